@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""Async facade over the SQLite pool.
+
+No query runs on the event-loop thread. Reads go to a small pool of
+reader threads, each borrowing a pooled WAL connection; writes are
+serialized on one dedicated writer thread that owns a long-lived
+connection and commits after every job (rolls back on error). A write
+is committed before its future resolves, so a following read sees it.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, List, NamedTuple, Optional, Sequence
+
+from db import db
+
+READER_THREADS = 4
+
+
+class WriteResult(NamedTuple):
+    rowcount: int
+    lastrowid: Optional[int]
+
+
+class AsyncDB:
+    def __init__(self, readers: int = READER_THREADS) -> None:
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-read")
+        # One worker == the write queue: jobs run strictly one after another.
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+        self._wconn = None  # only touched from the writer thread
+
+    async def _submit(self, pool: ThreadPoolExecutor, fn: Callable, *args) -> Any:
+        loop = asyncio.get_running_loop()
+        # Carry the caller's context so per-update query stats keep counting.
+        ctx = contextvars.copy_context()
+        return await loop.run_in_executor(pool, functools.partial(ctx.run, fn, *args))
+
+    # ---- worker-thread side ----
+    @staticmethod
+    def _run_read(fn: Callable) -> Any:
+        conn = db()
+        try:
+            return fn(conn)
+        finally:
+            conn.close()
+
+    def _run_write(self, fn: Callable) -> Any:
+        conn = self._wconn
+        if conn is None:
+            conn = self._wconn = db()
+        try:
+            res = fn(conn)
+            conn.commit()
+            return res
+        except BaseException:
+            conn.rollback()
+            raise
+
+    # ---- reads ----
+    async def read(self, fn: Callable) -> Any:
+        """Run `fn(conn)` on a reader thread and return its result."""
+        return await self._submit(self._readers, self._run_read, fn)
+
+    async def fetchone(self, sql: str, params: Sequence = ()):
+        return await self.read(lambda c: c.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params: Sequence = ()) -> List:
+        return await self.read(lambda c: c.execute(sql, params).fetchall())
+
+    # ---- writes ----
+    async def write(self, fn: Callable) -> Any:
+        """Run `fn(conn)` as one transaction on the writer thread."""
+        return await self._submit(self._writer, self._run_write, fn)
+
+    async def execute(self, sql: str, params: Sequence = ()) -> WriteResult:
+        def job(c):
+            cur = c.execute(sql, params)
+            return WriteResult(cur.rowcount, cur.lastrowid)
+
+        return await self.write(job)
+
+    async def executemany(self, sql: str, rows: Iterable[Sequence]) -> int:
+        rows = list(rows)
+        return await self.write(lambda c: c.executemany(sql, rows).rowcount)
+
+    def close(self) -> None:
+        self._readers.shutdown(wait=True)
+        self._writer.shutdown(wait=True)
+        if self._wconn is not None:
+            self._wconn.close()
+            self._wconn = None
+
+
+ADB = AsyncDB()
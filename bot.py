@@ -1,36 +1,26 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
 from zoneinfo import ZoneInfo
-from datetime import datetime, timezone
+from datetime import datetime, timedelta
 
-TEHRAN_TZ = ZoneInfo("Asia/Tehran")
+from timefmt import TEHRAN_TZ, fmt_ts
 
-def utc_sqlite_to_tehran(ts: str | None) -> str:
-    if not ts:
-        return "-"
-    try:
-        # SQLite: "YYYY-MM-DD HH:MM:SS" (UTC)
-        dt_utc = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
-        return dt_utc.astimezone(TEHRAN_TZ).strftime("%Y-%m-%d %H:%M:%S")
-    except ValueError:
-        # Fallback if format is slightly different (e.g. ISO) or invalid
-        return ts or "-"
+# ستون‌های زمان epoch (UTC) هستند؛ تبدیل فقط برای ردیف‌های نمایش‌داده‌شده (timefmt.py)
+utc_sqlite_to_tehran = fmt_ts
 
 # Backward-compatible alias (used by some parts of the code)
 to_tehran = utc_sqlite_to_tehran
 
 from dotenv import load_dotenv
 load_dotenv()
-import sqlite3
 import os
 import paramiko
-import subprocess
 import asyncio
 import time
 from datetime import datetime
 from typing import Optional
 
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F
 from aiogram.filters import CommandStart, StateFilter
 from aiogram.filters import CommandStart
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
@@ -39,12 +29,24 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 
 from utils.ssh_init import init_ssh_files
-from db import init, db
+from db import init, begin_request_stats
+from adb import ADB
+from settings import SETTINGS
+from users import USERS
 from crypto import enc, dec
 from ssh import reboot
 from states import AddServer, AdminAdd
 from monitor import loop as monitor_loop
-from checkhost import run_ping_check, CheckHostError
+from scheduler import clamp_interval
+from fleet import FLEET
+from icmp import PINGER, IcmpUnavailable
+from outbox import SENDER as OUTBOX_SENDER
+from writer import WRITER
+from partitions import CH_HISTORY, LOGS
+from export import ExportFilter, stream_export
+from rollups import DEFAULT_DAILY_DAYS, DEFAULT_HOURLY_DAYS, ROLLUPS, summarize
+from retention import RETENTION
+from checkhost import CHECKHOST, run_ping_check, CheckHostError, CheckHostThrottled
 
 
 # ---------------- FSM: Log retention ----------------
@@ -54,6 +56,8 @@ class BotSettings(StatesGroup):
     waiting_for_ping_int = State()
 class EditServer(StatesGroup):
     new_name = State()
+class LogExport(StatesGroup):
+    filters = State()
 
 # ---------------- Config ----------------
 OWNER = int(os.getenv("OWNER_ID") or os.getenv("OWNER") or "0")
@@ -67,83 +71,78 @@ BOT_HEADER = (
 BOT_NAME = "🎛 Server system guard"
 
 init()
+SETTINGS.load()
 bot = Bot(BOT_TOKEN)
 dp = Dispatcher(storage=MemoryStorage())
 
+# DB_QUERY_LOG=1 -> log query count/time for every update; otherwise only slow ones
+DB_QUERY_LOG = os.getenv("DB_QUERY_LOG") == "1"
+DB_SLOW_UPDATE_MS = 100.0
+
+
+class DbStatsMiddleware(BaseMiddleware):
+    """Counts SQLite queries and time spent in them for each update."""
+
+    async def __call__(self, handler, event, data):
+        st = begin_request_stats()
+        data["db_stats"] = st
+        try:
+            return await handler(event, data)
+        finally:
+            ms = st.seconds * 1000.0
+            if DB_QUERY_LOG or ms >= DB_SLOW_UPDATE_MS:
+                what = getattr(event, "event_type", type(event).__name__)
+                print(f"--- [DB] update {what}: {st.queries} queries, {ms:.1f} ms ---")
+
+
+dp.update.outer_middleware(DbStatsMiddleware())
+
 
 # ---------------- Role / Users ----------------
+# نقش‌ها از کش حافظه (users.py) خوانده می‌شوند؛ RoleMiddleware پیش از هر
+# هندلر کاربر را ثبت و کش را تازه می‌کند.
+USERS.owner = OWNER
+
+
+class RoleMiddleware(BaseMiddleware):
+    """Resolves the sender's role once per update and puts it in handler data."""
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        data["role"] = await USERS.resolve(user.id) if user else "viewer"
+        return await handler(event, data)
+
+
+dp.update.outer_middleware(RoleMiddleware())
+
+
 def get_role(uid: int) -> str:
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT role FROM users WHERE uid=?", (uid,))
-    r = cur.fetchone()
-    conn.close()
-    return r["role"] if r else "viewer"
+    return USERS.role(uid)
 
-def ensure_user(uid: int) -> None:
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT role FROM users WHERE uid=?", (uid,))
-    r = cur.fetchone()
-    if not r:
-        role = "viewer"
-        if OWNER and uid == OWNER:
-            role = "owner"
-        elif not OWNER:
-            # if no OWNER env, first ever user becomes owner
-            cur.execute("SELECT uid FROM users WHERE role='owner' LIMIT 1")
-            if not cur.fetchone():
-                role = "owner"
-        cur.execute("INSERT INTO users(uid,role) VALUES (?,?)", (uid, role))
-        conn.commit()
-    conn.close()
-
-
-def get_owner_id() -> int:
-    if OWNER:
-        return OWNER
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT uid FROM users WHERE role='owner' LIMIT 1")
-    r = cur.fetchone()
-    conn.close()
-    return int(r["uid"]) if r else 0
+
+async def get_owner_id() -> int:
+    await USERS.refresh()
+    return USERS.owner_id()
 
 
 def is_privileged(uid: int) -> bool:
     return get_role(uid) in ("owner", "admin")
 
 
-# ---------------- Settings (DB) ----------------
-def _ensure_settings_table() -> None:
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("CREATE TABLE IF NOT EXISTS settings (k TEXT PRIMARY KEY, v TEXT)")
-    conn.commit()
-    conn.close()
+def roles_changed() -> None:
+    # پس از setrole / rmuser / admin_add_uid
+    USERS.invalidate()
+    FLEET.invalidate_admins()
 
 
+# ---------------- Settings (cached, see settings.py) ----------------
 def get_setting(key: str, default: str) -> str:
-    _ensure_settings_table()
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT v FROM settings WHERE k=?", (key,))
-    r = cur.fetchone()
-    conn.close()
-    return (r["v"] if r is not None and r["v"] is not None else default)
+    return SETTINGS.get(key, default)
 
 
-def set_setting(key: str, value: str) -> None:
-    _ensure_settings_table()
-    conn = db()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO settings(k,v) VALUES (?,?) "
-        "ON CONFLICT(k) DO UPDATE SET v=excluded.v",
-        (key, value),
-    )
-    conn.commit()
-    conn.close()
+async def set_setting(key: str, value: str) -> None:
+    # ذخیره در دیتابیس + بیدار کردن monitor و checkhost_job
+    await SETTINGS.set(key, value)
 
 def post_add_server_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -166,40 +165,96 @@ def get_ping_interval() -> int:
     except:
         return 30
 
+def get_probe_mode() -> str:
+    # روش پایش: tcp (اتصال به پورت SSH) یا icmp (پینگ)
+    v = get_setting("probe_mode", "tcp")
+    return v if v in ("tcp", "icmp") else "tcp"
+
+def get_alert_digest_window() -> int:
+    # -1: هر تغییر یک پیام | 0: یک خلاصه برای هر دسته پروب | N: تجمیع N ثانیه‌ای
+    try:
+        v = int(get_setting("alert_digest_window", "15"))
+        return max(-1, min(300, v))
+    except Exception:
+        return 15
+
+def get_mon_log_mode() -> str:
+    # changes: فقط تغییر وضعیت در logs | full: یک ردیف برای هر پروب
+    v = get_setting("mon_log_mode", "changes")
+    return v if v in ("changes", "full") else "changes"
+
+def get_heartbeat_sec() -> int:
+    # طول پنجره خلاصه پروب‌ها (probe_heartbeats)، 0 = خاموش
+    try:
+        v = int(get_setting("log_heartbeat_min", "60"))
+        return max(0, min(1440, v)) * 60
+    except Exception:
+        return 3600
+
+def get_rollup_retention() -> tuple[int, int]:
+    # نگهداری آمار تجمیعی (rollups.py)، جدا از نگهداری لاگ خام
+    try:
+        h = max(1, min(3650, int(get_setting("rollup_hourly_days", str(DEFAULT_HOURLY_DAYS)))))
+        d = max(1, min(3650, int(get_setting("rollup_daily_days", str(DEFAULT_DAILY_DAYS)))))
+        return h, d
+    except Exception:
+        return DEFAULT_HOURLY_DAYS, DEFAULT_DAILY_DAYS
+
+def get_probe_concurrency() -> int:
+    # حداکثر تعداد پروب همزمان در هر دور پایش
+    try:
+        v = int(get_setting("probe_concurrency", "256"))
+        return max(1, min(4096, v))
+    except Exception:
+        return 256
+
+def get_cleanup_hour() -> int:
+    # ساعت اجرای پاک‌سازی خودکار (به وقت تهران) - ساعت کم‌ترافیک
+    try:
+        return max(0, min(23, int(get_setting("cleanup_hour", "4"))))
+    except Exception:
+        return 4
+
+def _seconds_until_hour(hour: int) -> float:
+    now = datetime.now(TEHRAN_TZ)
+    nxt = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+    if nxt <= now:
+        nxt += timedelta(days=1)
+    return (nxt - now).total_seconds()
+
 async def cleanup_logs_once(days: int) -> int:
     """پاک‌سازی همزمان لاگ‌های سیستمی و تاریخچه پایش ایران"""
-    conn = db()
-    cur = conn.cursor()
-    try:
-        # ۱. شمارش و حذف لاگ‌های عمومی (logs)
-        cur.execute("SELECT COUNT(*) AS c FROM logs WHERE ts < datetime('now', ?)", (f"-{days} day",))
-        before = cur.fetchone()["c"]
-        cur.execute("DELETE FROM logs WHERE ts < datetime('now', ?)", (f"-{days} day",))
-        
-        # ۲. حذف تاریخچه پایش (ch_history) - بدون تأثیر در شمارش قبل/بعد
-        try:
-            cur.execute("DELETE FROM ch_history WHERE ts < datetime('now', ?)", (f"-{days} day",))
-        except Exception:
-            pass # اگر جدول هنوز ساخته نشده بود
-            
-        conn.commit()
-        return int(before or 0)
-    finally:
-        conn.close()
+    # تکه‌تکه روی ترد writer (retention.py)؛ بین تکه‌ها نوشتن‌های دیگر اجرا می‌شوند
+    return await RETENTION.run(days)
 
 async def cleanup_logs_job():
-    """پاک‌سازی دوره‌ای (هر ۲۴ ساعت یک‌بار)"""
+    """پاک‌سازی روزانه در ساعت کم‌ترافیک (cleanup_hour)"""
+    loop = asyncio.get_running_loop()
     while True:
+        hour = get_cleanup_hour()
+        due = loop.time() + _seconds_until_hour(hour)
+        while True:
+            seen = SETTINGS.version
+            changed = await SETTINGS.wait_changed(seen, max(0.0, due - loop.time()))
+            # موعد رسیده (حتی اگر هم‌زمان تنظیمی عوض شده باشد)
+            if loop.time() >= due:
+                break
+            # فقط تغییر cleanup_hour زمان‌بندی را از نو شروع می‌کند
+            if changed and get_cleanup_hour() != hour:
+                hour = get_cleanup_hour()
+                due = loop.time() + _seconds_until_hour(hour)
         try:
             # خواندن تعداد روز از تنظیمات پنل (پیش‌فرض ۷ روز)
             days = get_log_retention_days()
             await cleanup_logs_once(days)
-            print(f"--- [Maintenance] Auto-cleanup done for {days} days old data. ---")
+            print(
+                f"--- [Maintenance] Auto-cleanup done for {days} days old data: "
+                f"{RETENTION.deleted} rows, {RETENTION.freed_mb():.1f} MB freed. ---"
+            )
         except Exception as e:
             print(f"--- [Maintenance Error] {e} ---")
-            
-        # ۲۴ ساعت انتظار تا اجرای بعدی
-        await asyncio.sleep(24 * 60 * 60)
+        # جلوگیری از اجرای دوباره در همان ساعت
+        await asyncio.sleep(60)
 
 async def get_system_usage(host, port, user, pw):
     try:
@@ -230,7 +285,7 @@ async def get_system_usage(host, port, user, pw):
 
 async def notify_owner_new_viewer(m: types.Message) -> None:
     """Notify owner when a non-admin/non-owner starts the bot."""
-    oid = get_owner_id()
+    oid = await get_owner_id()
     if not oid or oid == m.from_user.id:
         return
 
@@ -279,15 +334,32 @@ def main_kb(role: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 def settings_kb() -> InlineKeyboardMarkup:
+    mode_label = "ICMP (پینگ)" if get_probe_mode() == "icmp" else "TCP (پورت SSH)"
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="👥 مدیریت ادمین‌ها", callback_data="admin_panel")],
         [InlineKeyboardButton(text="🧹 مدیریت لاگ‌ها", callback_data="log_admin")],
         [InlineKeyboardButton(text="⏱ زمان پایش سرورها", callback_data="set_ping_int")],
+        [InlineKeyboardButton(text=f"📡 روش پایش: {mode_label}", callback_data="toggle_probe_mode")],
+        [InlineKeyboardButton(text=f"📣 خلاصه هشدارها: {digest_label(get_alert_digest_window())}", callback_data="alert_digest")],
              [InlineKeyboardButton(text="📜 لاگ‌های سیستم", callback_data="logs")],
         [InlineKeyboardButton(text="🔙 بازگشت به منوی اصلی", callback_data="home")],
    
     ])
 
+DIGEST_OPTIONS = [-1, 0, 15, 30, 60]
+
+def digest_label(v: int) -> str:
+    if v < 0:
+        return "خاموش"
+    if v == 0:
+        return "هر دور پایش"
+    return f"{v} ثانیه"
+
+def digest_kb() -> InlineKeyboardMarkup:
+    rows = [[InlineKeyboardButton(text=digest_label(v), callback_data=f"set_digest:{v}")] for v in DIGEST_OPTIONS]
+    rows.append([InlineKeyboardButton(text="🔙 بازگشت", callback_data="bot_settings")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
 def servers_list_kb(servers, role: str) -> InlineKeyboardMarkup:
     # تغییر srv: به status: برای هماهنگی با هندلر جدید
     rows = [[InlineKeyboardButton(text=f"🖥 {s['name']}", callback_data=f"status:{int(s['id'])}")] for s in servers]
@@ -310,20 +382,75 @@ def status_kb(sid: int) -> InlineKeyboardMarkup:
             InlineKeyboardButton(text="📝 ویرایش", callback_data=f"edit_name:{sid}"),
             InlineKeyboardButton(text="🗑 حذف", callback_data=f"del:{sid}")
         ],
+        [InlineKeyboardButton(text="⏱ بازه پایش این سرور", callback_data=f"ivl:{sid}")],
         [InlineKeyboardButton(text="🔙 بازگشت به لیست", callback_data="servers")]
     ])
 
+# بازه‌های آماده برای پایش هر سرور (ثانیه)؛ 0 یعنی استفاده از بازه کلی
+SERVER_INTERVAL_OPTIONS = [10, 30, 60, 120, 300, 0]
+
+def server_interval_kb(sid: int) -> InlineKeyboardMarkup:
+    rows = []
+    for v in SERVER_INTERVAL_OPTIONS:
+        label = "پیش‌فرض (بازه کلی)" if v == 0 else (f"{v} ثانیه" if v < 60 else f"{v // 60} دقیقه")
+        rows.append([InlineKeyboardButton(text=label, callback_data=f"set_ivl:{sid}:{v}")])
+    rows.append([InlineKeyboardButton(text="🔙 بازگشت", callback_data=f"status:{sid}")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
 def log_admin_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         inline_keyboard=[
             [InlineKeyboardButton(text="🧹 پاک‌سازی لاگ‌های قدیمی", callback_data="log_cleanup")],
             [InlineKeyboardButton(text="⏱ تنظیم تعداد روز نگهداری", callback_data="log_set_retention")],
             [InlineKeyboardButton(text="📦 آرشیو لاگ‌ها به فایل", callback_data="log_export")],
+            [InlineKeyboardButton(text=f"📝 لاگ پایش: {mon_log_label(get_mon_log_mode())}", callback_data="toggle_mon_log")],
+            [InlineKeyboardButton(text=f"💓 خلاصه پروب‌ها: {heartbeat_label(get_heartbeat_sec() // 60)}", callback_data="log_heartbeat")],
+            [InlineKeyboardButton(text=f"📚 نگهداری آمار: {rollup_label(*get_rollup_retention())}", callback_data="rollup_retention")],
+            [InlineKeyboardButton(text=f"🕓 ساعت پاک‌سازی خودکار: {get_cleanup_hour():02d}:00", callback_data="cleanup_hour")],
+            [InlineKeyboardButton(text="🔄 به‌روزرسانی وضعیت", callback_data="log_admin")],
             [InlineKeyboardButton(text="🔙 بازگشت", callback_data="bot_settings")],
         ]
     )
 
 
+HEARTBEAT_OPTIONS = [0, 15, 60, 360, 1440]
+
+def mon_log_label(v: str) -> str:
+    return "همه پروب‌ها" if v == "full" else "فقط تغییر وضعیت"
+
+def heartbeat_label(v: int) -> str:
+    if v <= 0:
+        return "خاموش"
+    if v % 60 == 0:
+        return f"{v // 60} ساعت"
+    return f"{v} دقیقه"
+
+def heartbeat_kb() -> InlineKeyboardMarkup:
+    rows = [[InlineKeyboardButton(text=heartbeat_label(v), callback_data=f"set_heartbeat:{v}")] for v in HEARTBEAT_OPTIONS]
+    rows.append([InlineKeyboardButton(text="🔙 بازگشت", callback_data="log_admin")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+# (روزهای نگهداری آمار ساعتی، روزهای نگهداری آمار روزانه)
+ROLLUP_OPTIONS = [(30, 365), (90, 730), (180, 1825)]
+
+def rollup_label(hourly: int, daily: int) -> str:
+    return f"ساعتی {hourly} روز | روزانه {daily} روز"
+
+def rollup_kb() -> InlineKeyboardMarkup:
+    rows = [[InlineKeyboardButton(text=rollup_label(h, d), callback_data=f"set_rollup:{h}:{d}")] for h, d in ROLLUP_OPTIONS]
+    rows.append([InlineKeyboardButton(text="🔙 بازگشت", callback_data="log_admin")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+CLEANUP_HOUR_OPTIONS = [1, 2, 3, 4, 5, 6]
+
+def cleanup_hour_kb() -> InlineKeyboardMarkup:
+    rows = [[InlineKeyboardButton(text=f"{h:02d}:00", callback_data=f"set_cleanup_hour:{h}")] for h in CLEANUP_HOUR_OPTIONS]
+    rows.append([InlineKeyboardButton(text="🔙 بازگشت", callback_data="log_admin")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
 def log_set_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -375,10 +502,57 @@ def add_server_kb() -> InlineKeyboardMarkup:
 def badge(st: str) -> str:
     return "🟢 UP" if st == "UP" else "🔴 DOWN"
 
+def _ms(v) -> str:
+    return "-" if v is None else f"{v:.1f}ms"
+
+def rtt_lines(sid: int) -> list[str]:
+    """Current / p50 / p95 connect latency over the last hour and day."""
+    srv = FLEET.servers.get(sid)
+    if srv is None or not len(srv.rtt):
+        return ["⚡ تاخیر: داده‌ای ثبت نشده"]
+    now = int(time.time())
+    h = srv.rtt.summary(now - 3600)
+    d = srv.rtt.summary(now - 86400)
+    return [
+        f"⚡ تاخیر فعلی: {_ms(srv.rtt.last())}",
+        f"🕐 ۱ ساعت: p50 {_ms(h['p50'])} | p95 {_ms(h['p95'])} ({h['ok']}/{h['probes']})",
+        f"📅 ۲۴ ساعت: p50 {_ms(d['p50'])} | p95 {_ms(d['p95'])} ({d['ok']}/{d['probes']})",
+    ]
+
+
+async def uptime_line(sid: int) -> str:
+    """24h uptime from probe_heartbeats (works in change-only log mode)."""
+    r = await ADB.fetchone(
+        "SELECT SUM(probes) AS n, SUM(failures) AS f FROM probe_heartbeats "
+        "WHERE server_id=? AND window_start >= ?",
+        (sid, int(time.time()) - 86400),
+    )
+    if not r or not r["n"]:
+        return "🟢 آپتایم ۲۴ ساعت: داده‌ای ثبت نشده"
+    up = (r["n"] - r["f"]) * 100.0 / r["n"]
+    return f"🟢 آپتایم ۲۴ ساعت: {up:.2f}% ({r['n'] - r['f']}/{r['n']})"
+
+
+async def rollup_lines(sid: int) -> list[str]:
+    """7-day (hourly tier) and 90-day (daily tier) uptime and latency."""
+    now = int(time.time())
+    week = await ADB.fetchall(
+        "SELECT * FROM probe_hourly WHERE server_id=? AND hour_start >= ?", (sid, now - 7 * 86400)
+    )
+    season = await ADB.fetchall(
+        "SELECT * FROM probe_daily WHERE server_id=? AND day_start >= ?", (sid, now - 90 * 86400)
+    )
+    out = []
+    for label, rows in (("۷ روز", week), ("۹۰ روز", season)):
+        s = summarize(rows)
+        if s["uptime"] is None:
+            continue
+        out.append(f"📆 {label}: آپتایم {s['uptime']:.2f}% | p50 {_ms(s['p50'])} | p95 {_ms(s['p95'])}")
+    return out
+
 
 # ---------------- Guards ----------------
 async def guard_cb(cb: types.CallbackQuery) -> bool:
-    ensure_user(cb.from_user.id)
     if not is_privileged(cb.from_user.id):
         try:
             await cb.answer()
@@ -389,7 +563,6 @@ async def guard_cb(cb: types.CallbackQuery) -> bool:
 
 
 async def guard_msg(m: types.Message) -> bool:
-    ensure_user(m.from_user.id)
     if not is_privileged(m.from_user.id):
         return False
     return True
@@ -397,21 +570,18 @@ async def guard_msg(m: types.Message) -> bool:
 
 # ---------------- Handlers ----------------
 @dp.message(CommandStart())
-async def start(m: types.Message, state: FSMContext):
+async def start(m: types.Message, state: FSMContext, role: str):
     await state.clear()
-    ensure_user(m.from_user.id)
-    if not is_privileged(m.from_user.id):
+    if role not in ("owner", "admin"):
         await notify_owner_new_viewer(m)
         return
-    role = get_role(m.from_user.id)
     await m.answer(BOT_HEADER + "\n\n" + BOT_NAME, reply_markup=main_kb(role))
 
 
 @dp.callback_query(F.data == "home")
-async def home(cb: types.CallbackQuery):
+async def home(cb: types.CallbackQuery, role: str):
     if not await guard_cb(cb):
         return
-    role = get_role(cb.from_user.id)
     await _edit_menu(cb.message, BOT_HEADER + "\n\n" + BOT_NAME, reply_markup=main_kb(role))
     await cb.answer()
 
@@ -419,15 +589,12 @@ async def home(cb: types.CallbackQuery):
 async def dashboard(cb: types.CallbackQuery):
     if not await guard_cb(cb): return
     
-    conn = db(); conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
     # اولویت با سرورهای آفلاین + مرتب‌سازی بر اساس ID
-    cur.execute(
+    rows = await ADB.fetchall(
         "SELECT s.name, s.host, ss.last_status "
         "FROM servers s LEFT JOIN server_status ss ON ss.server_id=s.id "
         "ORDER BY CASE WHEN ss.last_status = 'up' THEN 1 ELSE 0 END ASC, s.id DESC"
     )
-    rows = cur.fetchall(); conn.close()
 
     total = len(rows)
     up = sum(1 for r in rows if str(r["last_status"]).lower() == "up")
@@ -480,11 +647,7 @@ async def back_to_servers(cb: types.CallbackQuery, state: FSMContext):
     await state.clear()        
     role = get_role(cb.from_user.id)
     
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT id,name,host,port FROM servers ORDER BY id DESC")
-    rows = cur.fetchall()
-    conn.close()
+    rows = await ADB.fetchall("SELECT id,name,host,port FROM servers ORDER BY id DESC")
 
     if not rows:
         kb = []
@@ -512,12 +675,7 @@ async def server_detail(cb: types.CallbackQuery):
     if not await guard_cb(cb): return
     
     srv_id = int(cb.data.split(":")[1])
-    conn = db()
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM servers WHERE id = ?", (srv_id,))
-    srv = cur.fetchone()
-    conn.close()
+    srv = await ADB.fetchone("SELECT * FROM servers WHERE id = ?", (srv_id,))
 
     if not srv:
         await cb.answer("❌ سرور یافت نشد.", show_alert=True)
@@ -540,21 +698,20 @@ async def server_detail(cb: types.CallbackQuery):
 @dp.callback_query(F.data.startswith("stats:"))
 async def stats_handler(cb: types.CallbackQuery):
     sid = int(cb.data.split(":")[1])
-    conn = db()
-    cur = conn.cursor()
-    
     # من نام ستون اول را از SELECT حذف کردم و کل ستون‌ها را می‌گیرم تا خطا ندهد
-    cur.execute("SELECT * FROM logs WHERE server_id = ? ORDER BY id DESC LIMIT 5", (sid,))
-    rows = cur.fetchall()
-    conn.close()
+    rows = await ADB.read(lambda c: LOGS.newest_first(
+        c, "SELECT * FROM {t} WHERE server_id = ? ORDER BY id DESC LIMIT ?", (sid,), 5
+    ))
     
-    txt = "📊 **آخرین گزارشات:**\n\n"
+    txt = "📊 **آخرین گزارشات:**\n\n" + "\n".join(rtt_lines(sid)) + "\n"
+    txt += await uptime_line(sid) + "\n"
+    txt += "\n".join(await rollup_lines(sid)) + "\n\n"
     if not rows:
         txt += "داده‌ای یافت نشد."
     else:
         for r in rows:
             # r[-1] معمولاً زمان و r[1] معمولاً متن لاگ است در اکثر دیتابیس‌ها
-            txt += f"🔹 {r[-1]}: {r[1]}\n"
+            txt += f"🔹 {fmt_ts(r[-1])}: {r[1]}\n"
             
     kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🔙 بازگشت", callback_data=f"status:{sid}")]])
     await _edit_menu(cb.message, txt, reply_markup=kb)
@@ -563,18 +720,23 @@ async def stats_handler(cb: types.CallbackQuery):
 @dp.callback_query(F.data.startswith("test:"))
 async def test_ping_handler(cb: types.CallbackQuery):
     sid = int(cb.data.split(":")[1])
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT host FROM servers WHERE id=?", (sid,))
-    r = cur.fetchone()
-    conn.close()
+    r = await ADB.fetchone("SELECT host FROM servers WHERE id=?", (sid,))
     
     host = r[0]
-    # استفاده از فلگ -W 1 (تایم اوت ۱ ثانیه) برای سرعت بیشتر
-    check = subprocess.run(['ping', '-c', '1', '-W', '1', host], stdout=subprocess.PIPE)
-    
-    if check.returncode == 0:
-        await cb.answer(f"✅ آنلاین\nپاسخ از {host} دریافت شد.", show_alert=True)
+    # پینگ ICMP از طریق سوکت مشترک (بدون اجرای پروسه ping)
+    try:
+        res = await PINGER.ping(host, count=3, timeout=1.0)
+    except IcmpUnavailable:
+        await cb.answer("⚠️ ارسال ICMP مجاز نیست (NET_RAW).", show_alert=True)
+        return
+
+    if res.alive:
+        await cb.answer(
+            f"✅ آنلاین\nپاسخ از {host} دریافت شد.\n"
+            f"📦 Loss: {res.loss * 100:.0f}% ({res.received}/{res.sent})\n"
+            f"⏱ RTT min/avg/max: {res.rtt_min:.1f}/{res.rtt_avg:.1f}/{res.rtt_max:.1f} ms",
+            show_alert=True,
+        )
     else:
         await cb.answer(f"❌ آفلاین\nسرور {host} هیچ پاسخی نداد.", show_alert=True)
 
@@ -584,18 +746,13 @@ async def status(cb: types.CallbackQuery):
     if not await guard_cb(cb): return
     sid = int(cb.data.split(":")[1])
 
-    conn = db()
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT s.name, s.host, ss.last_status, ss.last_check_ts "
+    r = await ADB.fetchone(
+        "SELECT s.name, s.host, s.check_interval, ss.last_status, ss.last_check_ts "
         "FROM servers s "
         "LEFT JOIN server_status ss ON ss.server_id = s.id "
         "WHERE s.id = ?",
         (sid,),
     )
-    r = cur.fetchone()
-    conn.close()
 
     if not r:
         await cb.answer("سرور پیدا نشد", show_alert=True)
@@ -614,18 +771,51 @@ async def status(cb: types.CallbackQuery):
     last_check_utc = r['last_check_ts']
     last_check_tehran = utc_sqlite_to_tehran(last_check_utc)
 
+    if r['check_interval']:
+        interval_text = f"{int(r['check_interval'])} ثانیه"
+    else:
+        interval_text = f"{get_ping_interval()} ثانیه (پیش‌فرض)"
+
     txt = (
         f"<b>{BOT_NAME}</b>\n\n"
         f"🖥 <b>نام سرور:</b> {r['name']}\n"
         f"🌐 <b>آدرس:</b> <code>{r['host']}</code>\n"
         f"📊 <b>وضعیت پایش:</b> {st_text}\n"
-        f"⏱ <b>آخرین بررسی:</b> <code>{last_check_tehran}</code>"
+        f"⏱ <b>آخرین بررسی:</b> <code>{last_check_tehran}</code>\n"
+        f"🔁 <b>بازه پایش:</b> {interval_text}\n"
+        + "\n".join(rtt_lines(sid))
     )
 
     # حتما parse_mode را روی HTML ست کن
     await _edit_menu(cb.message, txt, reply_markup=status_kb(sid), parse_mode="HTML")
     await cb.answer()
 
+@dp.callback_query(F.data.startswith("ivl:"))
+async def server_interval(cb: types.CallbackQuery):
+    if not await guard_cb(cb): return
+    sid = int(cb.data.split(":")[1])
+    await _edit_menu(
+        cb.message,
+        BOT_HEADER + "\n\n⏱ بازه پایش این سرور را انتخاب کنید:\n"
+        "سرورهای حساس را کوتاه و سرورهای رزرو را طولانی تنظیم کنید.",
+        reply_markup=server_interval_kb(sid),
+    )
+    await cb.answer()
+
+@dp.callback_query(F.data.startswith("set_ivl:"))
+async def set_server_interval(cb: types.CallbackQuery):
+    if not await guard_cb(cb): return
+    _, sid, v = cb.data.split(":")
+    sid = int(sid)
+    v = int(v)
+    await ADB.execute(
+        "UPDATE servers SET check_interval=? WHERE id=?",
+        (clamp_interval(v) if v > 0 else None, sid),
+    )
+    FLEET.invalidate()
+    # نمایش دوباره صفحه سرور با بازه جدید
+    await status(cb)
+
 @dp.callback_query(F.data == "add")
 async def add(cb: types.CallbackQuery, state: FSMContext):
     if not await guard_cb(cb): return
@@ -731,14 +921,11 @@ async def add_pw(m: types.Message, state: FSMContext):
     await m.delete() # حذف پسورد از چت برای امنیت
     
     password = (m.text or "").strip()
-    conn = db()
-    cur = conn.cursor()
-    cur.execute(
+    await ADB.execute(
         "INSERT INTO servers(name,host,port,user,pw) VALUES (?,?,?,?,?)",
         (data["name"], data["host"], int(data["port"]), data["user"], enc(password)),
     )
-    conn.commit()
-    conn.close()
+    FLEET.invalidate()
     
     # حذف پیام مراحل قبلی ربات و فرستادن پیام اتمام موفقیت‌آمیز
     await m.bot.delete_message(chat_id=m.chat.id, message_id=data.get("last_msg_id"))
@@ -762,13 +949,9 @@ async def reboot_srv(cb: types.CallbackQuery):
         return
 
     sid = int(cb.data.split(":")[1])
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT host,port,user,pw,name FROM servers WHERE id=?", (sid,))
-    r = cur.fetchone()
+    r = await ADB.fetchone("SELECT host,port,user,pw,name FROM servers WHERE id=?", (sid,))
     
     if not r:
-        conn.close()
         return
 
     # ۲. اطلاع‌رسانی در منو که فرآیند شروع شده است
@@ -778,8 +961,10 @@ async def reboot_srv(cb: types.CallbackQuery):
         # فرآیند اصلی ریبوت که ممکن است زمان‌بر باشد
         await reboot((r["host"], int(r["port"]), r["user"], r["pw"]))
         
-        cur.execute("INSERT INTO logs(server_id,action,status) VALUES (?,?,?)", (sid, "REBOOT", "SENT"))
-        conn.commit()
+        await ADB.write(lambda c: c.execute(
+            LOGS.bind(c, "INSERT INTO {t}(server_id,action,status,ts) VALUES (?,?,?,?)"),
+            (sid, "REBOOT", "SENT", int(time.time())),
+        ))
         
         await _edit_menu(
             cb.message,
@@ -790,8 +975,10 @@ async def reboot_srv(cb: types.CallbackQuery):
             ),
         )
     except Exception as e:
-        cur.execute("INSERT INTO logs(server_id,action,status) VALUES (?,?,?)", (sid, "REBOOT", "ERR"))
-        conn.commit()
+        await ADB.write(lambda c: c.execute(
+            LOGS.bind(c, "INSERT INTO {t}(server_id,action,status,ts) VALUES (?,?,?,?)"),
+            (sid, "REBOOT", "ERR", int(time.time())),
+        ))
         await _edit_menu(
             cb.message,
             BOT_HEADER + f"\n\n❌ خطا در فرآیند ریبوت:\n`{e}`",
@@ -800,9 +987,7 @@ async def reboot_srv(cb: types.CallbackQuery):
                 inline_keyboard=[[InlineKeyboardButton(text="🔙 بازگشت", callback_data=f"status:{sid}")]]
             ),
         )
-    finally:
-        conn.close()
-        # دیگر نیازی به cb.answer در اینجا نیست چون در خط ۱۰ اجرا شد
+    # دیگر نیازی به cb.answer در اینجا نیست چون در خط ۱۰ اجرا شد
 
 @dp.callback_query(F.data.startswith("del:"))
 async def delete_confirm(cb: types.CallbackQuery):
@@ -816,22 +1001,27 @@ async def delete_confirm(cb: types.CallbackQuery):
 @dp.callback_query(F.data.startswith("force_del:"))
 async def force_delete(cb: types.CallbackQuery, state: FSMContext):
     sid = int(cb.data.split(":")[1])
-    conn = db()
-    cur = conn.cursor()
-    
-    # ۱. حذف از لیست اصلی سرورها
-    cur.execute("DELETE FROM servers WHERE id=?", (sid,))
-    # ۲. حذف از وضعیت‌های داشبورد
-    cur.execute("DELETE FROM server_status WHERE server_id=?", (sid,))
-    # ۳. حذف از لیست پایش ایران (نام صحیح جدول شما)
-    cur.execute("DELETE FROM checkhost_targets WHERE server_id=?", (sid,))
-    
-    conn.commit()
+    def _delete(conn):
+        cur = conn.cursor()
+        # ۱. حذف از لیست اصلی سرورها
+        cur.execute("DELETE FROM servers WHERE id=?", (sid,))
+        # ۲. حذف از وضعیت‌های داشبورد
+        cur.execute("DELETE FROM server_status WHERE server_id=?", (sid,))
+        # ۳. حذف از لیست پایش ایران (نام صحیح جدول شما)
+        cur.execute("DELETE FROM checkhost_targets WHERE server_id=?", (sid,))
+        # وضعیت check-host همراه با تاییدهای در انتظار (confirm_*)
+        cur.execute("DELETE FROM checkhost_state WHERE server_id=?", (sid,))
+        # ۴. حذف سری زمانی تاخیر
+        cur.execute("DELETE FROM probe_samples WHERE server_id=?", (sid,))
+        cur.execute("DELETE FROM probe_heartbeats WHERE server_id=?", (sid,))
+        cur.execute("DELETE FROM probe_hourly WHERE server_id=?", (sid,))
+        cur.execute("DELETE FROM probe_daily WHERE server_id=?", (sid,))
+
+    await ADB.write(_delete)
+    FLEET.invalidate()
     
     # دریافت لیست جدید برای نمایش
-    cur.execute("SELECT id, name, host, port FROM servers ORDER BY id DESC")
-    rows = cur.fetchall()
-    conn.close()
+    rows = await ADB.fetchall("SELECT id, name, host, port FROM servers ORDER BY id DESC")
     
     await cb.answer("🗑 سرور و تنظیمات پایش حذف شدند", show_alert=True)
     await state.clear()
@@ -858,11 +1048,8 @@ async def edit_name_finish(m: types.Message, state: FSMContext):
     new_name = m.text.strip()
     await m.delete() # پاک کردن پیام کاربر
     
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("UPDATE servers SET name = ? WHERE id = ?", (new_name, data['edit_srv_id']))
-    conn.commit()
-    conn.close()
+    await ADB.execute("UPDATE servers SET name = ? WHERE id = ?", (new_name, data['edit_srv_id']))
+    FLEET.invalidate()
     
     await m.bot.delete_message(m.chat.id, data['last_msg_id']) # حذف پیام قبلی ربات
     await state.clear()
@@ -875,11 +1062,7 @@ async def admin_panel(cb: types.CallbackQuery):
     if get_role(cb.from_user.id) != "owner":
         await cb.answer("فقط Owner دسترسی دارد", show_alert=True)
         return
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT uid,role FROM users ORDER BY role DESC, uid DESC")
-    users = cur.fetchall()
-    conn.close()
+    users = await ADB.fetchall("SELECT uid,role FROM users ORDER BY role DESC, uid DESC")
     await _edit_menu(cb.message, BOT_HEADER + "\n\n👥 مدیریت Admin", reply_markup=admin_panel_kb(users))
     await cb.answer()
 
@@ -892,11 +1075,7 @@ async def admin_user(cb: types.CallbackQuery):
         await cb.answer("فقط Owner", show_alert=True)
         return
     uid = int(cb.data.split(":")[1])
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT role FROM users WHERE uid=?", (uid,))
-    r = cur.fetchone()
-    conn.close()
+    r = await ADB.fetchone("SELECT role FROM users WHERE uid=?", (uid,))
     if not r:
         await cb.answer("کاربر پیدا نشد", show_alert=True)
         return
@@ -913,11 +1092,8 @@ async def setrole(cb: types.CallbackQuery):
         return
     _, uid, newrole = cb.data.split(":")
     uid = int(uid)
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET role=? WHERE uid=? AND role!='owner'", (newrole, uid))
-    conn.commit()
-    conn.close()
+    await ADB.execute("UPDATE users SET role=? WHERE uid=? AND role!='owner'", (newrole, uid))
+    roles_changed()
     await _edit_menu(
         cb.message,
         BOT_HEADER + "\n\n✅ Role آپدیت شد.",
@@ -936,11 +1112,8 @@ async def rmuser(cb: types.CallbackQuery):
         await cb.answer("فقط Owner", show_alert=True)
         return
     uid = int(cb.data.split(":")[1])
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM users WHERE uid=? AND role!='owner'", (uid,))
-    conn.commit()
-    conn.close()
+    await ADB.execute("DELETE FROM users WHERE uid=? AND role!='owner'", (uid,))
+    roles_changed()
     await _edit_menu(
         cb.message,
         BOT_HEADER + "\n\n🗑 حذف شد.",
@@ -991,9 +1164,7 @@ async def admin_add_uid(m: types.Message, state: FSMContext):
     # بررسی لغو عملیات
     if t.lower() in ("cancel", "/cancel", "بازگشت"):
         await state.clear()
-        conn = db(); cur = conn.cursor()
-        cur.execute("SELECT uid,role FROM users ORDER BY role DESC, uid DESC")
-        users = cur.fetchall(); conn.close()
+        users = await ADB.fetchall("SELECT uid,role FROM users ORDER BY role DESC, uid DESC")
         
         await bot.edit_message_text(
             chat_id=m.chat.id, message_id=menu_msg_id,
@@ -1009,17 +1180,16 @@ async def admin_add_uid(m: types.Message, state: FSMContext):
         return
 
     uid = int(t)
-    conn = db(); cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO users(uid,role) VALUES (?,?)", (uid, "admin"))
-    cur.execute("UPDATE users SET role='admin' WHERE uid=? AND role!='owner'", (uid,))
-    conn.commit(); conn.close()
+    await ADB.write(lambda c: (
+        c.execute("INSERT OR IGNORE INTO users(uid,role) VALUES (?,?)", (uid, "admin")),
+        c.execute("UPDATE users SET role='admin' WHERE uid=? AND role!='owner'", (uid,)),
+    ))
+    roles_changed()
     
     await state.clear()
 
     # بروزرسانی لیست ادمین‌ها در همان پیام قبلی
-    conn = db(); cur = conn.cursor()
-    cur.execute("SELECT uid,role FROM users ORDER BY role DESC, uid DESC")
-    users = cur.fetchall(); conn.close()
+    users = await ADB.fetchall("SELECT uid,role FROM users ORDER BY role DESC, uid DESC")
     
     await bot.edit_message_text(
         chat_id=m.chat.id, 
@@ -1037,16 +1207,113 @@ async def log_admin(cb: types.CallbackQuery):
         await cb.answer("فقط Owner", show_alert=True)
         return
     days = get_log_retention_days()
+    ws = WRITER.stats()
     msg = (
         BOT_HEADER
         + "\n\n🧹 **مدیریت لاگ‌ها**\n"
-        + f"⏱ نگهداری فعلی: **{days} روز**\n\n"
-        + "گزینه‌ها را انتخاب کنید:"
+        + f"⏱ نگهداری فعلی: **{days} روز**\n"
+        + f"📥 صف نوشتن: **{ws['queue_depth']}** | ⏱ آخرین flush: **{ws['last_flush_ms']:.1f} ms** "
+        + f"(بیشینه {ws['max_flush_ms']:.1f} ms)\n"
+        + retention_status()
+        + "\n\nگزینه‌ها را انتخاب کنید:"
     )
     await _edit_menu(cb.message, msg, parse_mode="Markdown", reply_markup=log_admin_kb())
     await cb.answer()
 
 
+def retention_status() -> str:
+    hour = get_cleanup_hour()
+    head = f"🕓 پاک‌سازی خودکار: هر روز ساعت **{hour:02d}:00**\n"
+    deleted = " | ".join(f"{k}: {v}" for k, v in RETENTION.deleted.items() if v) or "0"
+    if RETENTION.running:
+        return head + f"⏳ در حال اجرا ({RETENTION.phase}) — حذف شده: {deleted}"
+    if RETENTION.finished_ts:
+        when = datetime.fromtimestamp(RETENTION.finished_ts, TEHRAN_TZ).strftime("%Y-%m-%d %H:%M")
+        if RETENTION.last_error:
+            return head + f"❌ آخرین اجرا ({when}): {RETENTION.last_error}"
+        return head + f"✅ آخرین اجرا ({when}): حذف {deleted} | فضای آزاد شده {RETENTION.freed_mb():.1f} MB"
+    return head.rstrip("\n")
+
+
+@dp.callback_query(F.data == "toggle_mon_log")
+async def toggle_mon_log(cb: types.CallbackQuery):
+    if get_role(cb.from_user.id) != "owner":
+        return await cb.answer("دسترسی محدود!")
+    await set_setting("mon_log_mode", "changes" if get_mon_log_mode() == "full" else "full")
+    await log_admin(cb)
+
+
+@dp.callback_query(F.data == "log_heartbeat")
+async def log_heartbeat_menu(cb: types.CallbackQuery):
+    if get_role(cb.from_user.id) != "owner":
+        return await cb.answer("دسترسی محدود!")
+    await _edit_menu(
+        cb.message,
+        BOT_HEADER + "\n\n💓 **خلاصه پروب‌ها**\n"
+        "برای هر سرور در هر پنجره تعداد پروب، خطاها و میانگین تاخیر ذخیره می‌شود.\n"
+        f"وضعیت فعلی: {heartbeat_label(get_heartbeat_sec() // 60)}",
+        reply_markup=heartbeat_kb(),
+    )
+    await cb.answer()
+
+
+@dp.callback_query(F.data.startswith("set_heartbeat:"))
+async def set_heartbeat(cb: types.CallbackQuery):
+    if get_role(cb.from_user.id) != "owner":
+        return await cb.answer("دسترسی محدود!")
+    v = int(cb.data.split(":")[1])
+    await set_setting("log_heartbeat_min", str(max(0, min(1440, v))))
+    await log_admin(cb)
+
+
+@dp.callback_query(F.data == "rollup_retention")
+async def rollup_retention_menu(cb: types.CallbackQuery):
+    if get_role(cb.from_user.id) != "owner":
+        return await cb.answer("دسترسی محدود!")
+    await _edit_menu(
+        cb.message,
+        BOT_HEADER + "\n\n📚 **نگهداری آمار تجمیعی**\n"
+        "نمونه‌های خام پس از نگهداری لاگ حذف می‌شوند، اما آمار ساعتی و روزانه "
+        "(پروب‌ها، خطاها، آپتایم و p50/p95) مدت بیشتری می‌مانند.\n"
+        f"وضعیت فعلی: {rollup_label(*get_rollup_retention())}",
+        reply_markup=rollup_kb(),
+    )
+    await cb.answer()
+
+
+@dp.callback_query(F.data.startswith("set_rollup:"))
+async def set_rollup_retention(cb: types.CallbackQuery):
+    if get_role(cb.from_user.id) != "owner":
+        return await cb.answer("دسترسی محدود!")
+    _, h, d = cb.data.split(":")
+    await set_setting("rollup_hourly_days", str(max(1, min(3650, int(h)))))
+    await set_setting("rollup_daily_days", str(max(1, min(3650, int(d)))))
+    await log_admin(cb)
+
+
+@dp.callback_query(F.data == "cleanup_hour")
+async def cleanup_hour_menu(cb: types.CallbackQuery):
+    if get_role(cb.from_user.id) != "owner":
+        return await cb.answer("دسترسی محدود!")
+    await _edit_menu(
+        cb.message,
+        BOT_HEADER + "\n\n🕓 **ساعت پاک‌سازی خودکار**\n"
+        "پاک‌سازی روزانه در این ساعت (به وقت تهران) اجرا می‌شود.\n"
+        f"وضعیت فعلی: {get_cleanup_hour():02d}:00",
+        reply_markup=cleanup_hour_kb(),
+    )
+    await cb.answer()
+
+
+@dp.callback_query(F.data.startswith("set_cleanup_hour:"))
+async def set_cleanup_hour(cb: types.CallbackQuery):
+    if get_role(cb.from_user.id) != "owner":
+        return await cb.answer("دسترسی محدود!")
+    v = int(cb.data.split(":")[1])
+    await set_setting("cleanup_hour", str(max(0, min(23, v))))
+    await log_admin(cb)
+
+
 @dp.callback_query(F.data == "log_cleanup")
 async def log_cleanup(cb: types.CallbackQuery):
     if not await guard_cb(cb):
@@ -1054,11 +1321,17 @@ async def log_cleanup(cb: types.CallbackQuery):
     if get_role(cb.from_user.id) != "owner":
         await cb.answer("فقط Owner", show_alert=True)
         return
+    if RETENTION.running:
+        await cb.answer("پاک‌سازی در حال اجراست؛ پیشرفت در صفحه مدیریت لاگ‌ها.", show_alert=True)
+        return
     days = get_log_retention_days()
     await _edit_menu(cb.message, BOT_HEADER + f"\n\n⏳ در حال پاک‌سازی لاگ‌های قدیمی‌تر از {days} روز ...")
     try:
         deleted = await cleanup_logs_once(days)
-        msg = BOT_HEADER + f"\n\n✅ پاک‌سازی انجام شد.\n🗑 حذف شد: {deleted} رکورد"
+        msg = (
+            BOT_HEADER + f"\n\n✅ پاک‌سازی انجام شد.\n🗑 حذف شد: {deleted} رکورد"
+            f"\n💾 فضای آزاد شده: {RETENTION.freed_mb():.1f} MB"
+        )
     except Exception as e:
         msg = BOT_HEADER + f"\n\n❌ خطا در پاک‌سازی: {e}"
     await _edit_menu(cb.message, msg, reply_markup=log_admin_kb())
@@ -1104,7 +1377,7 @@ async def log_retention_days(m: types.Message, state: FSMContext):
         return
 
     days = int(t)
-    set_setting("log_retention_days", str(days))
+    await set_setting("log_retention_days", str(days))
 
     # گرفتن آیدی پیام منو و حذف پیام عدد کاربر
     data = await state.get_data()
@@ -1137,52 +1410,181 @@ async def log_retention_days(m: types.Message, state: FSMContext):
     except:
         await m.answer(msg, reply_markup=log_admin_kb())
 
+EXPORT_RANGES = [1, 7, 30, 0]  # روز؛ 0 = همه
+EXPORT_SOURCES = {"logs": "لاگ‌ها", "checkhost_history": "تاریخچه چک‌هاست"}
+
+def _export_cfg_default() -> dict:
+    return {"source": "logs", "fmt": "csv", "days": 7, "server_id": None, "action": None}
+
+def export_range_label(days: int) -> str:
+    if days <= 0:
+        return "همه"
+    if days == 1:
+        return "۲۴ ساعت اخیر"
+    return f"{days} روز اخیر"
+
+def export_filter_label(cfg: dict) -> str:
+    parts = []
+    if cfg.get("server_id") is not None:
+        parts.append(f"سرور {cfg['server_id']}")
+    if cfg.get("action"):
+        parts.append(f"وضعیت/اکشن {cfg['action']}")
+    return " | ".join(parts) or "بدون فیلتر"
+
+def export_kb(cfg: dict) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"📂 منبع: {EXPORT_SOURCES[cfg['source']]}", callback_data="exp:src")],
+        [InlineKeyboardButton(text=f"🗂 فرمت: {cfg['fmt'].upper()} (gzip)", callback_data="exp:fmt")],
+        [InlineKeyboardButton(text=f"📅 بازه: {export_range_label(cfg['days'])}", callback_data="exp:rng")],
+        [InlineKeyboardButton(text=f"🔎 فیلتر: {export_filter_label(cfg)}", callback_data="exp:flt")],
+        [InlineKeyboardButton(text="📤 ساخت و ارسال فایل", callback_data="exp:go")],
+        [InlineKeyboardButton(text="🔙 بازگشت", callback_data="log_admin")],
+    ])
+
+def _export_text() -> str:
+    return (
+        BOT_HEADER
+        + "\n\n📦 **آرشیو لاگ‌ها**\n"
+        + "خروجی به صورت فشرده (gzip) و بدون سقف تعداد رکورد ساخته می‌شود؛ "
+        + "فایل‌های بزرگ‌تر از ۴۵ مگابایت چند بخش ارسال می‌شوند."
+    )
+
+async def _export_cfg(state: FSMContext) -> dict:
+    data = await state.get_data()
+    return dict(data.get("export") or _export_cfg_default())
+
+
 @dp.callback_query(F.data == "log_export")
-async def log_export(cb: types.CallbackQuery):
+async def log_export(cb: types.CallbackQuery, state: FSMContext):
     if not await guard_cb(cb):
         return
     if get_role(cb.from_user.id) != "owner":
         await cb.answer("فقط Owner", show_alert=True)
         return
+    cfg = await _export_cfg(state)
+    await _edit_menu(cb.message, _export_text(), parse_mode="Markdown", reply_markup=export_kb(cfg))
+    await cb.answer()
 
-    days = get_log_retention_days()
-    await _edit_menu(cb.message, BOT_HEADER + "\n\n⏳ در حال آماده‌سازی فایل آرشیو لاگ‌ها ...")
 
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT id,ts,server_id,action,status FROM logs ORDER BY id DESC LIMIT 5000")
-    rows = cur.fetchall()
-    conn.close()
-
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    path = f"/tmp/server_guard_logs_{ts}.txt"
-    with open(path, "w", encoding="utf-8") as f:
-        f.write("Server system guard logs export\n")
-        f.write(f"Export time: {ts}\n")
-        f.write(f"Retention setting: {days} days\n")
-        f.write(f"Rows: {len(rows)}\n\n")
-        for r in rows:
-            f.write(f"{r['id']}\t{r['ts']}\tsrv:{r['server_id']}\t{r['action']}\t{r['status']}\n")
+@dp.callback_query(F.data.in_({"exp:src", "exp:fmt", "exp:rng"}))
+async def export_option(cb: types.CallbackQuery, state: FSMContext):
+    if get_role(cb.from_user.id) != "owner":
+        return await cb.answer("دسترسی محدود!")
+    cfg = await _export_cfg(state)
+    if cb.data == "exp:src":
+        cfg["source"] = "checkhost_history" if cfg["source"] == "logs" else "logs"
+    elif cb.data == "exp:fmt":
+        cfg["fmt"] = "jsonl" if cfg["fmt"] == "csv" else "csv"
+    else:
+        i = EXPORT_RANGES.index(cfg["days"]) if cfg["days"] in EXPORT_RANGES else 0
+        cfg["days"] = EXPORT_RANGES[(i + 1) % len(EXPORT_RANGES)]
+    await state.update_data(export=cfg)
+    await _edit_menu(cb.message, _export_text(), parse_mode="Markdown", reply_markup=export_kb(cfg))
+    await cb.answer()
+
+
+@dp.callback_query(F.data == "exp:flt")
+async def export_filter_ask(cb: types.CallbackQuery, state: FSMContext):
+    if get_role(cb.from_user.id) != "owner":
+        return await cb.answer("دسترسی محدود!")
+    await state.set_state(LogExport.filters)
+    await state.update_data(menu_msg_id=cb.message.message_id)
+    await _edit_menu(
+        cb.message,
+        BOT_HEADER + "\n\n🔎 **فیلتر آرشیو**\n"
+        "شناسه سرور و/یا اکشن (برای تاریخچه چک‌هاست: OK/FAIL) را بفرستید.\n"
+        "مثال: `12 MON` یا `REBOOT` یا `12`\n"
+        "برای حذف فیلتر `-` بفرستید.",
+        parse_mode="Markdown",
+        reply_markup=log_set_kb(),
+    )
+    await cb.answer()
+
+
+@dp.message(LogExport.filters)
+async def export_filter_set(m: types.Message, state: FSMContext):
+    if not await guard_msg(m):
+        return
+    if get_role(m.from_user.id) != "owner":
+        return
+    cfg = await _export_cfg(state)
+    cfg["server_id"] = None
+    cfg["action"] = None
+    for tok in (m.text or "").split():
+        if tok.isdigit():
+            cfg["server_id"] = int(tok)
+        elif tok != "-":
+            cfg["action"] = tok.upper()[:32]
+    data = await state.get_data()
+    await state.set_state(None)
+    await state.update_data(export=cfg)
+    try:
+        await m.delete()
+    except Exception:
+        pass
+    try:
+        await bot.edit_message_text(
+            chat_id=m.chat.id,
+            message_id=data.get("menu_msg_id"),
+            text=_export_text(),
+            parse_mode="Markdown",
+            reply_markup=export_kb(cfg),
+        )
+    except Exception:
+        await m.answer(_export_text(), parse_mode="Markdown", reply_markup=export_kb(cfg))
+
+
+@dp.callback_query(F.data == "exp:go")
+async def export_run(cb: types.CallbackQuery, state: FSMContext):
+    if not await guard_cb(cb):
+        return
+    if get_role(cb.from_user.id) != "owner":
+        await cb.answer("فقط Owner", show_alert=True)
+        return
+    cfg = await _export_cfg(state)
+    await cb.answer()
+    await _edit_menu(cb.message, BOT_HEADER + "\n\n⏳ در حال آماده‌سازی فایل آرشیو ...")
+
+    now = int(time.time())
+    flt = ExportFilter(
+        source=cfg["source"],
+        fmt=cfg["fmt"],
+        server_id=cfg.get("server_id"),
+        action=cfg.get("action"),
+        since=now - cfg["days"] * 86400 if cfg["days"] > 0 else None,
+        until=None,
+    )
+    stamp = fmt_ts(now, "%Y%m%d_%H%M%S")
+    sent = []
+
+    async def send_part(path: str, part_no: int, rows: int) -> None:
+        name = f"{flt.source}_{stamp}" + (f"_part{part_no}" if part_no > 1 else "") + f".{flt.fmt}.gz"
+        await bot.send_document(
+            cb.from_user.id,
+            FSInputFile(path, filename=name),
+            caption=f"📦 آرشیو {EXPORT_SOURCES[flt.source]} — بخش {part_no} ({rows} رکورد)",
+        )
+        sent.append(part_no)
 
     try:
-        await bot.send_document(cb.from_user.id, FSInputFile(path), caption="📦 آرشیو لاگ‌ها")
-        msg = BOT_HEADER + f"\n\n✅ فایل آرشیو ارسال شد.\n📄 تعداد رکورد: {len(rows)}"
+        total = await stream_export(flt, send_part)
+        if total:
+            msg = BOT_HEADER + f"\n\n✅ فایل آرشیو ارسال شد.\n📄 تعداد رکورد: {total} | 🗂 بخش‌ها: {len(sent)}"
+        else:
+            msg = BOT_HEADER + "\n\nℹ️ رکوردی با این فیلترها پیدا نشد."
     except Exception as e:
         msg = BOT_HEADER + f"\n\n❌ ارسال فایل ناموفق: {e}"
 
-    await _edit_menu(cb.message, msg, reply_markup=log_admin_kb())
-    await cb.answer()
+    await _edit_menu(cb.message, msg, reply_markup=export_kb(cfg))
 
 
 @dp.callback_query(F.data == "logs")
 async def logs(cb: types.CallbackQuery):
     if not await guard_cb(cb):
         return
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT server_id,action,status,ts FROM logs ORDER BY id DESC LIMIT 20")
-    rows = cur.fetchall()
-    conn.close()
+    rows = await ADB.read(lambda c: LOGS.newest_first(
+        c, "SELECT server_id,action,status,ts FROM {t} ORDER BY id DESC LIMIT ?", (), 20
+    ))
     if not rows:
         await _edit_menu(
             cb.message,
@@ -1250,46 +1652,6 @@ CH_IR_NODE_LABELS = {
 CH_LOCK = asyncio.Lock()
 
 
-def _ensure_checkhost_tables() -> None:
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("CREATE TABLE IF NOT EXISTS checkhost_targets (server_id INTEGER PRIMARY KEY)")
-    cur.execute(
-        "CREATE TABLE IF NOT EXISTS checkhost_state ("
-        "server_id INTEGER PRIMARY KEY,"
-        "last_status TEXT,"
-        "updated_ts DATETIME DEFAULT CURRENT_TIMESTAMP,"
-        "auto_status TEXT,"
-        "fail_alert_sent INTEGER DEFAULT 0"
-        ")"
-    )
-    # Migrate older DBs (ignore errors if columns already exist)
-    for ddl in (
-        "ALTER TABLE checkhost_state ADD COLUMN auto_status TEXT",
-        "ALTER TABLE checkhost_state ADD COLUMN fail_alert_sent INTEGER DEFAULT 0",
-    ):
-        try:
-            cur.execute(ddl)
-        except Exception:
-            pass
-    cur.execute(
-        "CREATE TABLE IF NOT EXISTS checkhost_history ("
-        "id INTEGER PRIMARY KEY AUTOINCREMENT,"
-        "ts DATETIME DEFAULT CURRENT_TIMESTAMP,"
-        "server_id INTEGER,"
-        "host TEXT,"
-        "ok_nodes INTEGER,"
-        "total_nodes INTEGER,"
-        "threshold INTEGER,"
-        "status TEXT,"
-        "report_link TEXT,"
-        "details TEXT"
-        ")"
-    )
-    conn.commit()
-    conn.close()
-
-
 def _ch_get_int(key: str, default: int, lo: int, hi: int) -> int:
     try:
         v = int(get_setting(key, str(default)))
@@ -1327,6 +1689,11 @@ def ch_retry_delay_sec() -> int:
     return _ch_get_int("ch_retry_delay_sec", 20, 0, 600)
 
 
+def ch_max_inflight() -> int:
+    # How many check-host checks may run at the same time.
+    return _ch_get_int("ch_max_inflight", 8, 1, 32)
+
+
 # Backward-compatible alias (some older code paths referenced ch_retry_delay())
 def ch_retry_delay() -> int:
     return ch_retry_delay_sec()
@@ -1349,8 +1716,8 @@ def ch_last_run_utc() -> int:
     return _ch_get_int("ch_last_run_utc", 0, 0, 2_000_000_000)
 
 
-def ch_set_last_run_utc(ts: int) -> None:
-    set_setting("ch_last_run_utc", str(int(ts)))
+async def ch_set_last_run_utc(ts: int) -> None:
+    await set_setting("ch_last_run_utc", str(int(ts)))
 
 
 
@@ -1361,105 +1728,104 @@ def ch_get_notify_chat_id() -> int:
         return 0
 
 
-def ch_set_notify_chat_id(chat_id: int) -> None:
+async def ch_set_notify_chat_id(chat_id: int) -> None:
     try:
-        set_setting("ch_notify_chat_id", str(int(chat_id)))
+        await set_setting("ch_notify_chat_id", str(int(chat_id)))
     except Exception:
         pass
 
-def ch_get_targets() -> set[int]:
-    _ensure_checkhost_tables()
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT server_id FROM checkhost_targets")
-    rows = cur.fetchall()
-    conn.close()
+async def ch_get_targets() -> set[int]:
+    rows = await ADB.fetchall("SELECT server_id FROM checkhost_targets")
     return {int(r["server_id"]) for r in rows}
 
 
-def ch_toggle_target(server_id: int) -> None:
-    _ensure_checkhost_tables()
-    conn = db()
+def _ch_toggle_target_txn(conn, server_id: int) -> None:
     cur = conn.cursor()
     cur.execute("SELECT 1 FROM checkhost_targets WHERE server_id=?", (server_id,))
     if cur.fetchone():
         cur.execute("DELETE FROM checkhost_targets WHERE server_id=?", (server_id,))
     else:
         cur.execute("INSERT OR IGNORE INTO checkhost_targets(server_id) VALUES (?)", (server_id,))
-    conn.commit()
-    conn.close()
 
 
-def ch_get_last_status(server_id: int) -> str:
-    _ensure_checkhost_tables()
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT last_status FROM checkhost_state WHERE server_id=?", (server_id,))
-    r = cur.fetchone()
-    conn.close()
+async def ch_toggle_target(server_id: int) -> None:
+    await ADB.write(lambda c: _ch_toggle_target_txn(c, server_id))
+
+
+async def ch_get_last_status(server_id: int) -> str:
+    r = await ADB.fetchone("SELECT last_status FROM checkhost_state WHERE server_id=?", (server_id,))
     return (r["last_status"] if r and r["last_status"] else "UNKNOWN")
 
 
-def ch_set_last_status(server_id: int, status: str) -> None:
-    _ensure_checkhost_tables()
-    conn = db()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO checkhost_state(server_id,last_status) VALUES (?,?) "
-        "ON CONFLICT(server_id) DO UPDATE SET last_status=excluded.last_status, updated_ts=CURRENT_TIMESTAMP",
-        (server_id, status),
+async def ch_set_last_status(server_id: int, status: str) -> None:
+    await ADB.execute(
+        "INSERT INTO checkhost_state(server_id,last_status,updated_ts) VALUES (?,?,?) "
+        "ON CONFLICT(server_id) DO UPDATE SET last_status=excluded.last_status, updated_ts=excluded.updated_ts",
+        (server_id, status, int(time.time())),
     )
-    conn.commit()
-    conn.close()
 
 
 
-def ch_get_auto_status(server_id: int) -> str:
-    _ensure_checkhost_tables()
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT auto_status FROM checkhost_state WHERE server_id=?", (server_id,))
-    r = cur.fetchone()
-    conn.close()
+async def ch_get_auto_status(server_id: int) -> str:
+    r = await ADB.fetchone("SELECT auto_status FROM checkhost_state WHERE server_id=?", (server_id,))
     return (r["auto_status"] if r and r["auto_status"] else "UNKNOWN")
 
 
-def ch_set_auto_status(server_id: int, status: str) -> None:
-    _ensure_checkhost_tables()
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO checkhost_state(server_id) VALUES (?)", (server_id,))
-    cur.execute(
-        "UPDATE checkhost_state SET auto_status=?, updated_ts=CURRENT_TIMESTAMP WHERE server_id=?",
-        (status, server_id),
+async def ch_set_auto_status(server_id: int, status: str) -> None:
+    await ADB.write(lambda c: (
+        c.execute("INSERT OR IGNORE INTO checkhost_state(server_id) VALUES (?)", (server_id,)),
+        c.execute(
+            "UPDATE checkhost_state SET auto_status=?, updated_ts=? WHERE server_id=?",
+            (status, int(time.time()), server_id),
+        ),
+    ))
+
+
+async def ch_schedule_confirm(
+    server_id: int, kind: str, done: int, left: int, due: int, deadline: int
+) -> None:
+    await ADB.write(lambda c: (
+        c.execute("INSERT OR IGNORE INTO checkhost_state(server_id) VALUES (?)", (server_id,)),
+        c.execute(
+            "UPDATE checkhost_state SET confirm_kind=?, confirm_done=?, confirm_left=?, "
+            "confirm_due=?, confirm_deadline=? WHERE server_id=?",
+            (kind, done, left, due, deadline, server_id),
+        ),
+    ))
+    _ch_confirm_wakeup.set()
+
+
+async def ch_clear_confirm(server_id: int) -> None:
+    await ADB.execute(
+        "UPDATE checkhost_state SET confirm_kind=NULL, confirm_done=0, confirm_left=0, "
+        "confirm_due=NULL, confirm_deadline=NULL WHERE server_id=?",
+        (server_id,),
     )
-    conn.commit()
-    conn.close()
 
 
-def ch_get_fail_alert_sent(server_id: int) -> int:
-    _ensure_checkhost_tables()
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT fail_alert_sent FROM checkhost_state WHERE server_id=?", (server_id,))
-    r = cur.fetchone()
-    conn.close()
+async def ch_get_confirm(server_id: int):
+    return await ADB.fetchone(
+        "SELECT confirm_kind, confirm_done, confirm_left, confirm_deadline FROM checkhost_state "
+        "WHERE server_id=? AND confirm_kind IS NOT NULL",
+        (server_id,),
+    )
+
+
+async def ch_get_fail_alert_sent(server_id: int) -> int:
+    r = await ADB.fetchone("SELECT fail_alert_sent FROM checkhost_state WHERE server_id=?", (server_id,))
     try:
         return int(r["fail_alert_sent"]) if r and r["fail_alert_sent"] is not None else 0
     except Exception:
         return 0
 
 
-def ch_set_fail_alert_sent(server_id: int, sent: int) -> None:
-    _ensure_checkhost_tables()
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO checkhost_state(server_id) VALUES (?)", (server_id,))
-    cur.execute("UPDATE checkhost_state SET fail_alert_sent=? WHERE server_id=?", (1 if sent else 0, server_id))
-    conn.commit()
-    conn.close()
+async def ch_set_fail_alert_sent(server_id: int, sent: int) -> None:
+    await ADB.write(lambda c: (
+        c.execute("INSERT OR IGNORE INTO checkhost_state(server_id) VALUES (?)", (server_id,)),
+        c.execute("UPDATE checkhost_state SET fail_alert_sent=? WHERE server_id=?", (1 if sent else 0, server_id)),
+    ))
 
-def ch_add_history(
+async def ch_add_history(
     server_id: int,
     host: str,
     ok_nodes: int,
@@ -1521,20 +1887,16 @@ def ch_add_history(
     if err:
         details = (details or "") + ("\n\n" if details else "") + f"⚠️ err: {err}"
 
-    _ensure_checkhost_tables()
-    conn = db()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO checkhost_history(server_id,host,ok_nodes,total_nodes,threshold,status,report_link,details) "
-        "VALUES (?,?,?,?,?,?,?,?)",
-        (server_id, host, int(ok_nodes), int(total_nodes), threshold_i, str(status), str(link), str(details)),
-    )
-    # Keep history bounded (last 2000 rows)
-    cur.execute(
-        "DELETE FROM checkhost_history WHERE id NOT IN (SELECT id FROM checkhost_history ORDER BY id DESC LIMIT 2000)"
-    )
-    conn.commit()
-    conn.close()
+    row = (int(time.time()), server_id, host, int(ok_nodes), int(total_nodes), threshold_i, str(status), str(link), str(details))
+    # History is bounded by partition retention (retention.py, partitions.drop_before).
+    await ADB.write(lambda c: c.execute(
+        CH_HISTORY.bind(
+            c,
+            "INSERT INTO {t}(ts,server_id,host,ok_nodes,total_nodes,threshold,status,report_link,details) "
+            "VALUES (?,?,?,?,?,?,?,?,?)",
+        ),
+        row,
+    ))
 
 
 def _ch_tehran_now() -> str:
@@ -1562,6 +1924,7 @@ def ch_menu_kb() -> InlineKeyboardMarkup:
             [InlineKeyboardButton(text="🔁 تایید خطا (تعداد تکرار)", callback_data="ch_fail_confirm")],
             [InlineKeyboardButton(text="⏳ تاخیر بین تکرارها", callback_data="ch_retry_delay")],
             [InlineKeyboardButton(text="✅ تایید رفع مشکل (OK)", callback_data="ch_ok_confirm")],
+            [InlineKeyboardButton(text=f"🚦 چک هم‌زمان: {ch_max_inflight()}", callback_data="ch_inflight")],
             [InlineKeyboardButton(text=f"🔔 نوتیفیکیشن: {'خاموش' if ch_silent_mode() else 'روشن'}", callback_data="ch_toggle_silent")],
             [InlineKeyboardButton(text=f"✅ پیام OK: {'روشن' if ch_notify_ok() else 'خاموش'}", callback_data="ch_toggle_ok_notify")],
             [InlineKeyboardButton(text="📜 تاریخچه پایش", callback_data="ch_history")],
@@ -1571,11 +1934,12 @@ def ch_menu_kb() -> InlineKeyboardMarkup:
     )
 
 
-def _ch_menu_text() -> str:
+async def _ch_menu_text() -> str:
     n = ch_nodes_count()
     thr = ch_threshold()
     interval = ch_interval_hours()
-    targets = len(ch_get_targets())
+    targets = len(await ch_get_targets())
+    pending = await ADB.fetchone("SELECT COUNT(*) FROM checkhost_state WHERE confirm_kind IS NOT NULL")
     fail_checks = ch_fail_confirm_checks()
     ok_checks = ch_ok_confirm_checks()
     delay = ch_retry_delay_sec()
@@ -1587,9 +1951,28 @@ def _ch_menu_text() -> str:
         + (f"⏱️ اجرای خودکار: **غیرفعال**\n" if interval == 0 else f"⏱️ اجرا هر: **{interval} ساعت**\n")
         + f"🔁 تایید خطا: **{fail_checks} چک** | ⏳ تاخیر: **{delay} ثانیه**\n"
         + f"✅ تایید OK: **{ok_checks} چک**\n"
+        + f"🕒 تایید در انتظار: **{pending[0] if pending else 0}**\n"
+        + f"🚦 چک هم‌زمان: **{ch_max_inflight()}**\n"
         + f"🔔 نوتیفیکیشن: **{'خاموش' if ch_silent_mode() else 'روشن'}**\n"
         + f"✅ پیام OK: **{'روشن' if ch_notify_ok() else 'خاموش'}**\n"
-        + f"🖥 سرورهای انتخاب‌شده: **{targets}**"
+        + f"🖥 سرورهای انتخاب‌شده: **{targets}**\n"
+        + ch_pool_line()
+    )
+
+
+def ch_pool_line() -> str:
+    st = CHECKHOST.stats()
+    conns = st["conn_new"] + st["conn_reused"]
+    reuse = st["conn_reused"] * 100.0 / conns if conns else 0.0
+    return (
+        f"🔌 اتصال check-host: {st['requests']} درخواست | "
+        f"{st['conn_new']} اتصال جدید | استفاده مجدد {reuse:.0f}% | "
+        f"DNS cache {st['dns_hits']}/{st['dns_hits'] + st['dns_misses']}\n"
+        f"📈 {st['checks']} چک | میانگین {st['polls'] / st['checks'] if st['checks'] else 0:.1f} poll | "
+        f"تصمیم زودهنگام {st['early']}\n"
+        f"🪣 سهمیه API: {st['tokens']:.0f}/{st['capacity']:.0f} توکن ({st['rate'] * 60:.0f}/دقیقه) | "
+        f"{st['req_last_min']} درخواست در دقیقه اخیر | 429: {st['throttled']}"
+        + (f" | ⏸ توقف {st['paused_for']:.0f} ثانیه" if st["paused_for"] > 0 else "")
     )
 
 
@@ -1605,15 +1988,10 @@ async def _owner_only_cb(cb: types.CallbackQuery) -> bool:
     return True
 
 
-def ch_targets_kb() -> InlineKeyboardMarkup:
-    _ensure_checkhost_tables()
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT id,name,host FROM servers ORDER BY id DESC")
-    servers = cur.fetchall()
-    conn.close()
+async def ch_targets_kb() -> InlineKeyboardMarkup:
+    servers = await ADB.fetchall("SELECT id,name,host FROM servers ORDER BY id DESC")
 
-    selected = ch_get_targets()
+    selected = await ch_get_targets()
     rows = []
     for s in servers:
         sid = int(s["id"])
@@ -1698,9 +2076,9 @@ def ch_ok_confirm_kb() -> InlineKeyboardMarkup:
 async def ch_menu(cb: types.CallbackQuery):
     if not await _owner_only_cb(cb):
         return
-    ch_set_notify_chat_id(cb.message.chat.id)
+    await ch_set_notify_chat_id(cb.message.chat.id)
 
-    await _edit_menu(cb.message, _ch_menu_text(), parse_mode="Markdown", reply_markup=ch_menu_kb())
+    await _edit_menu(cb.message, await _ch_menu_text(), parse_mode="Markdown", reply_markup=ch_menu_kb())
     try:
         await cb.answer()
     except Exception:
@@ -1711,7 +2089,7 @@ async def ch_menu(cb: types.CallbackQuery):
 async def ch_targets(cb: types.CallbackQuery):
     if not await _owner_only_cb(cb):
         return
-    await _edit_menu(cb.message, BOT_HEADER + "\n\n🖥 انتخاب سرورهای پایش:", reply_markup=ch_targets_kb())
+    await _edit_menu(cb.message, BOT_HEADER + "\n\n🖥 انتخاب سرورهای پایش:", reply_markup=await ch_targets_kb())
     try:
         await cb.answer()
     except Exception:
@@ -1720,12 +2098,7 @@ async def ch_targets(cb: types.CallbackQuery):
 @dp.callback_query(F.data.startswith("usage:"))
 async def show_usage(cb: types.CallbackQuery):
     sid = int(cb.data.split(":")[1])
-    conn = db()
-    conn.row_factory = sqlite3.Row # برای دسترسی با نام ستون
-    cur = conn.cursor()
-    cur.execute("SELECT host, port, user, pw, name FROM servers WHERE id=?", (sid,))
-    s = cur.fetchone()
-    conn.close()
+    s = await ADB.fetchone("SELECT host, port, user, pw, name FROM servers WHERE id=?", (sid,))
 
     if not s:
         await cb.answer("❌ سرور یافت نشد.")
@@ -1770,8 +2143,8 @@ async def ch_toggle(cb: types.CallbackQuery):
     if not await _owner_only_cb(cb):
         return
     sid = int(cb.data.split(":")[1])
-    ch_toggle_target(sid)
-    await _edit_menu(cb.message, BOT_HEADER + "\n\n🖥 انتخاب سرورهای پایش:", reply_markup=ch_targets_kb())
+    await ch_toggle_target(sid)
+    await _edit_menu(cb.message, BOT_HEADER + "\n\n🖥 انتخاب سرورهای پایش:", reply_markup=await ch_targets_kb())
     try:
         await cb.answer()
     except Exception:
@@ -1796,11 +2169,46 @@ async def ch_set_nodes(cb: types.CallbackQuery):
         return
     v = int(cb.data.split(":")[1])
     v = max(1, min(len(CH_IR_NODES), v))
-    set_setting("ch_nodes_count", str(v))
+    await set_setting("ch_nodes_count", str(v))
     # Clamp threshold to new N
     if ch_threshold() > v:
-        set_setting("ch_threshold", str(v))
-    await _edit_menu(cb.message, _ch_menu_text(), parse_mode="Markdown", reply_markup=ch_menu_kb())
+        await set_setting("ch_threshold", str(v))
+    await _edit_menu(cb.message, await _ch_menu_text(), parse_mode="Markdown", reply_markup=ch_menu_kb())
+    try:
+        await cb.answer("ثبت شد")
+    except Exception:
+        pass
+
+
+def ch_inflight_kb() -> InlineKeyboardMarkup:
+    rows = [[InlineKeyboardButton(text=f"{v}", callback_data=f"ch_set_inflight:{v}")] for v in (2, 4, 8, 16, 32)]
+    rows.append([InlineKeyboardButton(text="🔙 بازگشت", callback_data="ch_menu")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+@dp.callback_query(F.data == "ch_inflight")
+async def ch_inflight(cb: types.CallbackQuery):
+    if not await _owner_only_cb(cb):
+        return
+    msg = (
+        BOT_HEADER
+        + f"\n\n🚦 حداکثر تعداد چک هم‌زمان check-host (فعلی: {ch_max_inflight()}):\n"
+        + "همه سرورها با هم ارسال می‌شوند و بیش از این تعداد هم‌زمان در جریان نخواهد بود."
+    )
+    await _edit_menu(cb.message, msg, reply_markup=ch_inflight_kb())
+    try:
+        await cb.answer()
+    except Exception:
+        pass
+
+
+@dp.callback_query(F.data.startswith("ch_set_inflight:"))
+async def ch_set_inflight(cb: types.CallbackQuery):
+    if not await _owner_only_cb(cb):
+        return
+    v = max(1, min(32, int(cb.data.split(":")[1])))
+    await set_setting("ch_max_inflight", str(v))
+    await _edit_menu(cb.message, await _ch_menu_text(), parse_mode="Markdown", reply_markup=ch_menu_kb())
     try:
         await cb.answer("ثبت شد")
     except Exception:
@@ -1827,8 +2235,8 @@ async def ch_set_thr(cb: types.CallbackQuery):
     v = int(cb.data.split(":")[1])
     n = ch_nodes_count()
     v = max(1, min(n, v))
-    set_setting("ch_threshold", str(v))
-    await _edit_menu(cb.message, _ch_menu_text(), parse_mode="Markdown", reply_markup=ch_menu_kb())
+    await set_setting("ch_threshold", str(v))
+    await _edit_menu(cb.message, await _ch_menu_text(), parse_mode="Markdown", reply_markup=ch_menu_kb())
     try:
         await cb.answer("ثبت شد")
     except Exception:
@@ -1856,20 +2264,20 @@ async def ch_set_int(cb: types.CallbackQuery):
     
     if raw_val == "test":
         # حالت تست: مقدار را مستقیماً ذخیره می‌کنیم
-        set_setting("ch_interval_hours", "test")
-        ch_set_last_run_utc(0) # اجرای فوری
+        await set_setting("ch_interval_hours", "test")
+        await ch_set_last_run_utc(0) # اجرای فوری
         msg = "🧪 حالت تست (60 ثانیه) فعال شد."
     else:
         # حالت عادی: تبدیل به عدد
         v = int(raw_val)
         v = max(0, min(168, v))
-        set_setting("ch_interval_hours", str(v))
+        await set_setting("ch_interval_hours", str(v))
         if v > 0:
-            ch_set_last_run_utc(0) # اجرای فوری
+            await ch_set_last_run_utc(0) # اجرای فوری
         msg = "✅ تنظیمات زمان‌بندی آپدیت شد."
 
     # نمایش منوی اصلی بعد از تنظیم
-    await _edit_menu(cb.message, _ch_menu_text(), parse_mode="Markdown", reply_markup=ch_menu_kb())
+    await _edit_menu(cb.message, await _ch_menu_text(), parse_mode="Markdown", reply_markup=ch_menu_kb())
     
     try:
         await cb.answer(msg)
@@ -1893,8 +2301,8 @@ async def ch_set_fail(cb: types.CallbackQuery):
     if not await _owner_only_cb(cb):
         return
     v = int(cb.data.split(":")[1])
-    set_setting("ch_fail_confirm_checks", str(max(1, min(5, v))))
-    await _edit_menu(cb.message, _ch_menu_text(), parse_mode="Markdown", reply_markup=ch_menu_kb())
+    await set_setting("ch_fail_confirm_checks", str(max(1, min(5, v))))
+    await _edit_menu(cb.message, await _ch_menu_text(), parse_mode="Markdown", reply_markup=ch_menu_kb())
     try:
         await cb.answer("ثبت شد")
     except Exception:
@@ -1918,8 +2326,8 @@ async def ch_set_delay(cb: types.CallbackQuery):
     if not await _owner_only_cb(cb):
         return
     v = int(cb.data.split(":")[1])
-    set_setting("ch_retry_delay_sec", str(max(0, min(600, v))))
-    await _edit_menu(cb.message, _ch_menu_text(), parse_mode="Markdown", reply_markup=ch_menu_kb())
+    await set_setting("ch_retry_delay_sec", str(max(0, min(600, v))))
+    await _edit_menu(cb.message, await _ch_menu_text(), parse_mode="Markdown", reply_markup=ch_menu_kb())
     try:
         await cb.answer("ثبت شد")
     except Exception:
@@ -1942,8 +2350,8 @@ async def ch_set_ok(cb: types.CallbackQuery):
     if not await _owner_only_cb(cb):
         return
     v = int(cb.data.split(":")[1])
-    set_setting("ch_ok_confirm_checks", str(max(1, min(5, v))))
-    await _edit_menu(cb.message, _ch_menu_text(), parse_mode="Markdown", reply_markup=ch_menu_kb())
+    await set_setting("ch_ok_confirm_checks", str(max(1, min(5, v))))
+    await _edit_menu(cb.message, await _ch_menu_text(), parse_mode="Markdown", reply_markup=ch_menu_kb())
     try:
         await cb.answer("ثبت شد")
     except Exception:
@@ -1954,8 +2362,8 @@ async def ch_set_ok(cb: types.CallbackQuery):
 async def ch_toggle_silent(cb: types.CallbackQuery):
     if not await _owner_only_cb(cb):
         return
-    set_setting("ch_silent", "0" if ch_silent_mode() else "1")
-    await _edit_menu(cb.message, _ch_menu_text(), parse_mode="Markdown", reply_markup=ch_menu_kb())
+    await set_setting("ch_silent", "0" if ch_silent_mode() else "1")
+    await _edit_menu(cb.message, await _ch_menu_text(), parse_mode="Markdown", reply_markup=ch_menu_kb())
     try:
         await cb.answer()
     except Exception:
@@ -1966,8 +2374,8 @@ async def ch_toggle_silent(cb: types.CallbackQuery):
 async def ch_toggle_ok_notify(cb: types.CallbackQuery):
     if not await _owner_only_cb(cb):
         return
-    set_setting("ch_notify_ok", "0" if ch_notify_ok() else "1")
-    await _edit_menu(cb.message, _ch_menu_text(), parse_mode="Markdown", reply_markup=ch_menu_kb())
+    await set_setting("ch_notify_ok", "0" if ch_notify_ok() else "1")
+    await _edit_menu(cb.message, await _ch_menu_text(), parse_mode="Markdown", reply_markup=ch_menu_kb())
     try:
         await cb.answer()
     except Exception:
@@ -2038,8 +2446,8 @@ def _ch_format_report(
     block.append(sep)
     return "\n".join(block)
 
-def _ch_notify_targets() -> list[int]:
-    owner_id = get_owner_id()
+async def _ch_notify_targets() -> list[int]:
+    owner_id = await get_owner_id()
     chat_id = ch_get_notify_chat_id()
     targets: list[int] = []
     if owner_id:
@@ -2050,7 +2458,7 @@ def _ch_notify_targets() -> list[int]:
 
 
 async def _ch_send_notify(bot: Bot, text: str) -> bool:
-    for cid in _ch_notify_targets():
+    for cid in await _ch_notify_targets():
         try:
             await bot.send_message(cid, text, disable_web_page_preview=True)
             return True
@@ -2058,13 +2466,43 @@ async def _ch_send_notify(bot: Bot, text: str) -> bool:
             continue
     return False
 
-async def _ch_do_one(host: str, nodes: list[str]) -> tuple[int, int, str, list[str], Optional[str]]:
+_ch_gate: Optional[tuple[int, asyncio.Semaphore]] = None
+
+# Third check status next to OK/FAIL: check-host rate-limited us, result unknown.
+CH_THROTTLED = "THROTTLED"
+
+
+def _ch_status(ok_nodes: int, threshold: int, err: Optional[str]) -> str:
+    if err and err.startswith(CH_THROTTLED):
+        return CH_THROTTLED
+    return "OK" if ok_nodes >= threshold else "FAIL"
+
+
+def _ch_inflight() -> asyncio.Semaphore:
+    """Semaphore bounding check-host checks in flight (scheduled + manual runs)."""
+    global _ch_gate
+    n = ch_max_inflight()
+    if _ch_gate is None or _ch_gate[0] != n:
+        # Checks still holding the old one finish on it; new ones use the new limit.
+        _ch_gate = (n, asyncio.Semaphore(n))
+    return _ch_gate[1]
+
+
+async def _ch_do_one(
+    host: str, nodes: list[str], threshold: Optional[int] = None
+) -> tuple[int, int, str, list[str], Optional[str]]:
     """Run one check-host ping for selected nodes.
 
+    With `threshold`, returns as soon as the OK/FAIL verdict is settled.
+
     Returns: (ok_nodes, total_nodes, link, details_lines, err_text)
     """
     try:
-        res = await run_ping_check(host, nodes=nodes, max_wait_sec=90, poll_interval_sec=2.0)
+        async with _ch_inflight():
+            res = await run_ping_check(host, nodes=nodes, threshold=threshold, max_wait_sec=90)
+    except CheckHostThrottled as e:
+        # محدودیت API؛ وضعیت سرور نامشخص است نه FAIL
+        return (0, len(nodes), "", [f"⏳ محدودیت check-host: {e}"], f"{CH_THROTTLED}: {e}")
     except CheckHostError as e:
         return (0, len(nodes), "", [f"⚠️ خطا: {e}"], str(e))
     except Exception as e:
@@ -2076,60 +2514,231 @@ async def _ch_do_one(host: str, nodes: list[str]) -> tuple[int, int, str, list[s
 
     details = []
     for node in CH_IR_NODES:   # ← اینجا باید هم‌سطح با details باشه (۴ space)
+        node_name = CH_IR_NODE_LABELS.get(node, node)   # اسم شهر یا fallback به hostname
+        if node in res.pending_nodes:
+            # نتیجه قبل از تمام شدن این نود قطعی شد
+            details.append(f"⏳ {node_name}: -/{res.packets_per_node}")
+            continue
         okc = res.per_node_ok.get(node, 0)
         icon = "✅" if okc == res.packets_per_node else "⚠️"
-        node_name = CH_IR_NODE_LABELS.get(node, node)   # اسم شهر یا fallback به hostname
         details.append(f"{icon} {node_name}: {okc}/{res.packets_per_node}")
 
     return (ok_nodes, total, link, details, None)
 
 
-async def _ch_confirm_fail(host: str, nodes: list[str], threshold: int, checks: int, delay_s: int):
-    """
-    Confirm FAIL state by re-checking up to `checks` times.
-    Returns: (ok_nodes, total_nodes, link, details, status_now, checks_used)
-    status_now is "OK" if it recovered during confirmation, else "FAIL".
-    """
-    last_ok, last_total, last_link, last_details, last_err = 0, len(nodes), "", [], ""
-    checks = max(1, int(checks))
-    delay_s = max(0, int(delay_s))
-
-    for i in range(1, checks + 1):
-        ok_nodes, total_nodes, link, details, err = await _ch_do_one(host, nodes)
-        last_ok, last_total, last_link, last_details, last_err = ok_nodes, total_nodes, link, details, err or ""
-        status_now = "OK" if ok_nodes >= threshold else "FAIL"
-        if status_now == "OK":
-            return (ok_nodes, total_nodes, link, details, "OK", i)
-        if i < checks and delay_s > 0:
-            await asyncio.sleep(delay_s)
-
-    return (last_ok, last_total, last_link, last_details, "FAIL", checks)
-
-async def _ch_confirm_ok(host: str, nodes: list[str], threshold: int, checks: int, delay_s: int):
-    """
-    Confirm OK (recovery) by requiring `checks` consecutive OK results.
-    Returns: (ok_nodes, total_nodes, link, details, status_now, checks_used)
-    status_now is "OK" only if all confirmation checks are OK; otherwise "FAIL".
-    """
-    last_ok, last_total, last_link, last_details, last_err = 0, len(nodes), "", [], ""
-    checks = max(1, int(checks))
-    delay_s = max(0, int(delay_s))
-
-    for i in range(1, checks + 1):
-        ok_nodes, total_nodes, link, details, err = await _ch_do_one(host, nodes)
-        last_ok, last_total, last_link, last_details, last_err = ok_nodes, total_nodes, link, details, err or ""
-        status_now = "OK" if ok_nodes >= threshold else "FAIL"
-        if status_now != "OK":
-            # not recovered yet
-            return (ok_nodes, total_nodes, link, details, "FAIL", i)
-        if i < checks and delay_s > 0:
-            await asyncio.sleep(delay_s)
-
-    return (last_ok, last_total, last_link, last_details, "OK", checks)
-
-async def _ch_run_once_and_notify(bot: Bot, manual: bool = False) -> str:
+# ---- deferred confirm re-checks ----
+# A FAIL (or a recovery after FAIL) is confirmed by re-checks that run later
+# from _ch_confirm_job instead of sleeping inside the run. The progress
+# lives in checkhost_state (confirm_*), so other targets keep going, a
+# restart resumes pending confirmations, and each confirmation has a
+# deadline (the next scheduled run) it cannot outlast.
+_ch_confirm_wakeup = asyncio.Event()
+
+
+def _ch_confirm_delay(now: int, deadline: int, left: int) -> int:
+    # Spread the remaining checks so they all fit before the deadline.
+    return max(0, min(ch_retry_delay_sec(), (deadline - now) // max(1, left)))
+
+
+async def _ch_notify_verdict(
+    bot: Bot, name: str, host: str, status: str, auto_prev: str, threshold: int,
+    ok_nodes: int, total_nodes: int, link: str, details: list[str], checks_used: int,
+) -> None:
+    # ارسال اعلان در صورت تایید نهایی خرابی
+    if status == "FAIL":
+        report = _ch_format_report(
+            srv=name, host=host, ok_nodes=ok_nodes, total_nodes=total_nodes, 
+            threshold=threshold, link=link, details=details, status="FAIL",
+            confirmed_checks=checks_used
+        )
+    # ارسال اعلان رفع خرابی
+    elif auto_prev == "FAIL" and status == "OK":
+        report = _ch_format_report(
+            srv=name, host=host, ok_nodes=ok_nodes, total_nodes=total_nodes, 
+            threshold=threshold, link=link, details=details, status="OK",
+            ok_confirmed_checks=checks_used
+        )
+    else:
+        return
+    try:
+        await bot.send_message(chat_id=OWNER, text=report)
+    except:
+        pass
+
+
+async def _ch_finish(
+    bot: Bot, sid: int, name: str, host: str, status: str, threshold: int,
+    ok_nodes: int, total_nodes: int, link: str, details: list[str], checks_used: int,
+) -> None:
+    """Settle the auto status of a server and send the alert, if any."""
+    auto_prev = await ch_get_auto_status(sid)
+    await ch_clear_confirm(sid)
+    await ch_set_auto_status(sid, status)
+    await _ch_notify_verdict(
+        bot, name, host, status, auto_prev, threshold, ok_nodes, total_nodes, link, details, checks_used
+    )
+
+
+async def _ch_confirm_step(bot: Bot, row: dict) -> None:
+    """Run one due re-check of a pending confirmation."""
+    sid = int(row["server_id"])
+    kind = row["confirm_kind"]
+    done, left = int(row["confirm_done"]), int(row["confirm_left"])
+    deadline = int(row["confirm_deadline"] or 0)
+
+    srv = await ADB.fetchone("SELECT name, host FROM servers WHERE id=?", (sid,))
+    if not srv or sid not in await ch_get_targets():
+        await ch_clear_confirm(sid)
+        return
+    name, host = srv["name"], srv["host"]
+    nodes = ch_nodes_list()
+    threshold = min(ch_threshold(), len(nodes)) if nodes else 0
+
+    ok_nodes, total_nodes, link, details, err = await _ch_do_one(host, nodes, threshold)
+    status = _ch_status(ok_nodes, threshold, err)
+
+    cur = await ch_get_confirm(sid)
+    if not cur or cur["confirm_kind"] != kind or int(cur["confirm_deadline"] or 0) != deadline:
+        # A newer scheduled run replaced this confirmation meanwhile.
+        return
+
+    now = int(time.time())
+    if status == CH_THROTTLED:
+        # Unknown result: retry later without using up a check.
+        pass
+    elif status != kind:
+        # FAIL confirm saw OK (recovered) / OK confirm saw FAIL (not recovered).
+        await _ch_finish(bot, sid, name, host, status, threshold, ok_nodes, total_nodes, link, details, done + 1)
+        return
+    else:
+        done, left = done + 1, left - 1
+        if left <= 0:
+            await _ch_finish(bot, sid, name, host, kind, threshold, ok_nodes, total_nodes, link, details, done)
+            return
+
+    if now >= deadline:
+        # Out of time: settle with what every check so far agreed on.
+        await _ch_finish(bot, sid, name, host, kind, threshold, ok_nodes, total_nodes, link, details, done)
+        return
+    await ch_schedule_confirm(sid, kind, done, left, now + _ch_confirm_delay(now, deadline, left), deadline)
+
+
+async def _ch_confirm_run(bot: Bot, row: dict) -> None:
+    """_ch_confirm_step as a task: log failures and put the re-check back on the queue."""
+    sid = int(row["server_id"])
+    try:
+        await _ch_confirm_step(bot, row)
+    except Exception as e:
+        print(f"--- [CheckHost Confirm Error] server {sid}: {e} ---")
+        try:
+            # The row was claimed (confirm_due=NULL); give it a due time again.
+            await ADB.execute(
+                "UPDATE checkhost_state SET confirm_due=? "
+                "WHERE server_id=? AND confirm_kind IS NOT NULL AND confirm_due IS NULL",
+                (int(time.time()) + max(60, ch_retry_delay_sec()), sid),
+            )
+            _ch_confirm_wakeup.set()
+        except Exception as e2:
+            print(f"--- [CheckHost Confirm Error] server {sid}: reschedule failed: {e2} ---")
+
+
+async def _ch_confirm_job(bot: Bot):
+    """Timer queue: runs confirm re-checks from checkhost_state when they are due."""
+    running: dict[int, asyncio.Task] = {}
+    # Re-checks claimed before a restart (confirm_due cleared) are due now.
+    await ADB.execute(
+        "UPDATE checkhost_state SET confirm_due=? WHERE confirm_kind IS NOT NULL AND confirm_due IS NULL",
+        (int(time.time()),),
+    )
+    while True:
+        _ch_confirm_wakeup.clear()
+        wait = 300.0
+        try:
+            rows = await ADB.fetchall(
+                "SELECT server_id, confirm_kind, confirm_done, confirm_left, confirm_deadline "
+                "FROM checkhost_state WHERE confirm_due <= ?",
+                (int(time.time()),),
+            )
+            for r in rows:
+                sid = int(r["server_id"])
+                if sid in running:
+                    continue
+                # Claim it so the next pass does not start it twice.
+                await ADB.execute("UPDATE checkhost_state SET confirm_due=NULL WHERE server_id=?", (sid,))
+                task = asyncio.create_task(_ch_confirm_run(bot, dict(r)))
+                running[sid] = task
+                task.add_done_callback(lambda t, sid=sid: running.pop(sid, None))
+            nxt = await ADB.fetchone("SELECT MIN(confirm_due) FROM checkhost_state")
+            if nxt and nxt[0] is not None:
+                wait = min(wait, max(1.0, float(nxt[0]) - time.time()))
+        except Exception as e:
+            print(f"--- [CheckHost Confirm Error] {e} ---")
+        try:
+            await asyncio.wait_for(_ch_confirm_wakeup.wait(), timeout=wait)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def _ch_start_confirm(
+    bot: Bot, sid: int, name: str, host: str, kind: str, checks: int, deadline: int, threshold: int,
+    ok_nodes: int, total_nodes: int, link: str, details: list[str],
+) -> None:
+    """First check gave `kind`; settle now or queue the remaining re-checks."""
+    left = max(1, int(checks)) - 1
+    now = int(time.time())
+    if left <= 0 or now >= deadline:
+        await _ch_finish(bot, sid, name, host, kind, threshold, ok_nodes, total_nodes, link, details, 1)
+        return
+    await ch_schedule_confirm(sid, kind, 1, left, now + _ch_confirm_delay(now, deadline, left), deadline)
+
+
+async def _ch_process_target(
+    bot: Bot, sid: int, name: str, host: str, nodes: list[str], threshold: int, manual: bool, deadline: int
+) -> Optional[str]:
+    """Check one target, record it and notify; returns the report line for manual runs."""
+    # انجام عملیات پایش از نودها
+    ok_nodes, total_nodes, link, details, err = await _ch_do_one(host, nodes, threshold)
+    status_now = _ch_status(ok_nodes, threshold, err)
+    
+    # ثبت تاریخچه در دیتابیس (THROTTLED وضعیت قبلی را تغییر نمی‌دهد)
+    if status_now != CH_THROTTLED:
+        await ch_set_last_status(sid, status_now)
+    await ch_add_history(sid, host, ok_nodes, total_nodes, status_now, link, details, err or "")
+
+    # --- بخش ارسال اعلان اتوماتیک (فقط در اجرای زمان‌بندی شده) ---
+    if not manual and status_now != CH_THROTTLED:
+        auto_prev = await ch_get_auto_status(sid)
+        
+        # تایید خطا / رفع خطا با چک‌های بعدی انجام می‌شود (_ch_confirm_job)
+        # تا بقیه سرورها منتظر تاخیر بین تکرارها نمانند.
+        if status_now == "FAIL":
+            kind, checks = "FAIL", ch_fail_confirm_checks()
+        elif auto_prev == "FAIL":
+            kind, checks = "OK", ch_ok_confirm_checks()
+        else:
+            kind, checks = None, 0
+        if kind:
+            await _ch_start_confirm(
+                bot, sid, name, host, kind, checks, deadline, threshold,
+                ok_nodes, total_nodes, link, details,
+            )
+        else:
+            await ch_clear_confirm(sid)
+            await ch_set_auto_status(sid, status_now)
+
+    # ساخت گزارش برای پاسخ به دکمه دستی تلگرام
+    if manual:
+        status_text = {"OK": "✅ OK", CH_THROTTLED: "⏳ محدودیت API (نامشخص)"}.get(status_now, "❌ FAIL")
+        return _ch_format_report(
+            srv=name, host=host, ok_nodes=ok_nodes, total_nodes=total_nodes, 
+            threshold=threshold, link=link, details=details, status_line=status_text
+        )
+    return None
+
+
+async def _ch_run_once_and_notify(bot: Bot, manual: bool = False, interval_sec: int = 3600) -> str:
     # ۱. گرفتن تمام آیدی‌ها بدون قید و شرط
-    targets = ch_get_targets() 
+    targets = await ch_get_targets() 
     
     if not targets:
         return "No Targets Found"
@@ -2139,82 +2748,38 @@ async def _ch_run_once_and_notify(bot: Bot, manual: bool = False) -> str:
 
     nodes = ch_nodes_list()
     threshold = min(ch_threshold(), len(nodes)) if nodes else 0
-    lines: list[str] = []
-    
-    for sid in targets:
-        # استخراج اطلاعات سرور از دیتابیس
-        conn = db()
-        cur = conn.cursor()
-        cur.execute("SELECT name, host FROM servers WHERE id=?", (sid,))
-        srv_info = cur.fetchone()
-        conn.close()
-        
-        if not srv_info:
-            continue
-
-        name, host = srv_info["name"], srv_info["host"]
+    # Confirm re-checks must be settled before the next scheduled run.
+    deadline = int(time.time()) + max(60, int(interval_sec))
+    marks = ",".join("?" * len(targets))
+    servers = await ADB.fetchall(
+        f"SELECT id, name, host FROM servers WHERE id IN ({marks}) ORDER BY id", tuple(targets)
+    )
 
-        # انجام عملیات پایش از نودها
-        ok_nodes, total_nodes, link, details, err = await _ch_do_one(host, nodes)
-        status_now = "OK" if ok_nodes >= threshold else "FAIL"
-        
-        # ثبت تاریخچه در دیتابیس
-        ch_set_last_status(sid, status_now)
-        ch_add_history(sid, host, ok_nodes, total_nodes, status_now, link, details, err or "")
+    # همه سرورها هم‌زمان بررسی می‌شوند (محدودیت هم‌زمانی در _ch_do_one)
+    # و نتیجه/اعلان هر سرور به محض تمام شدن پردازش می‌شود.
+    async def one(srv) -> tuple[int, Optional[str]]:
+        sid = int(srv["id"])
+        try:
+            return sid, await _ch_process_target(
+                bot, sid, srv["name"], srv["host"], nodes, threshold, manual, deadline
+            )
+        except Exception as e:
+            print(f"--- [CheckHost Error] server {sid}: {e} ---")
+            return sid, None
 
-        # --- بخش ارسال اعلان اتوماتیک (فقط در اجرای زمان‌بندی شده) ---
-        if not manual:
-            auto_prev = ch_get_auto_status(sid)
-            
-            # --- شروع منطق تایید خطا (تکرار و تاخیر) ---
-            confirmed_checks = 1
-            if status_now == "FAIL":
-                # دریافت مقادیر تنظیم شده توسط شما در پنل مدیریت
-                fail_checks = ch_fail_confirm_checks() 
-                retry_delay = ch_retry_delay_sec()    
-                
-                # بررسی مجدد: اگر خطا موقتی باشد، اینجا فیلتر می‌شود
-                ok_nodes, total_nodes, link, details, status_now, confirmed_checks = await _ch_confirm_fail(
-                    host, nodes, threshold, checks=fail_checks, delay_s=retry_delay
-                )
-
-            # ثبت وضعیت نهایی در دیتابیس (پس از تایید تکرارها)
-            ch_set_auto_status(sid, status_now)
-            
-            # ارسال اعلان در صورت تایید نهایی خرابی
-            if status_now == "FAIL":
-                report = _ch_format_report(
-                    srv=name, host=host, ok_nodes=ok_nodes, total_nodes=total_nodes, 
-                    threshold=threshold, link=link, details=details, status="FAIL",
-                    confirmed_checks=confirmed_checks
-                )
-                try:
-                    await bot.send_message(chat_id=OWNER, text=report)
-                except:
-                    pass
-            
-            # ارسال اعلان رفع خرابی
-            elif auto_prev == "FAIL" and status_now == "OK":
-                report = _ch_format_report(
-                    srv=name, host=host, ok_nodes=ok_nodes, total_nodes=total_nodes, 
-                    threshold=threshold, link=link, details=details, status="OK"
-                )
-                try:
-                    await bot.send_message(chat_id=OWNER, text=report)
-                except:
-                    pass
-
-        # ساخت گزارش تجمیعی برای پاسخ به دکمه دستی تلگرام
-        if manual:
-            status_text = "✅ OK" if status_now == "OK" else "❌ FAIL"
-            lines.append(_ch_format_report(
-                srv=name, host=host, ok_nodes=ok_nodes, total_nodes=total_nodes, 
-                threshold=threshold, link=link, details=details, status_line=status_text
-            ))
-            lines.append("──────────────────────────────")
+    reports: dict[int, str] = {}
+    for fut in asyncio.as_completed([one(srv) for srv in servers]):
+        sid, report = await fut
+        if report:
+            reports[sid] = report
 
     # خروجی نهایی
     if manual:
+        lines: list[str] = []
+        for srv in servers:
+            if int(srv["id"]) in reports:
+                lines.append(reports[int(srv["id"])])
+                lines.append("──────────────────────────────")
         hdr = BOT_HEADER + "\n\n🌐 پایش ایران (check-host.net)\n\n✅ اجرای دستی"
         return hdr + "\n\n" + "\n".join(lines)
     
@@ -2225,6 +2790,8 @@ async def checkhost_job(bot: Bot):
     زمان‌بندی پایش مطابق با دکمه‌های پنل مدیریت.
     """
     while True:
+        seen = SETTINGS.version
+        wait: Optional[float] = 10.0
         try:
             now = int(time.time())
             
@@ -2236,15 +2803,15 @@ async def checkhost_job(bot: Bot):
                 interval_seconds = 60  # حالت تست: ۶۰ ثانیه
                 display_time = "60 Seconds (Test Mode)"
             elif interval_val == "0":
-                # اگر غیرفعال بود، ۱۰ ثانیه صبر کن و دوباره چک کن (تا اگر کاربر تغییر داد متوجه شویم)
-                await asyncio.sleep(10)
+                # اگر غیرفعال بود، تا تغییر تنظیمات توسط کاربر منتظر می‌مانیم
+                await SETTINGS.wait_changed(seen)
                 continue
             else:
                 # تبدیل ساعت به ثانیه
                 try:
                     interval_hours = int(interval_val)
                     if interval_hours <= 0:
-                        await asyncio.sleep(10)
+                        await SETTINGS.wait_changed(seen)
                         continue
                     interval_seconds = interval_hours * 3600
                     display_time = f"{interval_hours} Hour(s)"
@@ -2262,31 +2829,32 @@ async def checkhost_job(bot: Bot):
                 print(f"--- [Scheduler] Triggering: {display_time} ---")
                 
                 # بروزرسانی زمان اجرا
-                set_setting("ch_last_run_time", str(now))
+                await set_setting("ch_last_run_time", str(now))
                 
                 # اجرای تابع پایش اصلی
-                await _ch_run_once_and_notify(bot)
+                await _ch_run_once_and_notify(bot, interval_sec=interval_seconds)
+                wait = float(interval_seconds)
+            else:
+                wait = float(interval_seconds - (now - last))
                 
         except Exception as e:
             print(f"--- [Scheduler Error] {e} ---")
 
-        # چک کردن وضعیت تنظیمات هر ۱۰ ثانیه
-        await asyncio.sleep(10)
+        # تا نوبت بعدی یا تغییر تنظیمات (بازه جدید فوراً اعمال می‌شود)
+        await SETTINGS.wait_changed(seen, max(1.0, wait))
 
 @dp.callback_query(F.data == "ch_history")
 async def ch_history(cb: types.CallbackQuery):
     if not await _owner_only_cb(cb):
         return
-    _ensure_checkhost_tables()
-    conn = db()
-    cur = conn.cursor()
-    cur.execute(
+    rows = await ADB.read(lambda c: CH_HISTORY.newest_first(
+        c,
         "SELECT h.ts, s.name, h.host, h.ok_nodes, h.total_nodes, h.status "
-        "FROM checkhost_history h LEFT JOIN servers s ON s.id=h.server_id "
-        "ORDER BY h.id DESC LIMIT 20"
-    )
-    rows = cur.fetchall()
-    conn.close()
+        "FROM {t} h LEFT JOIN servers s ON s.id=h.server_id "
+        "ORDER BY h.id DESC LIMIT ?",
+        (),
+        20,
+    ))
 
     if not rows:
         await _edit_menu(cb.message, BOT_HEADER + "\n\n📜 تاریخچه پایش\n\nخالی است.", reply_markup=InlineKeyboardMarkup(
@@ -2300,9 +2868,9 @@ async def ch_history(cb: types.CallbackQuery):
 
     lines = []
     for r in rows:
-        ts = to_tehran(r["ts"])  # stored as UTC by sqlite
+        ts = to_tehran(r["ts"])  # epoch seconds (UTC)
         name = r["name"] or "(deleted)"
-        icon = "✅" if r["status"] == "OK" else "❌"
+        icon = {"OK": "✅", CH_THROTTLED: "⏳"}.get(r["status"], "❌")
         lines.append(f"{icon} {ts} | {name} | {r['ok_nodes']}/{r['total_nodes']}")
 
     msg = BOT_HEADER + "\n\n📜 تاریخچه پایش (آخرین ۲۰ مورد)\n\n" + "\n".join(lines)
@@ -2320,7 +2888,7 @@ async def ch_run_now(cb: types.CallbackQuery):
     if not await _owner_only_cb(cb):
         return
 
-    ch_set_notify_chat_id(cb.message.chat.id)
+    await ch_set_notify_chat_id(cb.message.chat.id)
     # ACK quickly (avoid callback timeout)
     try:
         await cb.answer("⏳ در حال اجرا ...")
@@ -2343,6 +2911,38 @@ async def bot_settings_menu(cb: types.CallbackQuery):
                      reply_markup=settings_kb())
     await cb.answer()
 
+@dp.callback_query(F.data == "toggle_probe_mode")
+async def toggle_probe_mode(cb: types.CallbackQuery):
+    if get_role(cb.from_user.id) != "owner":
+        return await cb.answer("دسترسی محدود!")
+    await set_setting("probe_mode", "tcp" if get_probe_mode() == "icmp" else "icmp")
+    await _edit_menu(cb.message, BOT_HEADER + "\n\n⚙️ **تنظیمات مدیریتی ربات:**\nیکی از موارد زیر را انتخاب کنید:",
+                     reply_markup=settings_kb())
+    await cb.answer("ثبت شد")
+
+@dp.callback_query(F.data == "alert_digest")
+async def alert_digest_menu(cb: types.CallbackQuery):
+    if get_role(cb.from_user.id) != "owner":
+        return await cb.answer("دسترسی محدود!")
+    await _edit_menu(
+        cb.message,
+        BOT_HEADER + "\n\n📣 **خلاصه هشدارها**\n"
+        "تغییر وضعیت چند سرور در این پنجره در یک پیام ارسال می‌شود.\n"
+        f"وضعیت فعلی: {digest_label(get_alert_digest_window())}",
+        reply_markup=digest_kb(),
+    )
+    await cb.answer()
+
+@dp.callback_query(F.data.startswith("set_digest:"))
+async def set_alert_digest(cb: types.CallbackQuery):
+    if get_role(cb.from_user.id) != "owner":
+        return await cb.answer("دسترسی محدود!")
+    v = int(cb.data.split(":")[1])
+    await set_setting("alert_digest_window", str(max(-1, min(300, v))))
+    await _edit_menu(cb.message, BOT_HEADER + "\n\n⚙️ **تنظیمات مدیریتی ربات:**\nیکی از موارد زیر را انتخاب کنید:",
+                     reply_markup=settings_kb())
+    await cb.answer("ثبت شد")
+
 # ۱. هندلر درخواست عدد (ویرایش صفحه فعلی به جای ارسال پیام جدید)
 @dp.callback_query(F.data == "set_ping_int")
 async def ask_ping_interval(cb: types.CallbackQuery, state: FSMContext):
@@ -2378,7 +2978,7 @@ async def save_ping_interval(m: types.Message, state: FSMContext):
         await m.delete()
         return
         
-    set_setting("ping_interval", str(val)) # ذخیره در دیتابیس
+    await set_setting("ping_interval", str(val)) # ذخیره در دیتابیس
     
     # گرفتن اطلاعات ذخیره شده در استیت
     data = await state.get_data()
@@ -2406,10 +3006,17 @@ async def save_ping_interval(m: types.Message, state: FSMContext):
 # ---------------- Main ----------------
 async def main():
     # Optional: enable daily cleanup
+    asyncio.create_task(WRITER.run())
+    asyncio.create_task(OUTBOX_SENDER.run(bot))
     asyncio.create_task(cleanup_logs_job())
+    asyncio.create_task(ROLLUPS.run())
     asyncio.create_task(monitor_loop(bot))
     asyncio.create_task(checkhost_job(bot))
-    await dp.start_polling(bot)
+    asyncio.create_task(_ch_confirm_job(bot))
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await CHECKHOST.close()
 
 
 if __name__ == "__main__":
@@ -14,21 +14,204 @@ JSON notes (ping):
       ["TIMEOUT", 3.005]
 
 We treat a node as "4/4" only if all 4 attempts are "OK".
+
+All requests go through one long-lived `CHECKHOST` client: a pooled
+keep-alive connector with DNS caching, so a check (and every poll and
+confirm retry after it) reuses the same TLS connection to check-host.net
+instead of a fresh resolve + handshake per request. Every request also
+takes a token from one shared bucket; 429 / Retry-After responses pause
+the bucket for everyone and surface as `CheckHostThrottled`, never as a
+0/N result.
 """
 
 from __future__ import annotations
 
 import asyncio
-from dataclasses import dataclass
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
 from typing import Any, Dict, List, Optional, Tuple
 
 import aiohttp
 
+from utils.ratelimit import TokenBucket
+
+
+API_BASE = "https://check-host.net"
+HEADERS = {
+    "Accept": "application/json",
+    "User-Agent": "ServerSystemGuardBot/1.0 (+https://t.me/)"
+}
+
+
+# check-host "ping" sends 4 packets per node.
+PACKETS = 4
+
+# Result polling: the first poll waits for a 4-ping round to finish, then
+# stays at MIN_POLL_SEC while nodes keep reporting and backs off (x1.5, up
+# to MAX_POLL_SEC) while nothing changes.
+FIRST_POLL_SEC = 3.0
+MIN_POLL_SEC = 1.0
+MAX_POLL_SEC = 6.0
+POLL_BACKOFF = 1.5
+
+# check-host.net does not publish its limits; stay well below what it
+# tolerates and let Retry-After correct us.
+RATE_PER_SEC = 1.0
+BURST = 10
+DEFAULT_RETRY_AFTER_SEC = 30.0
+MAX_RETRY_AFTER_SEC = 300.0
+
 
 class CheckHostError(Exception):
     pass
 
 
+class CheckHostThrottled(CheckHostError):
+    """check-host.net rate-limited us (HTTP 429 / Retry-After)."""
+
+    def __init__(self, msg: str, retry_after: float = 0.0) -> None:
+        super().__init__(msg)
+        self.retry_after = retry_after
+
+
+def _retry_after(value: Optional[str]) -> float:
+    # Retry-After is either delta-seconds or an HTTP date.
+    sec = DEFAULT_RETRY_AFTER_SEC
+    if value:
+        try:
+            sec = float(value)
+        except ValueError:
+            try:
+                sec = parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                pass
+    return max(1.0, min(MAX_RETRY_AFTER_SEC, sec))
+
+
+class CheckHostClient:
+    """Shared aiohttp session for check-host.net, created on first use."""
+
+    def __init__(
+        self,
+        pool_size: int = 8,
+        keepalive_sec: float = 60.0,
+        dns_ttl_sec: int = 300,
+        rate: float = RATE_PER_SEC,
+        burst: float = BURST,
+    ) -> None:
+        self.pool_size = pool_size
+        self.keepalive_sec = keepalive_sec
+        self.dns_ttl_sec = dns_ttl_sec
+        self._session: Optional[aiohttp.ClientSession] = None
+        # Shared by every check, poll and confirm retry.
+        self.bucket = TokenBucket(rate, burst)
+        self._recent: deque = deque()  # monotonic stamps of requests, last 60s
+        self.throttled = 0  # 429 / Retry-After responses
+        self.limiter_wait_sec = 0.0
+        # Counters (since start) to see handshakes being amortized.
+        self.requests = 0
+        self.conn_new = 0
+        self.conn_reused = 0
+        self.dns_hits = 0
+        self.dns_misses = 0
+        self.checks = 0
+        self.polls = 0
+        self.early = 0  # checks decided before every node finished
+
+    def _trace(self) -> aiohttp.TraceConfig:
+        tc = aiohttp.TraceConfig()
+
+        async def on_request_start(session, ctx, params):
+            self.requests += 1
+
+        async def on_conn_create(session, ctx, params):
+            self.conn_new += 1
+
+        async def on_conn_reuse(session, ctx, params):
+            self.conn_reused += 1
+
+        async def on_dns_hit(session, ctx, params):
+            self.dns_hits += 1
+
+        async def on_dns_miss(session, ctx, params):
+            self.dns_misses += 1
+
+        tc.on_request_start.append(on_request_start)
+        tc.on_connection_create_end.append(on_conn_create)
+        tc.on_connection_reuseconn.append(on_conn_reuse)
+        tc.on_dns_cache_hit.append(on_dns_hit)
+        tc.on_dns_cache_miss.append(on_dns_miss)
+        return tc
+
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                keepalive_timeout=self.keepalive_sec,
+                ttl_dns_cache=self.dns_ttl_sec,
+                use_dns_cache=True,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers=HEADERS,
+                trace_configs=[self._trace()],
+            )
+        return self._session
+
+    async def get_json(self, what: str, url: str, *, params=None, timeout=None) -> Any:
+        """GET through the rate limiter; raises CheckHostThrottled on 429."""
+        t0 = time.monotonic()
+        await self.bucket.acquire()
+        now = time.monotonic()
+        self.limiter_wait_sec += now - t0
+        self._recent.append(now)
+        async with self.session().get(url, params=params, timeout=timeout) as resp:
+            if resp.status == 429 or (resp.status == 503 and "Retry-After" in resp.headers):
+                ra = _retry_after(resp.headers.get("Retry-After"))
+                self.throttled += 1
+                self.bucket.pause(ra)
+                raise CheckHostThrottled(f"{what} throttled (HTTP {resp.status}), retry after {ra:.0f}s", ra)
+            if resp.status != 200:
+                txt = await resp.text()
+                raise CheckHostError(f"{what} HTTP {resp.status}: {txt[:200]}")
+            return await resp.json()
+
+    def requests_last_min(self) -> int:
+        cutoff = time.monotonic() - 60.0
+        while self._recent and self._recent[0] < cutoff:
+            self._recent.popleft()
+        return len(self._recent)
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "conn_new": self.conn_new,
+            "conn_reused": self.conn_reused,
+            "dns_hits": self.dns_hits,
+            "dns_misses": self.dns_misses,
+            "tokens": self.bucket.available,
+            "capacity": self.bucket.capacity,
+            "rate": self.bucket.rate,
+            "paused_for": self.bucket.paused_for,
+            "req_last_min": self.requests_last_min(),
+            "throttled": self.throttled,
+            "limiter_wait_sec": self.limiter_wait_sec,
+            "checks": self.checks,
+            "polls": self.polls,
+            "early": self.early,
+        }
+
+
+CHECKHOST = CheckHostClient()
+
+
 @dataclass
 class PingCheckResult:
     request_id: str
@@ -36,6 +219,9 @@ class PingCheckResult:
     total_nodes: int
     ok_nodes: int
     per_node_ok_counts: Dict[str, int]  # node -> ok_count (0..4)
+    # Nodes still running when the verdict was settled early.
+    pending_nodes: List[str] = field(default_factory=list)
+    polls: int = 0
 
     # --- Backward-compatible aliases ---
     # Earlier iterations of this project referenced different attribute names.
@@ -50,8 +236,19 @@ class PingCheckResult:
 
     @property
     def packets_per_node(self) -> int:
-        # check-host "ping" endpoint performs 4 ping attempts per node.
-        return 4
+        return PACKETS
+
+
+def _verdict(finished: Dict[str, int], total: int, threshold: Optional[int]) -> Optional[str]:
+    """The verdict ("OK"/"FAIL") once pending nodes can no longer change it, else None."""
+    if threshold is None:
+        return None
+    ok = sum(1 for v in finished.values() if v == PACKETS)
+    if ok >= threshold:
+        return "OK"
+    if ok + (total - len(finished)) < threshold:
+        return "FAIL"
+    return None
 
 
 def _extract_ok_count(node_payload: Any) -> Optional[int]:
@@ -89,11 +286,20 @@ async def run_ping_check(
     host: str,
     nodes: List[str],
     *,
+    threshold: Optional[int] = None,
     max_wait_sec: int = 60,
-    poll_interval_sec: float = 2.0,
+    first_poll_sec: float = FIRST_POLL_SEC,
+    poll_interval_sec: float = MIN_POLL_SEC,
+    max_poll_interval_sec: float = MAX_POLL_SEC,
     request_timeout_sec: int = 30,
 ) -> PingCheckResult:
-    """Run a ping check against a given set of nodes and wait until results are ready."""
+    """Run a ping check against a given set of nodes and wait for the results.
+
+    Without `threshold` this waits until every node has finished. With it
+    (OK means at least `threshold` nodes at 4/4), it returns as soon as the
+    verdict can no longer change. Nodes still running are then listed in
+    `pending_nodes` and left out of `per_node_ok_counts`.
+    """
 
     if not host or not isinstance(host, str):
         raise CheckHostError("host is empty")
@@ -101,87 +307,99 @@ async def run_ping_check(
     if not nodes:
         raise CheckHostError("nodes list is empty")
 
-    headers = {
-        "Accept": "application/json",
-        "User-Agent": "ServerSystemGuardBot/1.0 (+https://t.me/)"
-    }
-
     timeout = aiohttp.ClientTimeout(total=request_timeout_sec)
-
-    async with aiohttp.ClientSession(timeout=timeout, headers=headers) as session:
-        # Create check request
-        params = [("host", host)]
-        for n in nodes:
-            params.append(("node", n))
-
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max_wait_sec
+
+    # Create check request
+    params = [("host", host)]
+    for n in nodes:
+        params.append(("node", n))
+
+    while True:
+        # A pause (from any check's 429) running past the deadline: fail now instead of waiting it out.
+        paused = CHECKHOST.bucket.paused_for
+        if paused >= deadline - loop.time():
+            raise CheckHostThrottled(f"check-ping throttled, retry after {paused:.0f}s", paused)
         try:
-            async with session.get("https://check-host.net/check-ping", params=params) as resp:
-                if resp.status != 200:
-                    txt = await resp.text()
-                    raise CheckHostError(f"check-ping HTTP {resp.status}: {txt[:200]}")
-                data = await resp.json()
+            data = await CHECKHOST.get_json("check-ping", f"{API_BASE}/check-ping", params=params, timeout=timeout)
+            break
+        except CheckHostThrottled as e:
+            # The bucket is paused for retry_after; wait it out if the deadline allows.
+            if loop.time() + e.retry_after >= deadline:
+                raise
         except asyncio.TimeoutError as e:
             raise CheckHostError("check-ping timeout") from e
         except aiohttp.ClientError as e:
             raise CheckHostError(f"check-ping network error: {e}") from e
 
-        request_id = data.get("request_id")
-        report_url = data.get("permanent_link") or ""
-        if not request_id:
-            raise CheckHostError(f"invalid response from check-host: {data}")
-
-        # Poll results
-        deadline = asyncio.get_event_loop().time() + max_wait_sec
-        last_payload = None
-        while True:
-            try:
-                async with session.get(f"https://check-host.net/check-result/{request_id}") as resp:
-                    if resp.status != 200:
-                        txt = await resp.text()
-                        raise CheckHostError(f"check-result HTTP {resp.status}: {txt[:200]}")
-                    payload = await resp.json()
-                    last_payload = payload
-            except asyncio.TimeoutError:
-                payload = last_payload
-            except aiohttp.ClientError:
-                payload = last_payload
-
-            if isinstance(payload, dict):
-                done = True
-                per_node_ok: Dict[str, int] = {}
-                for n in nodes:
-                    okc = _extract_ok_count(payload.get(n))
-                    if okc is None:
-                        done = False
-                        break
-                    per_node_ok[n] = int(okc)
-                if done:
-                    ok_nodes = sum(1 for v in per_node_ok.values() if v == 4)
-                    return PingCheckResult(
-                        request_id=str(request_id),
-                        report_url=str(report_url),
-                        total_nodes=len(nodes),
-                        ok_nodes=int(ok_nodes),
-                        per_node_ok_counts=per_node_ok,
-                    )
-
-            if asyncio.get_event_loop().time() >= deadline:
-                # Timeout waiting. Treat missing nodes as 0/4.
-                per_node_ok = {}
-                if isinstance(last_payload, dict):
-                    for n in nodes:
-                        okc = _extract_ok_count(last_payload.get(n))
-                        per_node_ok[n] = int(okc or 0)
-                else:
-                    for n in nodes:
-                        per_node_ok[n] = 0
-                ok_nodes = sum(1 for v in per_node_ok.values() if v == 4)
-                return PingCheckResult(
-                    request_id=str(request_id),
-                    report_url=str(report_url),
-                    total_nodes=len(nodes),
-                    ok_nodes=int(ok_nodes),
-                    per_node_ok_counts=per_node_ok,
+    request_id = data.get("request_id")
+    report_url = data.get("permanent_link") or ""
+    if not request_id:
+        raise CheckHostError(f"invalid response from check-host: {data}")
+
+    # Poll results
+    deadline = max(deadline, loop.time() + first_poll_sec)
+    delay = first_poll_sec
+    polls = 0
+    throttled: Optional[CheckHostThrottled] = None
+    finished: Dict[str, int] = {}
+    while True:
+        await asyncio.sleep(max(0.0, min(delay, deadline - loop.time())))
+        polls += 1
+        payload = None
+        try:
+            if CHECKHOST.bucket.paused_for < deadline - loop.time():
+                payload = await CHECKHOST.get_json(
+                    "check-result", f"{API_BASE}/check-result/{request_id}", timeout=timeout
                 )
-
-            await asyncio.sleep(poll_interval_sec)
+        except CheckHostThrottled as e:
+            throttled = e
+        except asyncio.TimeoutError:
+            pass
+        except aiohttp.ClientError:
+            pass
+
+        progressed = False
+        if isinstance(payload, dict):
+            for n in nodes:
+                if n in finished:
+                    continue
+                okc = _extract_ok_count(payload.get(n))
+                if okc is not None:
+                    finished[n] = int(okc)
+                    progressed = True
+
+        verdict = _verdict(finished, len(nodes), threshold)
+        # A pause (from any check's 429) running past the deadline ends polling too.
+        paused = CHECKHOST.bucket.paused_for
+        timed_out = loop.time() >= deadline or paused >= deadline - loop.time()
+        if timed_out and verdict is None and len(finished) < len(nodes) and (throttled or paused):
+            # Unfinished because we were rate-limited, not because nodes failed.
+            ra = max(paused, throttled.retry_after if throttled else 0.0)
+            raise CheckHostThrottled(
+                f"check-result throttled, retry after {ra:.0f}s ({len(finished)}/{len(nodes)} nodes reported)", ra
+            )
+        if len(finished) == len(nodes) or verdict is not None or timed_out:
+            pending = [n for n in nodes if n not in finished]
+            if timed_out and len(finished) < len(nodes) and verdict is None:
+                # Timeout waiting. Treat missing nodes as 0/4.
+                for n in pending:
+                    finished[n] = 0
+                pending = []
+            CHECKHOST.checks += 1
+            CHECKHOST.polls += polls
+            if pending:
+                CHECKHOST.early += 1
+            return PingCheckResult(
+                request_id=str(request_id),
+                report_url=str(report_url),
+                total_nodes=len(nodes),
+                ok_nodes=sum(1 for v in finished.values() if v == PACKETS),
+                per_node_ok_counts=dict(finished),
+                pending_nodes=pending,
+                polls=polls,
+            )
+
+        # Results arriving: poll again soon. Nothing new: back off.
+        delay = poll_interval_sec if progressed else min(delay * POLL_BACKOFF, max_poll_interval_sec)
@@ -1,68 +1,183 @@
 import os
 import sqlite3
+import threading
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from migrations import migrate
+from queryplans import check_query_plans
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DEFAULT_DB = os.path.join(BASE_DIR, "data", "database.sqlite")
 
 DB = os.getenv("DB_PATH") or DEFAULT_DB
 
+# ---- connection pool tuning ----
+POOL_SIZE = 8  # idle connections kept for reuse
+BUSY_TIMEOUT_MS = 5000
+CACHE_SIZE_KIB = 16384  # page cache per connection
+MMAP_SIZE = 64 * 1024 * 1024
+STATEMENT_CACHE = 256
 
-def db():
+
+# ---- per-request query accounting ----
+class QueryStats:
+    __slots__ = ("queries", "seconds")
+
+    def __init__(self) -> None:
+        self.queries = 0
+        self.seconds = 0.0
+
+
+_request_stats: ContextVar[Optional[QueryStats]] = ContextVar("db_request_stats", default=None)
+TOTALS = QueryStats()
+
+
+def begin_request_stats() -> QueryStats:
+    """Start counting queries for the current context (one bot update)."""
+    st = QueryStats()
+    _request_stats.set(st)
+    return st
+
+
+def request_stats() -> Optional[QueryStats]:
+    return _request_stats.get()
+
+
+def _account(t0: float) -> None:
+    dt = time.perf_counter() - t0
+    TOTALS.queries += 1
+    TOTALS.seconds += dt
+    st = _request_stats.get()
+    if st is not None:
+        st.queries += 1
+        st.seconds += dt
+
+
+class _Cursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _account(t0)
+
+    def executemany(self, sql, seq_of_parameters):
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _account(t0)
+
+    def executescript(self, sql_script):
+        t0 = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            _account(t0)
+
+
+class _PooledConnection(sqlite3.Connection):
+    """Connection whose close() hands it back to the pool.
+
+    Anything left uncommitted is rolled back first, exactly like a real close.
+    """
+
+    def cursor(self, factory=_Cursor):
+        return super().cursor(factory)
+
+    # sqlite3.Connection.execute* bypass cursor(); route them through _Cursor.
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+    def close(self):
+        _release(self)
+
+    def _close(self):
+        super().close()
+
+
+_pool: list = []
+_pool_lock = threading.Lock()
+
+
+def _connect() -> _PooledConnection:
     os.makedirs(os.path.dirname(DB), exist_ok=True)
-    conn = sqlite3.connect(DB)
+    conn = sqlite3.connect(
+        DB,
+        factory=_PooledConnection,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE,
+    )
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KIB}")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+def _release(conn: _PooledConnection) -> None:
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.row_factory = sqlite3.Row
+    except sqlite3.Error:
+        conn._close()
+        return
+    with _pool_lock:
+        if len(_pool) < POOL_SIZE:
+            _pool.append(conn)
+            return
+    conn._close()
+
+
+def db():
+    """Borrow a pooled connection; `conn.close()` returns it to the pool."""
+    conn = None
+    with _pool_lock:
+        if _pool:
+            conn = _pool.pop()
+    if conn is None:
+        conn = _connect()
     conn.row_factory = sqlite3.Row
     return conn
 
 
+def close_all() -> None:
+    with _pool_lock:
+        conns, _pool[:] = list(_pool), []
+    for c in conns:
+        try:
+            c._close()
+        except Exception:
+            pass
+
+
 def init():
     conn = db()
-    cur = conn.cursor()
-
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS users(
-            uid INTEGER UNIQUE,
-            role TEXT NOT NULL
-        )
-    """)
-
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS servers(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            host TEXT NOT NULL,
-            port INTEGER NOT NULL DEFAULT 22,
-            user TEXT NOT NULL,
-            pw TEXT NOT NULL
-        )
-    """)
-
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS logs(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            server_id INTEGER,
-            action TEXT,
-            status TEXT,
-            ts DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS server_status(
-            server_id INTEGER PRIMARY KEY,
-            last_status TEXT,
-            last_check_ts DATETIME,
-            last_change_ts DATETIME,
-            last_notified_ts DATETIME
-        )
-    """)
-
-    # ? settings table for log retention etc.
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS settings(
-            k TEXT PRIMARY KEY,
-            v TEXT
-        )
-    """)
-
-    conn.commit()
-    conn.close()
+    try:
+        # Retention hands freed pages back with PRAGMA incremental_vacuum
+        # (retention.py). The mode sticks only if set before the first page is
+        # written, so it goes before WAL; an existing file needs a full VACUUM,
+        # which retention runs once in its maintenance window, not here.
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            if conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0]:
+                print("--- [DB] incremental auto_vacuum will be enabled in the next cleanup window ---")
+            else:
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        # WAL is persistent in the DB file; readers no longer block the writer.
+        conn.execute("PRAGMA journal_mode=WAL")
+        # All DDL lives in migrations.py and runs only here, once.
+        migrate(conn)
+        check_query_plans(conn)
+        conn.execute("PRAGMA optimize")
+    finally:
+        conn.close()
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""Streaming, gzip-compressed export of the partitioned history tables.
+
+Rows are read a page at a time with keyset pagination (`id > last ORDER BY
+id LIMIT n`) on the reader threads, oldest partition first, skipping
+partitions outside the requested time range. Each page is encoded to CSV
+or JSONL and pushed through one gzip stream into a temp file, so memory
+stays at one page whatever the size of the export. Output is split into
+parts below Telegram's upload limit; each finished part is handed to the
+caller and deleted right after.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+from typing import Awaitable, Callable, List, NamedTuple, Optional, Tuple
+
+from adb import ADB
+from partitions import CH_HISTORY, LOGS
+from timefmt import fmt_utc
+
+PAGE_ROWS = 2000
+# Telegram bots may upload up to 50 MB.
+PART_BYTES = 45 * 1024 * 1024
+# A partition can hold rows stamped a little before its start (probes in
+# flight at the week boundary).
+_SLACK = 3600
+
+# source -> (table, exported columns, column the "action" filter applies to)
+SOURCES = {
+    "logs": (LOGS, ["id", "ts", "server_id", "action", "status"], "action"),
+    "checkhost_history": (
+        CH_HISTORY,
+        ["id", "ts", "server_id", "host", "ok_nodes", "total_nodes", "threshold", "status", "report_link", "details"],
+        "status",
+    ),
+}
+FORMATS = ("csv", "jsonl")
+
+
+class ExportFilter(NamedTuple):
+    source: str = "logs"
+    fmt: str = "csv"
+    server_id: Optional[int] = None
+    action: Optional[str] = None
+    since: Optional[int] = None  # epoch seconds, inclusive
+    until: Optional[int] = None  # epoch seconds, exclusive
+
+
+def _conditions(f: ExportFilter, action_col: str, bounded: bool) -> Tuple[str, list]:
+    sql, params = "", []
+    if f.server_id is not None:
+        sql += " AND server_id = ?"
+        params.append(f.server_id)
+    if f.action:
+        sql += f" AND {action_col} = ?"
+        params.append(f.action)
+    # `+ts` keeps the planner on the rowid walk; only partitions straddling
+    # the range boundary need the check at all.
+    if bounded and f.since is not None:
+        sql += " AND +ts >= ?"
+        params.append(f.since)
+    if bounded and f.until is not None:
+        sql += " AND +ts < ?"
+        params.append(f.until)
+    return sql, params
+
+
+def _plan(parts: List[Tuple[int, str]], f: ExportFilter) -> List[Tuple[str, bool]]:
+    """(partition, needs ts filter) oldest first, for partitions that can match."""
+    out = []
+    ordered = list(reversed(parts))
+    for i, (start, name) in enumerate(ordered):
+        end = ordered[i + 1][0] if i + 1 < len(ordered) else None
+        lo = start - _SLACK
+        if f.since is not None and end is not None and end <= f.since:
+            continue
+        if f.until is not None and lo >= f.until:
+            continue
+        inside = (f.since is None or lo >= f.since) and (f.until is None or (end is not None and end <= f.until))
+        out.append((name, not inside))
+    return out
+
+
+def _page(conn, table: str, cols: List[str], where: str, params: list, after: int, fmt: str) -> Tuple[int, int, bytes]:
+    # Runs on a reader thread: fetch one page and encode it there too.
+    rows = conn.execute(
+        f"SELECT {', '.join(cols)} FROM {table} WHERE id > ?{where} ORDER BY id LIMIT ?",
+        (after, *params, PAGE_ROWS),
+    ).fetchall()
+    if not rows:
+        return 0, after, b""
+    return len(rows), rows[-1]["id"], _encode(rows, cols, fmt)
+
+
+def _encode(rows, cols: List[str], fmt: str) -> bytes:
+    buf = io.StringIO()
+    if fmt == "jsonl":
+        for r in rows:
+            d = {c: r[c] for c in cols}
+            d["time_utc"] = fmt_utc(r["ts"])
+            buf.write(json.dumps(d, ensure_ascii=False))
+            buf.write("\n")
+    else:
+        w = csv.writer(buf)
+        for r in rows:
+            w.writerow([r[c] for c in cols] + [fmt_utc(r["ts"])])
+    return buf.getvalue().encode("utf-8")
+
+
+def _header(cols: List[str], fmt: str) -> bytes:
+    if fmt != "csv":
+        return b""
+    buf = io.StringIO()
+    csv.writer(buf).writerow(cols + ["time_utc"])
+    return buf.getvalue().encode("utf-8")
+
+
+class _Part:
+    """One gzip file on disk; only the compressor state lives in memory."""
+
+    def __init__(self, suffix: str) -> None:
+        fd, self.path = tempfile.mkstemp(prefix="export_", suffix=suffix)
+        self._raw = os.fdopen(fd, "wb")
+        self._gz = gzip.GzipFile(fileobj=self._raw, mode="wb")
+        self.rows = 0
+
+    def write(self, data: bytes) -> None:
+        self._gz.write(data)
+
+    def size(self) -> int:
+        return self._raw.tell()
+
+    def close(self) -> str:
+        self._gz.close()
+        self._raw.close()
+        return self.path
+
+
+OnPart = Callable[[str, int, int], Awaitable[None]]
+
+
+async def stream_export(f: ExportFilter, on_part: OnPart) -> int:
+    """Export rows matching `f`; `on_part(path, part_no, rows)` gets each file.
+
+    Returns the number of rows exported.
+    """
+    pt, cols, action_col = SOURCES[f.source]
+    fmt = f.fmt if f.fmt in FORMATS else "csv"
+    plan = _plan(await ADB.read(pt.partitions), f)
+    suffix = f".{fmt}.gz"
+
+    total = 0
+    part_no = 0
+    part: Optional[_Part] = None
+
+    async def finish(p: _Part) -> None:
+        path = await asyncio.to_thread(p.close)
+        try:
+            await on_part(path, part_no, p.rows)
+        finally:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    try:
+        for name, bounded in plan:
+            where, params = _conditions(f, action_col, bounded)
+            after = 0
+            while True:
+                n, after, data = await ADB.read(lambda c: _page(c, name, cols, where, params, after, fmt))
+                if not n:
+                    break
+                if part is None:
+                    part_no += 1
+                    part = await asyncio.to_thread(_Part, suffix)
+                    await asyncio.to_thread(part.write, _header(cols, fmt))
+                await asyncio.to_thread(part.write, data)
+                part.rows += n
+                total += n
+                if part.size() >= PART_BYTES:
+                    p, part = part, None
+                    await finish(p)
+                if n < PAGE_ROWS:
+                    break
+        if part is not None:
+            p, part = part, None
+            await finish(p)
+    finally:
+        if part is not None:
+            # Aborted mid-way: drop the half-written file.
+            path = await asyncio.to_thread(part.close)
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+    return total
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""In-memory fleet state for the monitor hot path.
+
+Loaded once from SQLite at startup (on a reader thread, see adb.py);
+afterwards the monitor reads only from here and touches the DB just to
+persist changes. bot.py calls
+`FLEET.invalidate()` whenever a server is added, edited or deleted, and
+`FLEET.invalidate_admins()` whenever a role changes. Each record also
+carries the server's last-24h RTT series (see series.py).
+"""
+
+from __future__ import annotations
+
+import time
+from typing import Dict, List, Optional
+
+from adb import ADB
+from series import WINDOW_SEC, RttSeries, load_series
+
+
+class ServerState:
+    __slots__ = (
+        "sid",
+        "name",
+        "host",
+        "port",
+        "interval",
+        "last_status",
+        "last_check_ts",
+        "last_change_ts",
+        "last_notified_ts",
+        "rtt",
+    )
+
+    def __init__(self, sid: int, name: str, host: str, port: int, interval: Optional[int]) -> None:
+        self.sid = sid
+        self.name = name
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.last_status: Optional[str] = None
+        # epoch seconds (UTC)
+        self.last_check_ts: Optional[int] = None
+        self.last_change_ts: Optional[int] = None
+        self.last_notified_ts: Optional[int] = None
+        self.rtt = RttSeries()
+
+
+class FleetState:
+    def __init__(self) -> None:
+        self.servers: Dict[int, ServerState] = {}
+        self._admins: List[int] = []
+        self._dirty = True
+        self._admins_dirty = True
+        # Bumped on every reload so the scheduler knows when to re-sync.
+        self.version = 0
+
+    # ---- invalidation (called from bot.py) ----
+    def invalidate(self) -> None:
+        self._dirty = True
+
+    def invalidate_admins(self) -> None:
+        self._admins_dirty = True
+
+    @property
+    def dirty(self) -> bool:
+        return self._dirty
+
+    # ---- loading ----
+    def _load(self, conn):
+        # Runs on a reader thread.
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT s.id, s.name, s.host, s.port, s.check_interval, "
+            "ss.last_status, ss.last_check_ts, ss.last_change_ts, ss.last_notified_ts "
+            "FROM servers s LEFT JOIN server_status ss ON ss.server_id = s.id"
+        )
+        rows = cur.fetchall()
+        known = set(self.servers)
+        new_sids = [int(r["id"]) for r in rows if int(r["id"]) not in known]
+        return rows, load_series(conn, new_sids, int(time.time()) - WINDOW_SEC)
+
+    async def refresh(self) -> None:
+        """Reload server metadata; runtime status of known servers is kept."""
+        # Cleared first so an invalidate() during the load triggers another pass.
+        self._dirty = False
+        try:
+            rows, series = await ADB.read(self._load)
+        except BaseException:
+            self._dirty = True
+            raise
+
+        fresh: Dict[int, ServerState] = {}
+        for r in rows:
+            sid = int(r["id"])
+            st = self.servers.get(sid)
+            if st is None:
+                st = ServerState(sid, r["name"], r["host"], int(r["port"] or 22), None)
+                st.last_status = r["last_status"]
+                st.last_check_ts = r["last_check_ts"]
+                st.last_change_ts = r["last_change_ts"]
+                st.last_notified_ts = r["last_notified_ts"]
+                st.rtt = series.get(sid) or RttSeries()
+            else:
+                st.name = r["name"]
+                st.host = r["host"]
+                st.port = int(r["port"] or 22)
+            st.interval = int(r["check_interval"]) if r["check_interval"] else None
+            fresh[sid] = st
+
+        self.servers = fresh
+        self.version += 1
+
+    async def admins(self) -> List[int]:
+        if self._admins_dirty:
+            self._admins_dirty = False
+            try:
+                rows = await ADB.fetchall("SELECT uid FROM users WHERE role IN ('owner','admin')")
+            except BaseException:
+                self._admins_dirty = True
+                raise
+            self._admins = [int(r["uid"]) for r in rows]
+        return list(self._admins)
+
+
+FLEET = FleetState()
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""Async ICMP echo engine (IPv4).
+
+A single socket serves every ping in the process: a raw ICMP socket when
+the container has NET_RAW, otherwise an unprivileged datagram ICMP socket
+(Linux `net.ipv4.ping_group_range`). Echo requests to hundreds of hosts go
+out back-to-back and replies are matched by identifier + sequence number,
+so no `ping` process is spawned per host.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import socket
+import struct
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+
+_PAYLOAD = b"ServerSystemGuard".ljust(48, b"\x00")
+
+
+class IcmpUnavailable(OSError):
+    """Neither a raw nor a datagram ICMP socket could be opened."""
+
+
+@dataclass
+class PingStats:
+    host: str
+    sent: int = 0
+    rtts: List[float] = field(default_factory=list)  # milliseconds
+    error: str = ""
+
+    @property
+    def received(self) -> int:
+        return len(self.rtts)
+
+    @property
+    def alive(self) -> bool:
+        return bool(self.rtts)
+
+    @property
+    def loss(self) -> float:
+        # 0.0 .. 1.0
+        if self.sent <= 0:
+            return 1.0
+        return 1.0 - (self.received / self.sent)
+
+    @property
+    def rtt_min(self) -> Optional[float]:
+        return min(self.rtts) if self.rtts else None
+
+    @property
+    def rtt_avg(self) -> Optional[float]:
+        return sum(self.rtts) / len(self.rtts) if self.rtts else None
+
+    @property
+    def rtt_max(self) -> Optional[float]:
+        return max(self.rtts) if self.rtts else None
+
+
+def _checksum(data: bytes) -> int:
+    if len(data) % 2:
+        data += b"\x00"
+    s = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    s = (s >> 16) + (s & 0xFFFF)
+    s += s >> 16
+    return ~s & 0xFFFF
+
+
+def _echo_packet(ident: int, seq: int) -> bytes:
+    hdr = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    csum = _checksum(hdr + _PAYLOAD)
+    return struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, csum, ident, seq) + _PAYLOAD
+
+
+class IcmpPinger:
+    def __init__(self) -> None:
+        self._sock: Optional[socket.socket] = None
+        self._raw = False
+        self._ident = os.getpid() & 0xFFFF
+        self._seq = 0
+        # seq -> (dest ip, send time, future)
+        self._pending: Dict[int, Tuple[str, float, asyncio.Future]] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    # ---- socket ----
+    def _open(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._sock is not None and self._loop is loop:
+            return
+        self.close()
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            raw = True
+        except PermissionError:
+            try:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+                raw = False
+            except OSError as e:
+                raise IcmpUnavailable(f"ICMP socket not permitted: {e}") from e
+        sock.setblocking(False)
+        if not raw:
+            # The kernel replaces the echo id with the socket's local "port".
+            sock.bind(("0.0.0.0", 0))
+            self._ident = sock.getsockname()[1] & 0xFFFF
+        self._sock, self._raw, self._loop = sock, raw, loop
+        loop.add_reader(sock.fileno(), self._on_readable)
+
+    def close(self) -> None:
+        if self._sock is None:
+            return
+        try:
+            if self._loop is not None and not self._loop.is_closed():
+                self._loop.remove_reader(self._sock.fileno())
+        except Exception:
+            pass
+        try:
+            self._sock.close()
+        except Exception:
+            pass
+        self._sock = None
+        for _, _, fut in self._pending.values():
+            if not fut.done():
+                fut.cancel()
+        self._pending.clear()
+
+    @property
+    def mode(self) -> str:
+        if self._sock is None:
+            return "closed"
+        return "raw" if self._raw else "dgram"
+
+    def _on_readable(self) -> None:
+        while True:
+            try:
+                data, addr = self._sock.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            now = time.perf_counter()
+            if self._raw:
+                # Raw sockets deliver the IP header too.
+                data = data[(data[0] & 0x0F) * 4:]
+            if len(data) < 8:
+                continue
+            typ, _code, _csum, ident, seq = struct.unpack("!BBHHH", data[:8])
+            if typ != ICMP_ECHO_REPLY or ident != self._ident:
+                continue
+            entry = self._pending.get(seq)
+            if entry is None:
+                continue
+            ip, sent_at, fut = entry
+            if addr[0] != ip or fut.done():
+                continue
+            fut.set_result((now - sent_at) * 1000.0)
+
+    def _next_seq(self) -> int:
+        for _ in range(0x10000):
+            self._seq = (self._seq + 1) & 0xFFFF
+            if self._seq not in self._pending:
+                return self._seq
+        raise RuntimeError("ICMP sequence space exhausted")
+
+    # ---- public API ----
+    async def ping_many(
+        self,
+        hosts: List[str],
+        *,
+        count: int = 1,
+        timeout: float = 1.0,
+        interval: float = 0.2,
+    ) -> Dict[str, PingStats]:
+        """Ping every host `count` times; returns host -> PingStats.
+
+        Raises IcmpUnavailable if the process may not open ICMP sockets.
+        """
+        self._open()
+        loop = asyncio.get_running_loop()
+        stats: Dict[str, PingStats] = {h: PingStats(h) for h in hosts}
+
+        async def resolve(h: str) -> Optional[str]:
+            try:
+                infos = await loop.getaddrinfo(h, None, family=socket.AF_INET, type=socket.SOCK_RAW)
+                return infos[0][4][0]
+            except Exception as e:
+                stats[h].error = f"resolve: {e}"
+                return None
+
+        ips = await asyncio.gather(*(resolve(h) for h in hosts))
+        targets = [(h, ip) for h, ip in zip(hosts, ips) if ip]
+
+        probes: List[Tuple[str, int, asyncio.Future]] = []
+        try:
+            for rnd in range(max(1, int(count))):
+                if rnd and interval > 0:
+                    await asyncio.sleep(interval)
+                for h, ip in targets:
+                    seq = self._next_seq()
+                    fut = loop.create_future()
+                    self._pending[seq] = (ip, time.perf_counter(), fut)
+                    probes.append((h, seq, fut))
+                    stats[h].sent += 1
+                    try:
+                        await loop.sock_sendto(self._sock, _echo_packet(self._ident, seq), (ip, 0))
+                    except OSError as e:
+                        stats[h].error = str(e)
+                        fut.cancel()
+
+            waiting = [f for _, _, f in probes if not f.done()]
+            if waiting:
+                await asyncio.wait(waiting, timeout=timeout)
+
+            limit_ms = timeout * 1000.0
+            for h, _, fut in probes:
+                if fut.done() and not fut.cancelled():
+                    rtt = fut.result()
+                    if rtt <= limit_ms:
+                        stats[h].rtts.append(rtt)
+        finally:
+            for _, seq, fut in probes:
+                self._pending.pop(seq, None)
+                if not fut.done():
+                    fut.cancel()
+        return stats
+
+    async def ping(self, host: str, *, count: int = 1, timeout: float = 1.0, interval: float = 0.2) -> PingStats:
+        res = await self.ping_many([host], count=count, timeout=timeout, interval=interval)
+        return res[host]
+
+
+PINGER = IcmpPinger()
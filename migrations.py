@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+"""Versioned schema migrations.
+
+`migrate()` runs once at startup (from db.init). Each migration is a
+function applied in its own transaction and recorded in `schema_version`;
+applied versions are never run again, so no runtime query needs DDL.
+Append new migrations to MIGRATIONS with the next version number and
+never edit one that has shipped.
+"""
+
+from __future__ import annotations
+
+import time
+from datetime import datetime, timezone
+from typing import Callable, List, Tuple
+
+
+def _has_column(cur, table: str, column: str) -> bool:
+    return any(r[1] == column for r in cur.execute(f"PRAGMA table_info({table})").fetchall())
+
+
+def _add_column(cur, table: str, column: str, decl: str) -> None:
+    if not _has_column(cur, table, column):
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def _m001_baseline(cur) -> None:
+    """Everything db.init() and the check-host helpers used to create on the fly.
+
+    Written with IF NOT EXISTS / column checks so it also upgrades databases
+    created before schema versioning existed.
+    """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS users(
+            uid INTEGER UNIQUE,
+            role TEXT NOT NULL
+        )
+    """)
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS servers(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            host TEXT NOT NULL,
+            port INTEGER NOT NULL DEFAULT 22,
+            user TEXT NOT NULL,
+            pw TEXT NOT NULL
+        )
+    """)
+    # per-server probe interval (NULL = global ping_interval)
+    _add_column(cur, "servers", "check_interval", "INTEGER")
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS logs(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            server_id INTEGER,
+            action TEXT,
+            status TEXT,
+            ts DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS server_status(
+            server_id INTEGER PRIMARY KEY,
+            last_status TEXT,
+            last_check_ts DATETIME,
+            last_change_ts DATETIME,
+            last_notified_ts DATETIME
+        )
+    """)
+
+    # Narrow per-probe RTT series (epoch seconds, ms; NULL = probe failed)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS probe_samples(
+            server_id INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            rtt REAL,
+            PRIMARY KEY(server_id, ts)
+        ) WITHOUT ROWID
+    """)
+
+    # Pending Telegram notifications (see outbox.py)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS outbox(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            parse_mode TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_try REAL NOT NULL DEFAULT 0,
+            created_ts INTEGER,
+            kind TEXT NOT NULL DEFAULT 'text',
+            filename TEXT,
+            caption TEXT
+        )
+    """)
+    _add_column(cur, "outbox", "kind", "TEXT NOT NULL DEFAULT 'text'")
+    _add_column(cur, "outbox", "filename", "TEXT")
+    _add_column(cur, "outbox", "caption", "TEXT")
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS settings(
+            k TEXT PRIMARY KEY,
+            v TEXT
+        )
+    """)
+
+    # ---- check-host (Iran monitoring) ----
+    cur.execute("CREATE TABLE IF NOT EXISTS checkhost_targets (server_id INTEGER PRIMARY KEY)")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS checkhost_state(
+            server_id INTEGER PRIMARY KEY,
+            last_status TEXT,
+            updated_ts DATETIME DEFAULT CURRENT_TIMESTAMP,
+            auto_status TEXT,
+            fail_alert_sent INTEGER DEFAULT 0
+        )
+    """)
+    _add_column(cur, "checkhost_state", "auto_status", "TEXT")
+    _add_column(cur, "checkhost_state", "fail_alert_sent", "INTEGER DEFAULT 0")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS checkhost_history(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts DATETIME DEFAULT CURRENT_TIMESTAMP,
+            server_id INTEGER,
+            host TEXT,
+            ok_nodes INTEGER,
+            total_nodes INTEGER,
+            threshold INTEGER,
+            status TEXT,
+            report_link TEXT,
+            details TEXT
+        )
+    """)
+
+
+def _m002_outbox_due_index(cur) -> None:
+    # OutboxSender polls "WHERE next_try <= ? ORDER BY id"
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_outbox_next_try ON outbox(next_try)")
+
+
+def _m003_history_indexes(cur) -> None:
+    # logs: per-server lookups (rowid is implied, so ORDER BY id DESC is free)
+    # and the retention range on ts.
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_logs_server ON logs(server_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_logs_ts ON logs(ts)")
+    # probe_samples is keyed (server_id, ts); retention filters on ts alone.
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_probe_samples_ts ON probe_samples(ts)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_ch_history_ts ON checkhost_history(ts)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_ch_history_server ON checkhost_history(server_id)")
+    cur.execute("ANALYZE")
+
+
+def _m004_probe_heartbeats(cur) -> None:
+    # Per-server, per-window probe summary written instead of one logs row
+    # per probe (see monitor.py). Together with the transition rows in
+    # `logs` this is enough to rebuild uptime.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS probe_heartbeats(
+            server_id INTEGER NOT NULL,
+            window_start INTEGER NOT NULL,
+            probes INTEGER NOT NULL DEFAULT 0,
+            failures INTEGER NOT NULL DEFAULT 0,
+            rtt_sum REAL NOT NULL DEFAULT 0,
+            rtt_n INTEGER NOT NULL DEFAULT 0,
+            last_status TEXT,
+            PRIMARY KEY(server_id, window_start)
+        ) WITHOUT ROWID
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_probe_heartbeats_ts ON probe_heartbeats(window_start)")
+
+
+def _m005_rollups(cur) -> None:
+    # Hourly and daily probe aggregates (see rollups.py); `hist` is a sparse
+    # RTT histogram so coarser tiers can still report percentiles.
+    for table, col in (("probe_hourly", "hour_start"), ("probe_daily", "day_start")):
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table}(
+                server_id INTEGER NOT NULL,
+                {col} INTEGER NOT NULL,
+                probes INTEGER NOT NULL,
+                failures INTEGER NOT NULL,
+                rtt_n INTEGER NOT NULL,
+                rtt_sum REAL NOT NULL,
+                rtt_p50 REAL,
+                rtt_p95 REAL,
+                rtt_max REAL,
+                hist BLOB,
+                PRIMARY KEY(server_id, {col})
+            ) WITHOUT ROWID
+        """)
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_ts ON {table}({col})")
+    cur.execute("CREATE TABLE IF NOT EXISTS rollup_watermark(tier TEXT PRIMARY KEY, upto INTEGER NOT NULL)")
+
+
+# ---- history partitions (v6, v7) ----
+# Frozen copy of the partition layout these migrations were written
+# against; partitions.py may change later, a shipped migration must not.
+_WEEK = 7 * 86400
+_FIRST_MONDAY = 4 * 86400  # 1970-01-05
+_EPOCH_NOW = "(CAST(strftime('%s','now') AS INTEGER))"
+# table -> (v7 columns, copied columns, indexes (suffix, columns))
+_HISTORY_V7 = {
+    "logs": (
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, server_id INTEGER, action TEXT, status TEXT, "
+        f"ts INTEGER NOT NULL DEFAULT {_EPOCH_NOW}",
+        ["id", "server_id", "action", "status", "ts"],
+        (("server", "server_id"), ("ts", "ts")),
+    ),
+    "checkhost_history": (
+        f"id INTEGER PRIMARY KEY AUTOINCREMENT, ts INTEGER NOT NULL DEFAULT {_EPOCH_NOW}, server_id INTEGER, "
+        "host TEXT, ok_nodes INTEGER, total_nodes INTEGER, threshold INTEGER, status TEXT, "
+        "report_link TEXT, details TEXT",
+        ["id", "ts", "server_id", "host", "ok_nodes", "total_nodes",
+         "threshold", "status", "report_link", "details"],
+        (("server", "server_id"), ("ts", "ts")),
+    ),
+}
+
+
+def _week_partition(base: str, ts: float) -> str:
+    ts = int(ts)
+    start = ts - (ts - _FIRST_MONDAY) % _WEEK
+    return f"{base}_p{datetime.fromtimestamp(start, tz=timezone.utc):%Y%m%d}"
+
+
+def _history_partitions(cur, base: str) -> List[str]:
+    """Partition tables of `base`, oldest first (names sort by date)."""
+    rows = cur.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name GLOB ?", (f"{base}_p[0-9]*",)
+    ).fetchall()
+    return sorted(r[0] for r in rows)
+
+
+def _refresh_history_view(cur, base: str) -> None:
+    cur.execute(f"DROP VIEW IF EXISTS {base}")
+    parts = _history_partitions(cur, base)
+    if parts:
+        cur.execute(f"CREATE VIEW {base} AS " + " UNION ALL ".join(f"SELECT * FROM {n}" for n in parts))
+
+
+def _text_epoch(value, default: float) -> float:
+    # "YYYY-MM-DD HH:MM:SS" (UTC, CURRENT_TIMESTAMP) -> epoch seconds
+    try:
+        return datetime.strptime(str(value)[:19], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        return default
+
+
+def _m006_partition_history(cur) -> None:
+    # logs / checkhost_history become weekly partitions (see partitions.py).
+    # The existing table becomes the partition of the week of its last row and
+    # rows of earlier weeks move into their own partitions: retention and
+    # export treat a partition as ending where the next one starts, so each
+    # one must hold only its own week.
+    for base in ("logs", "checkhost_history"):
+        r = cur.execute(
+            "SELECT type FROM sqlite_master WHERE name=?", (base,)
+        ).fetchone()
+        if r is None or r[0] != "table":
+            continue
+        last = cur.execute(f"SELECT MAX(ts) FROM {base}").fetchone()[0]
+        newest = _week_partition(base, _text_epoch(last, time.time()))
+        cur.execute(f"ALTER TABLE {base} RENAME TO {newest}")
+        ddl = cur.execute("SELECT sql FROM sqlite_master WHERE name=?", (newest,)).fetchone()[0]
+        columns = ddl[ddl.index("("):]
+
+        days = cur.execute(f"SELECT DISTINCT substr(ts, 1, 10) FROM {newest} WHERE ts IS NOT NULL").fetchall()
+        weeks = {_week_partition(base, _text_epoch(f"{d[0]} 00:00:00", 0)) for d in days}
+        weeks.discard(newest)
+        weeks.discard(_week_partition(base, 0))  # unparsable ts: stays in the newest partition
+        for name in sorted(weeks):
+            start = datetime.strptime(name[len(base) + 2:], "%Y%m%d").replace(tzinfo=timezone.utc)
+            lo = f"{start:%Y-%m-%d %H:%M:%S}"
+            hi = f"{datetime.fromtimestamp(start.timestamp() + _WEEK, tz=timezone.utc):%Y-%m-%d %H:%M:%S}"
+            cur.execute(f"CREATE TABLE {name}{columns}")
+            cur.execute(f"INSERT INTO {name} SELECT * FROM {newest} WHERE ts >= ? AND ts < ?", (lo, hi))
+            cur.execute(f"DELETE FROM {newest} WHERE ts >= ? AND ts < ?", (lo, hi))
+        _refresh_history_view(cur, base)
+
+
+def _epoch(col: str) -> str:
+    # "YYYY-MM-DD HH:MM:SS" (UTC, CURRENT_TIMESTAMP) -> epoch seconds; numbers pass through.
+    return (
+        f"CASE WHEN {col} IS NULL OR {col} = '' THEN NULL "
+        f"WHEN typeof({col}) IN ('integer','real') THEN CAST({col} AS INTEGER) "
+        f"ELSE CAST(strftime('%s', {col}) AS INTEGER) END"
+    )
+
+
+def _rebuild(cur, table: str, columns: str, copy_cols: List[str], ts_cols: List[str], not_null: bool = False) -> None:
+    """Recreate `table` with `columns`, converting `ts_cols` to epoch seconds."""
+    seq = cur.execute("SELECT seq FROM sqlite_sequence WHERE name=?", (table,)).fetchone()
+    tmp = f"{table}__v7"
+    cur.execute(f"CREATE TABLE {tmp}({columns})")
+    exprs = [
+        (f"COALESCE({_epoch(c)}, 0)" if not_null else _epoch(c)) if c in ts_cols else c
+        for c in copy_cols
+    ]
+    cur.execute(f"INSERT INTO {tmp}({', '.join(copy_cols)}) SELECT {', '.join(exprs)} FROM {table}")
+    cur.execute(f"DROP TABLE {table}")
+    cur.execute(f"ALTER TABLE {tmp} RENAME TO {table}")
+    if seq is not None:
+        cur.execute("DELETE FROM sqlite_sequence WHERE name=?", (table,))
+        cur.execute("INSERT INTO sqlite_sequence(name, seq) VALUES (?,?)", (table, seq[0]))
+
+
+def _m007_epoch_timestamps(cur) -> None:
+    # Text CURRENT_TIMESTAMP columns -> INTEGER epoch seconds (UTC), so range
+    # filters are integer comparisons and text is produced only for display
+    # (timefmt.py).
+    for base, (columns, cols, indexes) in _HISTORY_V7.items():
+        cur.execute(f"DROP VIEW IF EXISTS {base}")
+        for name in _history_partitions(cur, base):
+            _rebuild(cur, name, columns, cols, ["ts"], not_null=True)
+            for suffix, icols in indexes:
+                cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_{suffix} ON {name}({icols})")
+        _refresh_history_view(cur, base)
+
+    _rebuild(
+        cur,
+        "server_status",
+        "server_id INTEGER PRIMARY KEY, last_status TEXT, last_check_ts INTEGER, "
+        "last_change_ts INTEGER, last_notified_ts INTEGER",
+        ["server_id", "last_status", "last_check_ts", "last_change_ts", "last_notified_ts"],
+        ["last_check_ts", "last_change_ts", "last_notified_ts"],
+    )
+    _rebuild(
+        cur,
+        "checkhost_state",
+        "server_id INTEGER PRIMARY KEY, last_status TEXT, "
+        "updated_ts INTEGER DEFAULT (CAST(strftime('%s','now') AS INTEGER)), "
+        "auto_status TEXT, fail_alert_sent INTEGER DEFAULT 0",
+        ["server_id", "last_status", "updated_ts", "auto_status", "fail_alert_sent"],
+        ["updated_ts"],
+    )
+
+
+def _m008_checkhost_confirm(cur) -> None:
+    # Deferred confirm re-checks (bot.py, _ch_confirm_job): what is being
+    # confirmed (FAIL / OK), checks done and still needed, when the next one
+    # is due and the time by which the confirmation must finish.
+    _add_column(cur, "checkhost_state", "confirm_kind", "TEXT")
+    _add_column(cur, "checkhost_state", "confirm_done", "INTEGER NOT NULL DEFAULT 0")
+    _add_column(cur, "checkhost_state", "confirm_left", "INTEGER NOT NULL DEFAULT 0")
+    _add_column(cur, "checkhost_state", "confirm_due", "INTEGER")
+    _add_column(cur, "checkhost_state", "confirm_deadline", "INTEGER")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_checkhost_state_confirm_due ON checkhost_state(confirm_due)")
+
+
+MIGRATIONS: List[Tuple[int, str, Callable]] = [
+    (1, "baseline", _m001_baseline),
+    (2, "outbox_due_index", _m002_outbox_due_index),
+    (3, "history_indexes", _m003_history_indexes),
+    (4, "probe_heartbeats", _m004_probe_heartbeats),
+    (5, "rollups", _m005_rollups),
+    (6, "partition_history", _m006_partition_history),
+    (7, "epoch_timestamps", _m007_epoch_timestamps),
+    (8, "checkhost_confirm", _m008_checkhost_confirm),
+]
+
+
+def current_version(conn) -> int:
+    r = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return int(r[0] or 0)
+
+
+def migrate(conn) -> int:
+    """Apply pending migrations in order; returns the resulting version."""
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS schema_version("
+        "version INTEGER PRIMARY KEY, name TEXT NOT NULL, applied_ts INTEGER NOT NULL)"
+    )
+    conn.commit()
+    version = current_version(conn)
+    for ver, name, fn in MIGRATIONS:
+        if ver <= version:
+            continue
+        cur = conn.cursor()
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            if current_version(conn) >= ver:
+                # applied meanwhile by another process
+                conn.rollback()
+                continue
+            fn(cur)
+            cur.execute(
+                "INSERT INTO schema_version(version, name, applied_ts) VALUES (?,?,?)",
+                (ver, name, int(time.time())),
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"--- [DB] schema migrated to v{ver} ({name}) ---")
+        version = ver
+    return version
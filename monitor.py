@@ -1,105 +1,305 @@
 # -*- coding: utf-8 -*-
 import asyncio
-import socket
 import os
-from datetime import datetime, timezone
-from db import db
+import time
+from fleet import FLEET, ServerState
+from icmp import PINGER, IcmpUnavailable
+from outbox import enqueue_document, enqueue_many
+from writer import WRITER
+from scheduler import ProbeScheduler
+from settings import SETTINGS
+from timefmt import fmt_utc
 
 # هدر ربات با ایموجی‌های استاندارد
 BOT_HEADER = "🎛 Server system guard\n💎 | Version Bot: 1.6\n🔹 | creator: @farhadasqarii"
 
-def _utcnow_str():
-    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+# حداکثر تاخیر در دیدن تغییرات لیست سرورها (invalidate از bot.py)
+FLEET_POLL_SEC = 1.0
 
-async def _check_ssh(host: str, port: int = 22, timeout: float = 3.0) -> str:
-    s = socket.socket()
-    s.settimeout(timeout)
+# سقف پیش‌فرض پروب‌های همزمان (قابل تنظیم از settings: probe_concurrency)
+DEFAULT_PROBE_CONCURRENCY = 256
+PROBE_TIMEOUT = 3.0
+
+# لاگ پایش: "changes" فقط تغییر وضعیت، "full" یک ردیف برای هر پروب
+DEFAULT_MON_LOG_MODE = "changes"
+# پنجره خلاصه پروب‌ها در probe_heartbeats (ثانیه، 0 = خاموش)
+DEFAULT_HEARTBEAT_SEC = 3600
+
+# پنجره تجمیع هشدارها (ثانیه): -1 خاموش، 0 هر دسته پروب، N ثانیه
+DEFAULT_DIGEST_WINDOW = 15
+# بیشتر از این، خلاصه به صورت فایل ارسال می‌شود (سقف پیام تلگرام 4096)
+DIGEST_MAX_CHARS = 3800
+# سقف انتظار برای بسته شدن اتصال پروب (ثانیه)
+CLOSE_TIMEOUT = 1.0
+
+
+async def _check_ssh(host: str, port: int = 22, timeout: float = PROBE_TIMEOUT) -> tuple[str, float | None]:
+    """TCP connect probe that never blocks the event loop.
+
+    Returns (status, rtt_ms); rtt is the handshake time, None when DOWN.
+    """
+    writer = None
+    t0 = time.perf_counter()
     try:
-        s.connect((host, port))
-        return "UP"
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        return "UP", (time.perf_counter() - t0) * 1000.0
     except Exception:
-        return "DOWN"
+        return "DOWN", None
     finally:
+        if writer is not None:
+            try:
+                writer.close()
+                # Let the transport finish closing instead of leaking it.
+                await asyncio.wait_for(writer.wait_closed(), CLOSE_TIMEOUT)
+            except Exception:
+                pass
+
+
+async def _probe_all(servers, sem: asyncio.Semaphore, timeout: float = PROBE_TIMEOUT) -> list[tuple]:
+    """Probe every server concurrently; `sem` caps connections in flight.
+
+    Results are returned in the same order as `servers`.
+    """
+
+    async def one(srv: ServerState) -> tuple:
+        async with sem:
+            return await _check_ssh(srv.host, port=srv.port, timeout=timeout)
+
+    return await asyncio.gather(*(one(s) for s in servers))
+
+
+async def _icmp_probe_all(servers, timeout: float = PROBE_TIMEOUT) -> list[tuple]:
+    """One ICMP echo per server, all sent over the shared PINGER socket."""
+    hosts = list({s.host for s in servers})
+    res = await PINGER.ping_many(hosts, count=1, timeout=timeout)
+    return [("UP", res[s.host].rtt_avg) if res[s.host].alive else ("DOWN", None) for s in servers]
+
+
+def _transition_msg(name: str, host: str, port: int, st: str, now: int) -> str:
+    if st == "DOWN":
+        status_emoji = "🚨"
+        status_text = "DOWN (قطع شده)"
+    else:
+        status_emoji = "✅"
+        status_text = "UP (متصل شد)"
+
+    return (
+        f"{BOT_HEADER}\n\n"
+        f"{status_emoji} **تغییر وضعیت سرور**\n"
+        f"🔹 نام سرور: **{name}**\n"
+        f"🌐 آدرس: `{host}:{port}`\n"
+        f"📊 وضعیت فعلی: **{status_text}**\n"
+        f"⏰ زمان: `{fmt_utc(now)} UTC`"
+    )
+
+
+class AlertDigest:
+    """Collects transitions for a short window, then sends one message per admin.
+
+    DOWN and UP servers are grouped; a digest too long for one Telegram
+    message goes out as a text document instead.
+    """
+
+    def __init__(self) -> None:
+        self.items: list[tuple] = []
+        self.due: float | None = None
+
+    def add(self, transitions, window: float) -> None:
+        self.items.extend(transitions)
+        if self.due is None:
+            self.due = time.monotonic() + max(0.0, float(window))
+
+    def _lines(self, items, st: str, markdown: bool) -> list[str]:
+        out = []
+        for name, host, port, s, now in items:
+            if s != st:
+                continue
+            if markdown:
+                out.append(f"• **{name}** — `{host}:{port}` ({fmt_utc(now, '%H:%M:%S')})")
+            else:
+                out.append(f"- {name} | {host}:{port} | {fmt_utc(now)} UTC")
+        return out
+
+    def _render(self, items, markdown: bool) -> str:
+        down = self._lines(items, "DOWN", markdown)
+        up = self._lines(items, "UP", markdown)
+        parts = [BOT_HEADER, "", f"📣 خلاصه تغییر وضعیت ({len(items)} سرور)"]
+        if down:
+            parts += ["", f"🚨 DOWN (قطع شده): {len(down)}"] + down
+        if up:
+            parts += ["", f"✅ UP (متصل شد): {len(up)}"] + up
+        if markdown:
+            parts += ["", f"⏰ زمان: `{fmt_utc(items[-1][4])} UTC`"]
+        return "\n".join(parts)
+
+    async def flush(self) -> None:
+        items, self.items, self.due = self.items, [], None
+        if not items:
+            return
+        uids = await FLEET.admins()
+        if len(items) == 1:
+            await enqueue_many((uid, _transition_msg(*items[0]), "Markdown") for uid in uids)
+            return
+        text = self._render(items, markdown=True)
+        if len(text) <= DIGEST_MAX_CHARS:
+            await enqueue_many((uid, text, "Markdown") for uid in uids)
+            return
+        down = sum(1 for t in items if t[3] == "DOWN")
+        caption = f"📣 خلاصه تغییر وضعیت: 🚨 {down} DOWN | ✅ {len(items) - down} UP"
+        await enqueue_document(uids, self._render(items, markdown=False), "status_digest.txt", caption)
+
+
+DIGEST = AlertDigest()
+
+
+async def _run_batch(
+    bot,
+    servers,
+    sem: asyncio.Semaphore,
+    mode: str = "tcp",
+    digest_window: float = -1,
+    log_mode: str = DEFAULT_MON_LOG_MODE,
+    hb_sec: int = DEFAULT_HEARTBEAT_SEC,
+) -> None:
+    # همه سرورهای این نوبت همزمان بررسی می‌شوند
+    if mode == "icmp":
         try:
-            s.close()
-        except Exception:
-            pass
+            results = await _icmp_probe_all(servers)
+        except IcmpUnavailable:
+            results = await _probe_all(servers, sem)
+    else:
+        results = await _probe_all(servers, sem)
+
+    transitions = []
+
+    for srv, (st, rtt) in zip(servers, results):
+        # سرور در حین پروب حذف شده است
+        if FLEET.servers.get(srv.sid) is not srv:
+            continue
+
+        sid = srv.sid
+        prev_status = srv.last_status
+        now = int(time.time())
+
+        srv.last_check_ts = now
+        srv.rtt.add(now, rtt)
+        if prev_status != st:
+            srv.last_status = st
+            srv.last_change_ts = now
+
+        # اعلان در صورت تغییر وضعیت
+        if prev_status and prev_status != st:
+            transitions.append((srv.name, srv.host, srv.port, st, now))
+            srv.last_notified_ts = now
+
+        # نوشتن در دیتابیس به صورت دسته‌ای توسط WRITER انجام می‌شود
+        # در حالت changes فقط تغییر وضعیت (و اولین پروب) ثبت می‌شود؛ بقیه در heartbeat خلاصه می‌شوند
+        if log_mode == "full" or prev_status != st:
+            WRITER.log(sid, "MON", st, now)
+        if hb_sec > 0:
+            WRITER.heartbeat(sid, now - now % hb_sec, st, rtt)
+        WRITER.sample(sid, now, rtt)
+        WRITER.status(sid, srv.last_status, srv.last_check_ts, srv.last_change_ts, srv.last_notified_ts)
+
+    if not transitions:
+        return
+    # فقط در صف قرار می‌گیرد؛ ارسال توسط outbox انجام می‌شود
+    if digest_window < 0:
+        uids = await FLEET.admins()
+        await enqueue_many((uid, _transition_msg(*t), "Markdown") for t in transitions for uid in uids)
+    else:
+        DIGEST.add(transitions, digest_window)
+        if digest_window == 0:
+            await DIGEST.flush()
+
 
 async def loop(bot):
+    """Fixed-rate per-server scheduler: each server is probed on its own slot."""
+    sched = ProbeScheduler()
+    inflight: set[int] = set()
+    tasks: set = set()
+    sem = None
+    sem_size = 0
+    interval = 30
+    mode = "tcp"
+    digest_window = DEFAULT_DIGEST_WINDOW
+    log_mode = DEFAULT_MON_LOG_MODE
+    hb_sec = DEFAULT_HEARTBEAT_SEC
+    synced = (-1, 0)
+    settings_ver = -1
+
+    def _done(t, sids):
+        tasks.discard(t)
+        inflight.difference_update(sids)
+        if not t.cancelled() and t.exception() is not None:
+            print(f"--- [Monitor Error] {t.exception()} ---")
+
     while True:
-        try:
-            from bot import get_ping_interval
-            interval = get_ping_interval()
-        except Exception:
-            interval = 30
-
-        conn = db()
-        cur = conn.cursor()
-        cur.execute("SELECT id, name, host, port FROM servers")
-        servers = cur.fetchall()
-
-        for row in servers:
-            sid = int(row["id"])
-            name = row["name"]
-            host = row["host"]
-            port = int(row["port"] or 22)
-
-            # چک کردن وضعیت سرور
-            st = await _check_ssh(host, port=port)
-
-            # ثبت در لاگ
-            cur.execute("INSERT INTO logs(server_id, action, status) VALUES (?,?,?)", (sid, "MON", st))
-
-            # بررسی وضعیت قبلی
-            cur.execute("SELECT last_status FROM server_status WHERE server_id=?", (sid,))
-            prev = cur.fetchone()
-            prev_status = prev["last_status"] if prev else None
-
-            now = _utcnow_str()
-
-            if not prev:
-                cur.execute(
-                    "INSERT INTO server_status(server_id,last_status,last_check_ts,last_change_ts) VALUES (?,?,?,?)",
-                    (sid, st, now, now),
-                )
-            else:
-                if prev_status != st:
-                    cur.execute(
-                        "UPDATE server_status SET last_status=?, last_check_ts=?, last_change_ts=? WHERE server_id=?",
-                        (st, now, now, sid),
-                    )
-                else:
-                    cur.execute("UPDATE server_status SET last_check_ts=? WHERE server_id=?", (now, sid))
-
-            # ارسال اعلان در صورت تغییر وضعیت
-            if prev_status and prev_status != st:
-                cur.execute("SELECT uid FROM users WHERE role IN ('owner','admin')")
-                uids = [int(r["uid"]) for r in cur.fetchall()]
-                
-                if st == "DOWN":
-                    status_emoji = "🚨"
-                    status_text = "DOWN (قطع شده)"
-                else:
-                    status_emoji = "✅"
-                    status_text = "UP (متصل شد)"
-
-                msg = (
-                    f"{BOT_HEADER}\n\n"
-                    f"{status_emoji} **تغییر وضعیت سرور**\n"
-                    f"🔹 نام سرور: **{name}**\n"
-                    f"🌐 آدرس: `{host}:{port}`\n"
-                    f"📊 وضعیت فعلی: **{status_text}**\n"
-                    f"⏰ زمان: `{now} UTC`"
+        now = time.monotonic()
+
+        # تنظیمات فقط پس از تغییر (set_setting) دوباره خوانده می‌شوند
+        if settings_ver != SETTINGS.version:
+            settings_ver = SETTINGS.version
+            try:
+                from bot import (
+                    get_alert_digest_window,
+                    get_heartbeat_sec,
+                    get_mon_log_mode,
+                    get_ping_interval,
+                    get_probe_concurrency,
+                    get_probe_mode,
                 )
+                interval = get_ping_interval()
+                concurrency = get_probe_concurrency()
+                mode = get_probe_mode()
+                digest_window = get_alert_digest_window()
+                log_mode = get_mon_log_mode()
+                hb_sec = get_heartbeat_sec()
+            except Exception:
+                interval = 30
+                concurrency = DEFAULT_PROBE_CONCURRENCY
+                mode = "tcp"
+                digest_window = DEFAULT_DIGEST_WINDOW
+                log_mode = DEFAULT_MON_LOG_MODE
+                hb_sec = DEFAULT_HEARTBEAT_SEC
+            if sem is None or concurrency != sem_size:
+                sem = asyncio.Semaphore(concurrency)
+                sem_size = concurrency
+
+        # لیست سرورها فقط بعد از افزودن/ویرایش/حذف دوباره خوانده می‌شود
+        if FLEET.dirty:
+            try:
+                await FLEET.refresh()
+            except Exception as e:
+                print(f"--- [Monitor Error] {e} ---")
+
+        if synced != (FLEET.version, interval):
+            # بازه اختصاصی هر سرور، در غیر این صورت بازه کلی
+            sched.sync({sid: (s.interval or interval) for sid, s in FLEET.servers.items()}, now)
+            synced = (FLEET.version, interval)
+
+        # سروری که پروب قبلی‌اش هنوز تمام نشده دوباره ارسال نمی‌شود
+        due = [sid for sid in sched.pop_due(now) if sid in FLEET.servers and sid not in inflight]
+        if due:
+            inflight.update(due)
+            t = asyncio.create_task(_run_batch(
+                bot, [FLEET.servers[sid] for sid in due], sem, mode, digest_window, log_mode, hb_sec
+            ))
+            tasks.add(t)
+            t.add_done_callback(lambda t, d=tuple(due): _done(t, d))
+
+        # ارسال خلاصه هشدارها پس از پایان پنجره
+        if DIGEST.due is not None and now >= DIGEST.due:
+            try:
+                await DIGEST.flush()
+            except Exception as e:
+                print(f"--- [Monitor Error] {e} ---")
 
-                for uid in uids:
-                    try:
-                        await bot.send_message(uid, msg, parse_mode="Markdown")
-                    except Exception:
-                        pass
-                
-                cur.execute("UPDATE server_status SET last_notified_ts=? WHERE server_id=?", (now, sid))
-
-        conn.commit()
-        conn.close()
-        await asyncio.sleep(interval)
\ No newline at end of file
+        wake = now + FLEET_POLL_SEC
+        nxt = sched.next_due()
+        if nxt is not None:
+            wake = min(wake, nxt)
+        if DIGEST.due is not None:
+            wake = min(wake, DIGEST.due)
+        # تغییر تنظیمات (مثلاً بازه پایش) خواب را زودتر قطع می‌کند
+        await SETTINGS.wait_changed(settings_ver, max(0.0, wake - time.monotonic()))
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""Persistent notification outbox.
+
+Producers (the monitor) only `enqueue()` rows into the `outbox` table; the
+`OutboxSender` task delivers them concurrently while staying under
+Telegram's limits: a global token bucket (~30 msg/s) plus per-chat spacing
+(1 msg/s for private chats, 20 msg/min for groups). Messages to the same
+chat keep their order. RetryAfter responses reschedule the row (and pause
+the global bucket); other transient errors back off exponentially. Rows
+live in SQLite until delivered, so pending alerts survive a restart.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from aiogram.types import BufferedInputFile
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNotFound,
+    TelegramRetryAfter,
+)
+
+from adb import ADB
+from utils.ratelimit import TokenBucket
+
+GLOBAL_RATE = 25.0  # msg/s, a little under Telegram's ~30/s
+PRIVATE_SPACING = 1.0  # seconds between messages to one private chat
+GROUP_SPACING = 3.0  # 20 msg/min per group
+MAX_ATTEMPTS = 8
+BATCH = 200
+IDLE_POLL = 5.0
+
+_wakeup: Optional[asyncio.Event] = None
+
+
+async def enqueue_many(items: Iterable[Tuple[int, str, Optional[str]]]) -> int:
+    """Queue (chat_id, text, parse_mode) messages; returns how many were queued."""
+    rows = [(int(cid), text, pm, int(time.time())) for cid, text, pm in items]
+    if not rows:
+        return 0
+    await ADB.executemany(
+        "INSERT INTO outbox(chat_id, text, parse_mode, created_ts) VALUES (?,?,?,?)", rows
+    )
+    if _wakeup is not None:
+        _wakeup.set()
+    return len(rows)
+
+
+async def enqueue(chat_id: int, text: str, parse_mode: Optional[str] = None) -> None:
+    await enqueue_many([(chat_id, text, parse_mode)])
+
+
+async def enqueue_document(chat_ids: Iterable[int], content: str, filename: str, caption: str = "") -> int:
+    """Queue `content` as a text file for each chat (for messages over the size limit)."""
+    now = int(time.time())
+    rows = [(int(cid), content, filename, caption, now) for cid in chat_ids]
+    if not rows:
+        return 0
+    await ADB.executemany(
+        "INSERT INTO outbox(chat_id, text, kind, filename, caption, created_ts) "
+        "VALUES (?,?,'document',?,?,?)",
+        rows,
+    )
+    if _wakeup is not None:
+        _wakeup.set()
+    return len(rows)
+
+
+async def pending_count() -> int:
+    r = await ADB.fetchone("SELECT COUNT(*) AS c FROM outbox")
+    return int(r["c"] or 0)
+
+
+class OutboxSender:
+    def __init__(self) -> None:
+        self.bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        self._next_slot: Dict[int, float] = {}
+        self.sent = 0
+        self.failed = 0
+
+    def _spacing(self, chat_id: int) -> float:
+        return GROUP_SPACING if chat_id < 0 else PRIVATE_SPACING
+
+    async def _fetch_due(self) -> List:
+        return await ADB.fetchall(
+            "SELECT id, chat_id, text, parse_mode, attempts, kind, filename, caption FROM outbox "
+            "WHERE next_try <= ? ORDER BY id LIMIT ?",
+            (time.time(), BATCH),
+        )
+
+    async def _done(self, row_id: int) -> None:
+        await ADB.execute("DELETE FROM outbox WHERE id=?", (row_id,))
+
+    async def _retry(self, row_id: int, attempts: int, delay: float) -> None:
+        await ADB.execute(
+            "UPDATE outbox SET attempts=?, next_try=? WHERE id=?",
+            (attempts, time.time() + delay, row_id),
+        )
+
+    async def _send_text(self, bot, chat_id: int, row) -> None:
+        try:
+            await bot.send_message(
+                chat_id, row["text"], parse_mode=row["parse_mode"], disable_web_page_preview=True
+            )
+        except TelegramBadRequest as e:
+            # A server name with stray Markdown must not cost us the alert.
+            if not row["parse_mode"] or "parse" not in str(e).lower():
+                raise
+            await bot.send_message(chat_id, row["text"], disable_web_page_preview=True)
+
+    async def _deliver_chat(self, bot, chat_id: int, rows: List) -> None:
+        for i, row in enumerate(rows):
+            # per-chat spacing
+            now = time.monotonic()
+            slot = self._next_slot.get(chat_id, 0.0)
+            if slot > now:
+                await asyncio.sleep(slot - now)
+            await self.bucket.acquire()
+            self._next_slot[chat_id] = time.monotonic() + self._spacing(chat_id)
+
+            attempts = int(row["attempts"] or 0) + 1
+            try:
+                if row["kind"] == "document":
+                    await bot.send_document(
+                        chat_id,
+                        BufferedInputFile(row["text"].encode("utf-8"), filename=row["filename"] or "message.txt"),
+                        caption=row["caption"] or None,
+                    )
+                else:
+                    await self._send_text(bot, chat_id, row)
+            except TelegramRetryAfter as e:
+                # Flood control: park this message and everything after it in this chat.
+                self.bucket.pause(e.retry_after)
+                next_try = time.time() + float(e.retry_after)
+                await ADB.executemany(
+                    "UPDATE outbox SET next_try=? WHERE id=?",
+                    [(next_try, int(r["id"])) for r in rows[i:]],
+                )
+                return
+            except (TelegramForbiddenError, TelegramNotFound, TelegramBadRequest) as e:
+                # Permanent: bot blocked, chat gone, malformed text.
+                print(f"--- [Outbox] dropping message {row['id']} to {chat_id}: {e} ---")
+                self.failed += 1
+                await self._done(int(row["id"]))
+                continue
+            except Exception as e:
+                if attempts >= MAX_ATTEMPTS:
+                    print(f"--- [Outbox] giving up on message {row['id']} to {chat_id}: {e} ---")
+                    self.failed += 1
+                    await self._done(int(row["id"]))
+                    continue
+                # Transient: hold back the rest of this chat too so messages keep their order.
+                delay = min(300.0, 2.0 ** attempts)
+                await self._retry(int(row["id"]), attempts, delay)
+                next_try = time.time() + delay
+                await ADB.executemany(
+                    "UPDATE outbox SET next_try=? WHERE id=?",
+                    [(next_try, int(r["id"])) for r in rows[i + 1:]],
+                )
+                return
+
+            self.sent += 1
+            await self._done(int(row["id"]))
+
+    async def run(self, bot) -> None:
+        global _wakeup
+        _wakeup = asyncio.Event()
+        while True:
+            try:
+                rows = await self._fetch_due()
+            except Exception as e:
+                print(f"--- [Outbox Error] {e} ---")
+                rows = []
+
+            if rows:
+                by_chat: Dict[int, List] = {}
+                for r in rows:
+                    by_chat.setdefault(int(r["chat_id"]), []).append(r)
+                results = await asyncio.gather(
+                    *(self._deliver_chat(bot, cid, rs) for cid, rs in by_chat.items()),
+                    return_exceptions=True,
+                )
+                for res in results:
+                    if isinstance(res, Exception):
+                        print(f"--- [Outbox Error] {res} ---")
+                continue
+
+            try:
+                await asyncio.wait_for(_wakeup.wait(), IDLE_POLL)
+            except asyncio.TimeoutError:
+                pass
+            _wakeup.clear()
+
+
+SENDER = OutboxSender()
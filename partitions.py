@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""Time-partitioned append-only tables (`logs`, `checkhost_history`).
+
+Each table is split into one physical table per UTC week (Monday 00:00),
+named `<base>_pYYYYMMDD` after the week's first day. Rows are always
+written to the current week's partition, and a new partition continues
+the id sequence of the previous one, so `id` stays increasing across the
+whole set: "newest first" reads walk partitions from the newest and stop
+as soon as their LIMIT is met. Retention drops whole partitions whose
+week ended before the cutoff -- no row deletes, no index churn.
+
+A plain `<base>` view (UNION ALL of every partition) is kept for ad-hoc
+queries; the bot itself goes through the router methods below. DDL here
+only ever runs on the DB writer thread (adb.py) or from migrations.
+"""
+
+from __future__ import annotations
+
+import time
+from datetime import datetime, timezone
+from typing import List, Optional, Sequence, Tuple
+
+PERIOD = 7 * 86400
+# 1970-01-05 was the first Monday of the epoch.
+_MONDAY = 4 * 86400
+
+
+class PartitionedTable:
+    def __init__(self, base: str, columns: str, indexes: Sequence[Tuple[str, str]] = ()) -> None:
+        self.base = base
+        self.columns = columns
+        # (suffix, column list) -> CREATE INDEX idx_<partition>_<suffix>
+        self.indexes = tuple(indexes)
+        self._current: Optional[Tuple[int, str]] = None  # writer thread only
+
+    # ---- naming ----
+    @staticmethod
+    def period_start(ts: float) -> int:
+        ts = int(ts)
+        return ts - (ts - _MONDAY) % PERIOD
+
+    def name_for(self, start: int) -> str:
+        return f"{self.base}_p{datetime.fromtimestamp(start, tz=timezone.utc):%Y%m%d}"
+
+    def _start_of(self, name: str) -> int:
+        d = datetime.strptime(name[len(self.base) + 2:], "%Y%m%d").replace(tzinfo=timezone.utc)
+        return int(d.timestamp())
+
+    def partitions(self, conn) -> List[Tuple[int, str]]:
+        """(start, name) of every partition, newest first."""
+        rows = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name GLOB ?",
+            (f"{self.base}_p[0-9]*",),
+        ).fetchall()
+        return sorted(((self._start_of(r[0]), r[0]) for r in rows), reverse=True)
+
+    # ---- DDL (writer thread / migrations) ----
+    def refresh_view(self, conn) -> None:
+        conn.execute(f"DROP VIEW IF EXISTS {self.base}")
+        parts = self.partitions(conn)
+        if parts:
+            body = " UNION ALL ".join(f"SELECT * FROM {name}" for _, name in reversed(parts))
+            conn.execute(f"CREATE VIEW {self.base} AS {body}")
+
+    def _create(self, conn, start: int) -> str:
+        name = self.name_for(start)
+        # Continue the id sequence of the partitions before this one.
+        r = conn.execute(
+            "SELECT MAX(seq) FROM sqlite_sequence WHERE name GLOB ?", (f"{self.base}_p[0-9]*",)
+        ).fetchone()
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {name}({self.columns})")
+        for suffix, cols in self.indexes:
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_{suffix} ON {name}({cols})")
+        if r and r[0]:
+            conn.execute("DELETE FROM sqlite_sequence WHERE name=?", (name,))
+            conn.execute("INSERT INTO sqlite_sequence(name, seq) VALUES (?,?)", (name, int(r[0])))
+        self.refresh_view(conn)
+        return name
+
+    def current(self, conn, now: Optional[float] = None) -> str:
+        """Partition new rows go to; created on the first write of a new week."""
+        start = self.period_start(time.time() if now is None else now)
+        if self._current is not None and self._current[0] == start:
+            return self._current[1]
+        name = self.name_for(start)
+        if not any(n == name for _, n in self.partitions(conn)):
+            name = self._create(conn, start)
+        self._current = (start, name)
+        return name
+
+    def bind(self, conn, sql: str) -> str:
+        """`sql` with `{t}` pointing at the current partition (for INSERTs)."""
+        return sql.format(t=self.current(conn))
+
+    def drop_before(self, conn, cutoff: float) -> Tuple[int, int]:
+        """Drop partitions that hold only rows older than `cutoff`.
+
+        Returns (partitions dropped, rows dropped). The newest partition is
+        never dropped, so writes always have a home.
+        """
+        parts = self.partitions(conn)
+        dropped = rows = 0
+        # A partition ends where the next (newer) one starts.
+        for (_, newer), (_, name) in zip(parts, parts[1:]):
+            if self._start_of(newer) > cutoff:
+                continue
+            r = conn.execute(f"SELECT MIN(id), MAX(id) FROM {name}").fetchone()
+            if r[0] is not None:
+                rows += int(r[1]) - int(r[0]) + 1
+            conn.execute(f"DROP TABLE {name}")
+            conn.execute("DELETE FROM sqlite_sequence WHERE name=?", (name,))
+            dropped += 1
+        if dropped:
+            self.refresh_view(conn)
+        return dropped, rows
+
+    # ---- reads (any thread) ----
+    def newest_first(self, conn, sql: str, params: Sequence = (), limit: int = 20) -> list:
+        """Run `sql` (with `{t}` and a trailing `LIMIT ?`) over partitions,
+        newest first, until `limit` rows are collected."""
+        out: list = []
+        for _, name in self.partitions(conn):
+            out.extend(conn.execute(sql.format(t=name), (*params, limit - len(out))).fetchall())
+            if len(out) >= limit:
+                break
+        return out
+
+
+# Epoch seconds (UTC); callers always pass ts, the default is a safety net.
+EPOCH_NOW = "(CAST(strftime('%s','now') AS INTEGER))"
+
+LOGS = PartitionedTable(
+    "logs",
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, server_id INTEGER, action TEXT, status TEXT, "
+    f"ts INTEGER NOT NULL DEFAULT {EPOCH_NOW}",
+    indexes=(("server", "server_id"), ("ts", "ts")),
+)
+
+CH_HISTORY = PartitionedTable(
+    "checkhost_history",
+    f"id INTEGER PRIMARY KEY AUTOINCREMENT, ts INTEGER NOT NULL DEFAULT {EPOCH_NOW}, server_id INTEGER, "
+    "host TEXT, ok_nodes INTEGER, total_nodes INTEGER, threshold INTEGER, status TEXT, "
+    "report_link TEXT, details TEXT",
+    indexes=(("server", "server_id"), ("ts", "ts")),
+)
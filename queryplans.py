@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""Startup self-check of the query plans behind the hot paths.
+
+Each entry is a query the bot runs often or against a large table. At
+startup `check_query_plans()` runs `EXPLAIN QUERY PLAN` on each and warns
+when SQLite would walk a whole table that is expected to be reached
+through an index. Keep the SQL here in sync with the call sites; `{logs}` and
+`{checkhost_history}` stand for the newest partition (see partitions.py).
+
+Tables that ANALYZE (sqlite_stat1) counted as small are not reported: with
+a handful of rows SQLite rightly prefers a scan over an index lookup.
+"""
+
+from __future__ import annotations
+
+import re
+from typing import Dict, List, NamedTuple, Sequence, Tuple
+
+from partitions import CH_HISTORY, LOGS
+
+# "SCAN logs" / "SCAN h" -- a full pass over a table (not "SCAN ... USING INDEX").
+_FULL_SCAN = re.compile(r"^SCAN (\w+)(?: AS \w+)?$")
+# "FROM servers s" / "JOIN server_status AS ss" -> alias, table
+_TABLE_REF = re.compile(r"\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", re.IGNORECASE)
+_NOT_ALIAS = {"WHERE", "ORDER", "GROUP", "LIMIT", "LEFT", "INNER", "CROSS", "JOIN", "ON", "USING"}
+# Below this many rows (per sqlite_stat1) a scan is the better plan anyway.
+SMALL_TABLE_ROWS = 1000
+
+
+class HotQuery(NamedTuple):
+    name: str
+    sql: str
+    params: Sequence
+    # Tables (or aliases) a full scan is fine for: tiny ones, or ORDER BY rowid LIMIT n.
+    allow_scan: Tuple[str, ...] = ()
+
+
+HOT_QUERIES: List[HotQuery] = [
+    HotQuery(
+        "stats: last logs of a server",
+        "SELECT * FROM {logs} WHERE server_id = ? ORDER BY id DESC LIMIT ?",
+        (0, 5),
+    ),
+    HotQuery(
+        "retention: delete a chunk of old probe samples",
+        "DELETE FROM probe_samples WHERE (server_id, ts) IN "
+        "(SELECT server_id, ts FROM probe_samples WHERE ts < ? LIMIT ?)",
+        (0, 5000),
+    ),
+    HotQuery(
+        "retention: delete a chunk of old heartbeats",
+        "DELETE FROM probe_heartbeats WHERE (server_id, window_start) IN "
+        "(SELECT server_id, window_start FROM probe_heartbeats WHERE window_start < ? LIMIT ?)",
+        (0, 5000),
+    ),
+    HotQuery(
+        "rollup: fold one hour",
+        "SELECT server_id, ts, rtt FROM probe_samples WHERE ts >= ? AND ts < ?",
+        (0, 3600),
+    ),
+    HotQuery(
+        "rollup: prune hourly tier",
+        "DELETE FROM probe_hourly WHERE hour_start < ?",
+        (0,),
+    ),
+    HotQuery(
+        "rollup: prune daily tier",
+        "DELETE FROM probe_daily WHERE day_start < ?",
+        (0,),
+    ),
+    HotQuery(
+        "stats: 24h uptime",
+        "SELECT SUM(probes) AS n, SUM(failures) AS f FROM probe_heartbeats "
+        "WHERE server_id=? AND window_start >= ?",
+        (0, 0),
+    ),
+    HotQuery(
+        "check-host: history screen",
+        "SELECT h.ts, s.name, h.host, h.ok_nodes, h.total_nodes, h.status "
+        "FROM {checkhost_history} h LEFT JOIN servers s ON s.id=h.server_id "
+        "ORDER BY h.id DESC LIMIT ?",
+        (20,),
+        allow_scan=("h",),
+    ),
+    HotQuery(
+        "check-host: due confirmations",
+        "SELECT server_id FROM checkhost_state WHERE confirm_due <= ?",
+        (0,),
+    ),
+    HotQuery(
+        "status screen",
+        "SELECT s.name, s.host, s.check_interval, ss.last_status, ss.last_check_ts "
+        "FROM servers s LEFT JOIN server_status ss ON ss.server_id = s.id WHERE s.id = ?",
+        (0,),
+    ),
+    HotQuery(
+        "dashboard",
+        "SELECT s.name, s.host, ss.last_status "
+        "FROM servers s LEFT JOIN server_status ss ON ss.server_id=s.id "
+        "ORDER BY CASE WHEN ss.last_status = 'up' THEN 1 ELSE 0 END ASC, s.id DESC",
+        (),
+        allow_scan=("s",),
+    ),
+    HotQuery(
+        "logs screen",
+        "SELECT server_id,action,status,ts FROM {logs} ORDER BY id DESC LIMIT ?",
+        (20,),
+        allow_scan=("{logs}",),
+    ),
+    HotQuery(
+        "probe series load",
+        "SELECT ts, rtt FROM probe_samples WHERE server_id=? AND ts >= ? ORDER BY ts",
+        (0, 0),
+    ),
+]
+
+
+def _newest_partitions(conn) -> dict:
+    names = {}
+    for pt in (LOGS, CH_HISTORY):
+        parts = pt.partitions(conn)
+        names[pt.base] = parts[0][1] if parts else pt.base
+    return names
+
+
+def _row_counts(conn) -> Dict[str, int]:
+    """Table -> row count as last measured by ANALYZE (empty if never run)."""
+    try:
+        rows = conn.execute("SELECT tbl, stat FROM sqlite_stat1").fetchall()
+    except Exception:
+        return {}
+    counts: Dict[str, int] = {}
+    for tbl, stat in rows:
+        try:
+            n = int(str(stat).split()[0])
+        except (IndexError, ValueError):
+            continue
+        counts[tbl] = max(n, counts.get(tbl, 0))
+    return counts
+
+
+def _tables_by_alias(sql: str) -> Dict[str, str]:
+    out = {}
+    for table, alias in _TABLE_REF.findall(sql):
+        out[table] = table
+        if alias and alias.upper() not in _NOT_ALIAS:
+            out[alias] = table
+    return out
+
+
+def full_scans(conn, q: HotQuery, names: dict | None = None, counts: dict | None = None) -> List[str]:
+    """Plan lines of `q` that are unexpected full scans of a non-small table."""
+    names = _newest_partitions(conn) if names is None else names
+    counts = _row_counts(conn) if counts is None else counts
+    allow = {a.format(**names) for a in q.allow_scan}
+    sql = q.sql.format(**names)
+    tables = _tables_by_alias(sql)
+    bad = []
+    for row in conn.execute("EXPLAIN QUERY PLAN " + sql, tuple(q.params)).fetchall():
+        detail = row[-1]
+        m = _FULL_SCAN.match(detail)
+        if not m or m.group(1) in allow:
+            continue
+        table = tables.get(m.group(1), m.group(1))
+        if counts.get(table, SMALL_TABLE_ROWS) < SMALL_TABLE_ROWS:
+            continue
+        bad.append(detail)
+    return bad
+
+
+def check_query_plans(conn) -> int:
+    """Warn about hot queries that fall back to a full scan; returns the count."""
+    n = 0
+    names = _newest_partitions(conn)
+    counts = _row_counts(conn)
+    for q in HOT_QUERIES:
+        try:
+            bad = full_scans(conn, q, names, counts)
+        except Exception as e:
+            print(f"--- [DB Plan Error] {q.name}: {e} ---")
+            continue
+        for detail in bad:
+            n += 1
+            print(f"--- [DB Plan] full scan in '{q.name}': {detail} ---")
+    return n
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""Background retention: bounded chunks, then incremental vacuum.
+
+Partitioned history (partitions.py) is dropped a partition at a time.
+Row-level tables (`probe_samples`, `probe_heartbeats`) are deleted in
+chunks of at most `chunk_rows` rows, each its own short job on the DB
+writer thread, so handler writes queue between chunks instead of behind
+one long transaction. Freed pages are then returned to the filesystem
+with `PRAGMA incremental_vacuum` (the DB runs with auto_vacuum=INCREMENTAL,
+see db.init), again in small steps. A database created before that mode
+existed is converted by the first run with one full VACUUM, here in the
+maintenance window rather than at startup.
+
+The log admin screen (bot.py) shows RETENTION's phase / deleted counts
+while a run is in flight and the totals after it finished.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Dict, Optional
+
+from adb import ADB
+from partitions import CH_HISTORY, LOGS
+from rollups import safe_cutoff
+
+CHUNK_ROWS = 5000
+VACUUM_PAGES = 2000
+# Raw probe samples are written once per probe (series.py keeps a 24h
+# in-memory series from them and rollups.py folds them hourly); older
+# history lives in the rollup tiers, so raw rows only need to outlive both.
+RAW_SAMPLE_SEC = 2 * 86400
+
+# WITHOUT ROWID tables: chunk on their primary key instead of a rowid range.
+_CHUNK_SQL = {
+    "probe_samples": (
+        "DELETE FROM probe_samples WHERE (server_id, ts) IN "
+        "(SELECT server_id, ts FROM probe_samples WHERE ts < ? LIMIT ?)"
+    ),
+    "probe_heartbeats": (
+        "DELETE FROM probe_heartbeats WHERE (server_id, window_start) IN "
+        "(SELECT server_id, window_start FROM probe_heartbeats WHERE window_start < ? LIMIT ?)"
+    ),
+}
+
+
+def _raw_cutoff(conn, cutoff: int, now: int) -> int:
+    # Keep at most RAW_SAMPLE_SEC of raw samples (less if log retention is
+    # shorter), but never the ones the hourly rollup has not folded yet.
+    return safe_cutoff(conn, "hourly", max(cutoff, now - RAW_SAMPLE_SEC))
+
+
+def _vacuum_step(conn, pages: int) -> int:
+    before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    # executescript steps the pragma to completion; execute() frees one page.
+    conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+    return before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def _enable_incremental(conn) -> int:
+    """One-time switch to auto_vacuum=INCREMENTAL; returns pages freed (0 if already on)."""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return 0
+    print("--- [DB] enabling incremental auto_vacuum (one-time VACUUM) ---")
+    before = conn.execute("PRAGMA page_count").fetchone()[0]
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+    # The rewritten file went through the WAL; fold it back and truncate it.
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return max(0, before - conn.execute("PRAGMA page_count").fetchone()[0])
+
+
+class RetentionJob:
+    def __init__(self, chunk_rows: int = CHUNK_ROWS) -> None:
+        self.chunk_rows = chunk_rows
+        self.running = False
+        self.phase = ""
+        self.deleted: Dict[str, int] = {}
+        self.pages_freed = 0
+        self.page_size = 4096
+        self.started_ts = 0.0
+        self.finished_ts = 0.0
+        self.last_error: Optional[str] = None
+        self._lock = asyncio.Lock()
+
+    def _count(self, table: str, n: int) -> None:
+        self.deleted[table] = self.deleted.get(table, 0) + n
+
+    async def _chunked(self, table: str, cutoff: int) -> None:
+        self.phase = table
+        sql = _CHUNK_SQL[table]
+        if table == "probe_samples":
+            now = int(time.time())
+            cutoff = await ADB.read(lambda c: _raw_cutoff(c, cutoff, now))
+        while True:
+            res = await ADB.execute(sql, (cutoff, self.chunk_rows))
+            self._count(table, res.rowcount)
+            if res.rowcount < self.chunk_rows:
+                break
+            await asyncio.sleep(0)
+
+    async def _vacuum(self) -> None:
+        self.phase = "vacuum"
+        self.page_size = (await ADB.fetchone("PRAGMA page_size"))[0]
+        self.pages_freed += await ADB.write(_enable_incremental)
+        while True:
+            freed = await ADB.write(lambda c: _vacuum_step(c, VACUUM_PAGES))
+            self.pages_freed += freed
+            if freed < VACUUM_PAGES:
+                break
+            await asyncio.sleep(0)
+
+    async def run(self, days: int) -> int:
+        """One full pass; returns the number of log rows removed."""
+        async with self._lock:
+            self.running = True
+            self.deleted = {}
+            self.pages_freed = 0
+            self.last_error = None
+            self.started_ts = time.time()
+            cutoff = int(time.time()) - days * 86400
+            try:
+                # Partitions: one DROP per aged-out week, no row deletes.
+                for pt in (LOGS, CH_HISTORY):
+                    self.phase = pt.base
+                    _, rows = await ADB.write(lambda c, pt=pt: pt.drop_before(c, cutoff))
+                    self._count(pt.base, rows)
+                for table in _CHUNK_SQL:
+                    await self._chunked(table, cutoff)
+                await self._vacuum()
+            except Exception as e:
+                self.last_error = str(e)
+                raise
+            finally:
+                self.running = False
+                self.phase = ""
+                self.finished_ts = time.time()
+            return self.deleted.get(LOGS.base, 0)
+
+    def freed_mb(self) -> float:
+        return self.pages_freed * self.page_size / (1024 * 1024)
+
+
+RETENTION = RetentionJob()
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""Tiered rollups of probe history: raw -> hourly -> daily.
+
+Raw `probe_samples` are folded into `probe_hourly` one settled hour at a
+time, and finished hours into `probe_daily` one UTC day at a time. Each
+tier keeps a watermark in `rollup_watermark` (the end of the last folded
+period); a pass only looks at periods past it and rewrites whole periods,
+so re-running is harmless. Raw retention never deletes samples the hourly
+tier has not folded yet (same for hourly vs. daily).
+
+Every rollup row keeps a sparse log-scale RTT histogram so the daily tier
+(and any multi-day summary) can report percentiles without the raw rows;
+bucket resolution is ~5%.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import math
+import time
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from adb import ADB
+from series import percentile
+from settings import SETTINGS
+
+HOUR = 3600
+DAY = 86400
+# The newest hour is left alone until in-flight probes and the write-behind
+# buffer (writer.py) had time to land its samples.
+SETTLE_SEC = 120
+
+DEFAULT_HOURLY_DAYS = 90
+DEFAULT_DAILY_DAYS = 730
+
+_BASE = 1.1
+_NBUCKETS = 120
+
+_HOURLY_COLS = "server_id, hour_start, probes, failures, rtt_n, rtt_sum, rtt_p50, rtt_p95, rtt_max, hist"
+_DAILY_COLS = "server_id, day_start, probes, failures, rtt_n, rtt_sum, rtt_p50, rtt_p95, rtt_max, hist"
+
+
+# ---- RTT histogram ----
+def bucket(rtt: float) -> int:
+    # 0: under 1 ms; i >= 1: [BASE^(i-1), BASE^i) ms
+    if rtt < 1.0:
+        return 0
+    return min(_NBUCKETS - 1, 1 + int(math.log(rtt) / math.log(_BASE)))
+
+
+def bucket_mid(i: int) -> float:
+    if i == 0:
+        return 0.5
+    return _BASE ** (i - 1) * math.sqrt(_BASE)
+
+
+def encode_hist(hist: Dict[int, int]) -> bytes:
+    flat = array("I")
+    for i in sorted(hist):
+        flat.extend((i, hist[i]))
+    return flat.tobytes()
+
+
+def decode_hist(blob: Optional[bytes]) -> Dict[int, int]:
+    if not blob:
+        return {}
+    flat = array("I")
+    flat.frombytes(blob)
+    return {flat[k]: flat[k + 1] for k in range(0, len(flat), 2)}
+
+
+def hist_percentile(hist: Dict[int, int], q: float) -> Optional[float]:
+    """Nearest-rank percentile (q in 0..100) read off a histogram."""
+    n = sum(hist.values())
+    if n == 0:
+        return None
+    k = max(1, int(math.ceil(q / 100.0 * n)))
+    seen = 0
+    for i in sorted(hist):
+        seen += hist[i]
+        if seen >= k:
+            return bucket_mid(i)
+    return None
+
+
+def summarize(rows: Iterable) -> dict:
+    """Merge rollup rows (hourly or daily) into one summary."""
+    probes = failures = rtt_n = 0
+    rtt_sum = 0.0
+    rtt_max = None
+    hist: Counter = Counter()
+    for r in rows:
+        probes += r["probes"]
+        failures += r["failures"]
+        rtt_n += r["rtt_n"]
+        rtt_sum += r["rtt_sum"]
+        if r["rtt_max"] is not None:
+            rtt_max = r["rtt_max"] if rtt_max is None else max(rtt_max, r["rtt_max"])
+        hist.update(decode_hist(r["hist"]))
+    return {
+        "probes": probes,
+        "failures": failures,
+        "rtt_n": rtt_n,
+        "rtt_sum": rtt_sum,
+        "hist": hist,
+        "uptime": (probes - failures) * 100.0 / probes if probes else None,
+        "rtt_avg": rtt_sum / rtt_n if rtt_n else None,
+        "p50": hist_percentile(hist, 50),
+        "p95": hist_percentile(hist, 95),
+        "rtt_max": rtt_max,
+    }
+
+
+# ---- watermarks ----
+def get_watermark(conn, tier: str) -> Optional[int]:
+    r = conn.execute("SELECT upto FROM rollup_watermark WHERE tier=?", (tier,)).fetchone()
+    return int(r[0]) if r else None
+
+
+def _set_watermark(conn, tier: str, upto: int) -> None:
+    conn.execute(
+        "INSERT INTO rollup_watermark(tier, upto) VALUES (?,?) "
+        "ON CONFLICT(tier) DO UPDATE SET upto=excluded.upto",
+        (tier, int(upto)),
+    )
+
+
+def safe_cutoff(conn, tier: str, cutoff: int) -> int:
+    """Clamp a retention cutoff so rows not yet folded into `tier` survive."""
+    wm = get_watermark(conn, tier)
+    return min(cutoff, wm if wm is not None else 0)
+
+
+# ---- hourly tier (reader thread computes, writer thread stores) ----
+def _next_hour(conn, start: Optional[int]) -> Optional[int]:
+    # First hour >= start that has samples; skips gaps (bot offline) in one query.
+    r = conn.execute("SELECT MIN(ts) FROM probe_samples WHERE ts >= ?", (start or 0,)).fetchone()
+    if r[0] is None:
+        return None
+    return int(r[0]) - int(r[0]) % HOUR
+
+
+def _fold_hour(conn, start: int) -> List[Tuple]:
+    by_sid: Dict[int, list] = {}
+    for sid, _ts, rtt in conn.execute(
+        "SELECT server_id, ts, rtt FROM probe_samples WHERE ts >= ? AND ts < ?", (start, start + HOUR)
+    ):
+        by_sid.setdefault(int(sid), []).append(rtt)
+    out = []
+    for sid, vals in by_sid.items():
+        ok = sorted(float(v) for v in vals if v is not None)
+        out.append((
+            sid,
+            start,
+            len(vals),
+            len(vals) - len(ok),
+            len(ok),
+            sum(ok),
+            percentile(ok, 50),
+            percentile(ok, 95),
+            ok[-1] if ok else None,
+            encode_hist(Counter(bucket(v) for v in ok)),
+        ))
+    return out
+
+
+def _store_hour(conn, start: int, rows: List[Tuple]) -> None:
+    conn.execute("DELETE FROM probe_hourly WHERE hour_start = ?", (start,))
+    conn.executemany(f"INSERT INTO probe_hourly({_HOURLY_COLS}) VALUES (?,?,?,?,?,?,?,?,?,?)", rows)
+    _set_watermark(conn, "hourly", start + HOUR)
+
+
+# ---- daily tier ----
+def _next_day(conn, start: Optional[int]) -> Optional[int]:
+    r = conn.execute("SELECT MIN(hour_start) FROM probe_hourly WHERE hour_start >= ?", (start or 0,)).fetchone()
+    if r[0] is None:
+        return None
+    return int(r[0]) - int(r[0]) % DAY
+
+
+def _fold_day(conn, start: int) -> List[Tuple]:
+    by_sid: Dict[int, list] = {}
+    for r in conn.execute(
+        f"SELECT {_HOURLY_COLS} FROM probe_hourly WHERE hour_start >= ? AND hour_start < ?", (start, start + DAY)
+    ):
+        by_sid.setdefault(int(r["server_id"]), []).append(r)
+    out = []
+    for sid, rows in by_sid.items():
+        s = summarize(rows)
+        out.append((
+            sid,
+            start,
+            s["probes"],
+            s["failures"],
+            s["rtt_n"],
+            s["rtt_sum"],
+            s["p50"],
+            s["p95"],
+            s["rtt_max"],
+            encode_hist(s["hist"]),
+        ))
+    return out
+
+
+def _store_day(conn, start: int, rows: List[Tuple]) -> None:
+    conn.execute("DELETE FROM probe_daily WHERE day_start = ?", (start,))
+    conn.executemany(f"INSERT INTO probe_daily({_DAILY_COLS}) VALUES (?,?,?,?,?,?,?,?,?,?)", rows)
+    _set_watermark(conn, "daily", start + DAY)
+
+
+def _prune_txn(conn, hourly_days: int, daily_days: int, now: int) -> None:
+    conn.execute(
+        "DELETE FROM probe_hourly WHERE hour_start < ?",
+        (safe_cutoff(conn, "daily", now - hourly_days * DAY),),
+    )
+    if daily_days > 0:
+        conn.execute("DELETE FROM probe_daily WHERE day_start < ?", (now - daily_days * DAY,))
+
+
+def _days(key: str, default: int) -> int:
+    try:
+        return max(0, min(3650, int(SETTINGS.get(key, str(default)))))
+    except Exception:
+        return default
+
+
+class RollupPipeline:
+    def __init__(self) -> None:
+        self.hours_folded = 0
+        self.days_folded = 0
+        self.last_run_ts = 0.0
+
+    async def fold_hours(self, now: Optional[int] = None) -> int:
+        """Fold every settled hour past the hourly watermark; one txn per hour."""
+        now = int(now if now is not None else time.time())
+        limit = now - SETTLE_SEC
+        n = 0
+        wm = await ADB.read(lambda c: get_watermark(c, "hourly"))
+        while True:
+            start = await ADB.read(lambda c: _next_hour(c, wm))
+            if start is None or start + HOUR > limit:
+                break
+            rows = await ADB.read(lambda c: _fold_hour(c, start))
+            await ADB.write(lambda c: _store_hour(c, start, rows))
+            wm = start + HOUR
+            n += 1
+        self.hours_folded += n
+        return n
+
+    async def fold_days(self) -> int:
+        """Fold every day the hourly tier has fully covered."""
+        n = 0
+        hourly_wm = await ADB.read(lambda c: get_watermark(c, "hourly"))
+        if hourly_wm is None:
+            return 0
+        wm = await ADB.read(lambda c: get_watermark(c, "daily"))
+        while True:
+            start = await ADB.read(lambda c: _next_day(c, wm))
+            if start is None or start + DAY > hourly_wm:
+                break
+            rows = await ADB.read(lambda c: _fold_day(c, start))
+            await ADB.write(lambda c: _store_day(c, start, rows))
+            wm = start + DAY
+            n += 1
+        self.days_folded += n
+        return n
+
+    async def run_once(self) -> Tuple[int, int]:
+        hours = await self.fold_hours()
+        days = await self.fold_days()
+        hourly_days = max(1, _days("rollup_hourly_days", DEFAULT_HOURLY_DAYS))
+        daily_days = _days("rollup_daily_days", DEFAULT_DAILY_DAYS)
+        await ADB.write(lambda c: _prune_txn(c, hourly_days, daily_days, int(time.time())))
+        self.last_run_ts = time.time()
+        return hours, days
+
+    async def run(self) -> None:
+        """Roll up shortly after every hour boundary."""
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                print(f"--- [Rollup Error] {e} ---")
+            now = time.time()
+            await asyncio.sleep(HOUR - now % HOUR + SETTLE_SEC)
+
+
+ROLLUPS = RollupPipeline()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Per-server probe scheduler.
+
+Every server gets its own interval and next-due time, kept in a min-heap.
+Slots are fixed-rate: the next due time is derived from the previous *due*
+time, not from when the probe actually finished, so the period never drifts.
+First slots are phase-spread over the interval (golden-ratio offsets per
+server id) so a large fleet does not fire in one burst.
+"""
+
+from __future__ import annotations
+
+import heapq
+import math
+from typing import Dict, Iterable, List, Optional, Tuple
+
+MIN_INTERVAL = 10
+MAX_INTERVAL = 3600
+
+_GOLDEN = 0.6180339887498949
+
+
+def clamp_interval(v) -> int:
+    try:
+        return max(MIN_INTERVAL, min(MAX_INTERVAL, int(v)))
+    except Exception:
+        return MIN_INTERVAL
+
+
+def _phase(sid: int, interval: float) -> float:
+    # Low-discrepancy offset in [0, interval): consecutive ids land far apart.
+    return ((sid * _GOLDEN) % 1.0) * interval
+
+
+class ProbeScheduler:
+    """Min-heap of (due, sid, gen). Stale heap entries are skipped lazily."""
+
+    def __init__(self) -> None:
+        self._heap: List[Tuple[float, int, int]] = []
+        # sid -> [interval, due, gen]
+        self._entries: Dict[int, list] = {}
+        self._gen = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _push(self, sid: int, interval: float, due: float) -> None:
+        self._gen += 1
+        self._entries[sid] = [interval, due, self._gen]
+        heapq.heappush(self._heap, (due, sid, self._gen))
+
+    def sync(self, intervals: Dict[int, int], now: float) -> None:
+        """Bring the schedule in line with `intervals` (sid -> seconds).
+
+        New servers get a phase-spread first slot, removed servers are dropped
+        and servers whose interval changed are re-phased on the new period.
+        """
+        for sid in [s for s in self._entries if s not in intervals]:
+            del self._entries[sid]
+
+        for sid, interval in intervals.items():
+            interval = clamp_interval(interval)
+            cur = self._entries.get(sid)
+            if cur is not None and cur[0] == interval:
+                continue
+            self._push(sid, interval, now + _phase(sid, interval))
+
+        # Drop dead heap entries if they pile up (many removals/re-phases).
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [
+                (e[1], sid, e[2]) for sid, e in self._entries.items()
+            ]
+            heapq.heapify(self._heap)
+
+    def pop_due(self, now: float) -> List[int]:
+        """Return all sids whose slot has come and schedule their next slot.
+
+        Missed slots (e.g. after a long event-loop stall) are skipped rather
+        than fired back-to-back, keeping the original phase.
+        """
+        due: List[int] = []
+        while self._heap and self._heap[0][0] <= now:
+            t, sid, gen = heapq.heappop(self._heap)
+            e = self._entries.get(sid)
+            if e is None or e[2] != gen:
+                continue
+            interval = e[0]
+            nxt = t + interval
+            if nxt <= now:
+                nxt = t + interval * (math.floor((now - t) / interval) + 1)
+            e[1] = nxt
+            heapq.heappush(self._heap, (nxt, sid, gen))
+            due.append(sid)
+        return due
+
+    def next_due(self) -> Optional[float]:
+        while self._heap:
+            t, sid, gen = self._heap[0]
+            e = self._entries.get(sid)
+            if e is not None and e[2] == gen:
+                return t
+            heapq.heappop(self._heap)
+        return None
+
+    def interval_of(self, sid: int) -> Optional[int]:
+        e = self._entries.get(sid)
+        return int(e[0]) if e else None
+
+    def sids(self) -> Iterable[int]:
+        return self._entries.keys()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Compact per-server RTT time series.
+
+Each server keeps the last 24h of probe samples in two parallel arrays:
+epoch seconds (`array('l')`) and RTT in ms as float32 (`array('f')`),
+with NaN marking a failed probe. The same samples are persisted to the
+narrow `probe_samples` table (server_id, ts, rtt) so the series survives
+restarts.
+"""
+
+from __future__ import annotations
+
+import math
+from array import array
+from typing import Dict, Iterable, Optional, Tuple
+
+WINDOW_SEC = 24 * 3600
+
+NAN = float("nan")
+
+
+def percentile(sorted_vals, q: float) -> Optional[float]:
+    """Nearest-rank percentile of an already sorted sequence (q in 0..100)."""
+    n = len(sorted_vals)
+    if n == 0:
+        return None
+    k = max(0, min(n - 1, int(math.ceil(q / 100.0 * n)) - 1))
+    return float(sorted_vals[k])
+
+
+class RttSeries:
+    __slots__ = ("ts", "rtt")
+
+    def __init__(self) -> None:
+        self.ts = array("l")
+        self.rtt = array("f")
+
+    def __len__(self) -> int:
+        return len(self.ts)
+
+    def add(self, ts: int, rtt: Optional[float]) -> None:
+        self.ts.append(int(ts))
+        self.rtt.append(NAN if rtt is None else float(rtt))
+        # Trim in blocks so we are not shifting the arrays on every sample.
+        if self.ts[0] < ts - WINDOW_SEC - 600:
+            self.trim(ts - WINDOW_SEC)
+
+    def trim(self, cutoff: int) -> None:
+        i = 0
+        n = len(self.ts)
+        while i < n and self.ts[i] < cutoff:
+            i += 1
+        if i:
+            del self.ts[:i]
+            del self.rtt[:i]
+
+    def last(self) -> Optional[float]:
+        if not self.rtt:
+            return None
+        v = self.rtt[-1]
+        return None if math.isnan(v) else float(v)
+
+    def window(self, since: int) -> Tuple[int, list]:
+        """(probes, sorted successful RTTs) for samples with ts >= since."""
+        probes = 0
+        vals = []
+        for i in range(len(self.ts) - 1, -1, -1):
+            if self.ts[i] < since:
+                break
+            probes += 1
+            v = self.rtt[i]
+            if not math.isnan(v):
+                vals.append(v)
+        vals.sort()
+        return probes, vals
+
+    def summary(self, since: int) -> dict:
+        probes, vals = self.window(since)
+        return {
+            "probes": probes,
+            "ok": len(vals),
+            "p50": percentile(vals, 50),
+            "p95": percentile(vals, 95),
+        }
+
+
+def load_series(conn, sids: Iterable[int], since: int) -> Dict[int, RttSeries]:
+    """Load persisted samples (ts >= since) for the given servers."""
+    out: Dict[int, RttSeries] = {}
+    cur = conn.cursor()
+    for sid in sids:
+        s = out[int(sid)] = RttSeries()
+        # Served by the (server_id, ts) primary key.
+        cur.execute(
+            "SELECT ts, rtt FROM probe_samples WHERE server_id=? AND ts >= ? ORDER BY ts",
+            (int(sid), int(since)),
+        )
+        for ts, rtt in cur.fetchall():
+            s.add(int(ts), rtt)
+    return out
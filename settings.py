@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""In-memory settings store.
+
+The `settings` table is read once at startup; `get()` is a dict lookup
+and `set()` writes through to SQLite (on the async writer thread) before
+updating the cache. Every change bumps `version` and wakes coroutines
+blocked in `wait_changed()`, so background loops pick up a new interval
+immediately instead of polling for it.
+"""
+
+from __future__ import annotations
+
+import asyncio
+from typing import Dict, Optional
+
+from adb import ADB
+from db import db
+
+_UPSERT_SQL = "INSERT INTO settings(k,v) VALUES (?,?) ON CONFLICT(k) DO UPDATE SET v=excluded.v"
+
+
+class SettingsStore:
+    def __init__(self) -> None:
+        self._values: Dict[str, str] = {}
+        self._loaded = False
+        self._changed: Optional[asyncio.Event] = None
+        self.version = 0
+
+    def load(self) -> None:
+        """(Re)load every setting; called once at startup, before polling."""
+        conn = db()
+        try:
+            rows = conn.execute("SELECT k, v FROM settings").fetchall()
+        finally:
+            conn.close()
+        self._values = {r["k"]: r["v"] for r in rows if r["v"] is not None}
+        self._loaded = True
+
+    def get(self, key: str, default: str) -> str:
+        if not self._loaded:
+            self.load()
+        v = self._values.get(key)
+        return default if v is None else v
+
+    async def set(self, key: str, value: str) -> None:
+        value = str(value)
+        if self._loaded and self._values.get(key) == value:
+            return
+        await ADB.execute(_UPSERT_SQL, (key, value))
+        self._values[key] = value
+        self.version += 1
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = None
+
+    async def wait_changed(self, since: int, timeout: Optional[float] = None) -> bool:
+        """Wait until `version` moves past `since` (or `timeout` passes).
+
+        Returns True if something changed.
+        """
+        if self.version != since:
+            return True
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.version != since
+
+
+SETTINGS = SettingsStore()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""Display formatting for epoch timestamps.
+
+Every time column holds integer epoch seconds (UTC); text only exists on
+the way out. `fmt_ts()` renders Tehran local time with the zone offset
+cached per 15-minute slot (every real-world offset change falls on one),
+so a list screen costs one dict hit and one `time.strftime` per row that
+is actually displayed -- no strptime, no zoneinfo lookup.
+"""
+
+from __future__ import annotations
+
+import time
+from datetime import datetime
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+TEHRAN_TZ = ZoneInfo("Asia/Tehran")
+
+_SLOT = 900
+DEFAULT_FMT = "%Y-%m-%d %H:%M:%S"
+
+
+@lru_cache(maxsize=4096)
+def _offset(slot: int) -> int:
+    return int(datetime.fromtimestamp(slot * _SLOT, TEHRAN_TZ).utcoffset().total_seconds())
+
+
+def fmt_ts(ts, fmt: str = DEFAULT_FMT, default: str = "-") -> str:
+    """Epoch seconds -> Tehran local time text."""
+    if ts is None or ts == "":
+        return default
+    try:
+        ts = int(ts)
+    except (TypeError, ValueError):
+        # Not an epoch (should not happen after migration v7); show as is.
+        return str(ts)
+    return time.strftime(fmt, time.gmtime(ts + _offset(ts // _SLOT)))
+
+
+def fmt_utc(ts, fmt: str = DEFAULT_FMT, default: str = "-") -> str:
+    """Epoch seconds -> UTC text."""
+    if ts is None or ts == "":
+        return default
+    return time.strftime(fmt, time.gmtime(int(ts)))
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""In-memory user/role directory.
+
+The `users` table is small, so it is cached whole. bot.py's role
+middleware calls `resolve()` once per update; only a user we have never
+seen costs a write, everything else is a dict lookup. Handlers that
+change roles call `invalidate()` and the next update reloads the table.
+"""
+
+from __future__ import annotations
+
+from typing import Dict
+
+from adb import ADB
+from fleet import FLEET
+
+
+def _ensure_user_txn(conn, uid: int, owner: int) -> str:
+    # Runs on the writer thread; returns the user's (possibly new) role.
+    cur = conn.cursor()
+    cur.execute("SELECT role FROM users WHERE uid=?", (uid,))
+    r = cur.fetchone()
+    if r:
+        return r["role"]
+    role = "viewer"
+    if owner and uid == owner:
+        role = "owner"
+    elif not owner:
+        # if no OWNER env, first ever user becomes owner
+        cur.execute("SELECT uid FROM users WHERE role='owner' LIMIT 1")
+        if not cur.fetchone():
+            role = "owner"
+    cur.execute("INSERT INTO users(uid,role) VALUES (?,?)", (uid, role))
+    return role
+
+
+class UserDirectory:
+    def __init__(self) -> None:
+        self._roles: Dict[int, str] = {}
+        self._dirty = True
+        self.owner = 0  # OWNER_ID from the environment, set by bot.py
+
+    def invalidate(self) -> None:
+        self._dirty = True
+
+    async def refresh(self) -> None:
+        """Reload the table if it was invalidated (a no-op otherwise)."""
+        if not self._dirty:
+            return
+        self._dirty = False
+        try:
+            rows = await ADB.fetchall("SELECT uid, role FROM users")
+        except BaseException:
+            self._dirty = True
+            raise
+        self._roles = {int(r["uid"]): r["role"] for r in rows}
+
+    async def resolve(self, uid: int) -> str:
+        """Role of `uid`, registering unknown users on first contact."""
+        await self.refresh()
+        role = self._roles.get(uid)
+        if role is None:
+            role = await ADB.write(lambda c: _ensure_user_txn(c, uid, self.owner))
+            self._roles[uid] = role
+            if role == "owner":
+                FLEET.invalidate_admins()
+        return role
+
+    def role(self, uid: int) -> str:
+        return self._roles.get(uid, "viewer")
+
+    def owner_id(self) -> int:
+        if self.owner:
+            return self.owner
+        for uid, role in self._roles.items():
+            if role == "owner":
+                return uid
+        return 0
+
+
+USERS = UserDirectory()
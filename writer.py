@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""Write-behind buffer for probe results.
+
+The monitor only queues rows here; a background task flushes them with
+`executemany` in short transactions of at most `txn_rows` rows, either when
+`max_batch` rows are pending or every `flush_interval` seconds. Each
+transaction is a job on the async DB writer thread (adb.py), so bot
+handlers' writes queue between chunks instead of behind one long
+sweep-sized write.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Dict, List, Optional, Tuple
+
+from adb import ADB
+from db import db
+from partitions import LOGS
+
+# `{t}` is the current logs partition (partitions.py), resolved on the writer thread.
+_LOG_SQL = "INSERT INTO {t}(server_id, action, status, ts) VALUES (?,?,?,?)"
+_SAMPLE_SQL = "INSERT OR REPLACE INTO probe_samples(server_id, ts, rtt) VALUES (?,?,?)"
+# Rows for servers deleted while queued are skipped.
+_STATUS_SQL = (
+    "INSERT INTO server_status(server_id,last_status,last_check_ts,last_change_ts,last_notified_ts) "
+    "SELECT ?,?,?,?,? WHERE EXISTS (SELECT 1 FROM servers WHERE id=?) "
+    "ON CONFLICT(server_id) DO UPDATE SET last_status=excluded.last_status, "
+    "last_check_ts=excluded.last_check_ts, last_change_ts=excluded.last_change_ts, "
+    "last_notified_ts=excluded.last_notified_ts"
+)
+
+# Heartbeat rows are deltas: they add onto whatever the window already holds.
+_HEARTBEAT_SQL = (
+    "INSERT INTO probe_heartbeats(server_id,window_start,probes,failures,rtt_sum,rtt_n,last_status) "
+    "VALUES (?,?,?,?,?,?,?) ON CONFLICT(server_id, window_start) DO UPDATE SET "
+    "probes=probes+excluded.probes, failures=failures+excluded.failures, "
+    "rtt_sum=rtt_sum+excluded.rtt_sum, rtt_n=rtt_n+excluded.rtt_n, last_status=excluded.last_status"
+)
+
+
+def _bind(conn, sql: str) -> str:
+    return LOGS.bind(conn, sql) if sql == _LOG_SQL else sql
+
+
+class WriteBuffer:
+    def __init__(self, max_batch: int = 500, txn_rows: int = 500, flush_interval: float = 2.0) -> None:
+        self.max_batch = max_batch
+        self.txn_rows = txn_rows
+        self.flush_interval = flush_interval
+        self._logs: List[Tuple] = []
+        self._samples: List[Tuple] = []
+        # Only the latest status per server matters; older ones are coalesced.
+        self._status: Dict[int, Tuple] = {}
+        # (sid, window_start) -> [sid, window_start, probes, failures, rtt_sum, rtt_n, last_status]
+        self._beats: Dict[Tuple[int, int], list] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+
+        self.flushes = 0
+        self.rows_written = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.last_flush_ts = 0.0
+
+    # ---- producers ----
+    def log(self, sid: int, action: str, status: str, ts: int) -> None:
+        self._logs.append((sid, action, status, ts))
+        self._maybe_wake()
+
+    def sample(self, sid: int, ts: int, rtt: Optional[float]) -> None:
+        self._samples.append((sid, ts, rtt))
+        self._maybe_wake()
+
+    def status(self, sid: int, last_status, check_ts, change_ts, notified_ts) -> None:
+        self._status[sid] = (sid, last_status, check_ts, change_ts, notified_ts, sid)
+        self._maybe_wake()
+
+    def heartbeat(self, sid: int, window_start: int, status: str, rtt: Optional[float]) -> None:
+        b = self._beats.get((sid, window_start))
+        if b is None:
+            b = self._beats[(sid, window_start)] = [sid, window_start, 0, 0, 0.0, 0, status]
+        b[2] += 1
+        if status != "UP":
+            b[3] += 1
+        if rtt is not None:
+            b[4] += rtt
+            b[5] += 1
+        b[6] = status
+        self._maybe_wake()
+
+    def queue_depth(self) -> int:
+        return len(self._logs) + len(self._samples) + len(self._status) + len(self._beats)
+
+    def _maybe_wake(self) -> None:
+        if self._wakeup is not None and self.queue_depth() >= self.max_batch:
+            self._wakeup.set()
+
+    # ---- flushing ----
+    def _write_chunk_sync(self, sql: str, rows: List[Tuple]) -> None:
+        conn = db()
+        try:
+            conn.executemany(_bind(conn, sql), rows)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _take(self) -> List[Tuple[str, List[Tuple]]]:
+        batches = [
+            (_LOG_SQL, self._logs),
+            (_SAMPLE_SQL, self._samples),
+            (_STATUS_SQL, list(self._status.values())),
+            (_HEARTBEAT_SQL, [tuple(b) for b in self._beats.values()]),
+        ]
+        self._logs, self._samples, self._status, self._beats = [], [], {}, {}
+        return batches
+
+    def _requeue(self, batches, k: int, i: int) -> None:
+        # Put unwritten rows back (ahead of newer ones) for the next flush.
+        for j, (sql, rows) in enumerate(batches[k:]):
+            rest = rows[i:] if j == 0 else rows
+            if sql == _STATUS_SQL:
+                for row in rest:
+                    self._status.setdefault(row[0], row)
+            elif sql == _HEARTBEAT_SQL:
+                # Merge into counts gathered since; the newer last_status wins.
+                for row in rest:
+                    b = self._beats.get((row[0], row[1]))
+                    if b is None:
+                        self._beats[(row[0], row[1])] = list(row)
+                    else:
+                        for f in range(2, 6):
+                            b[f] += row[f]
+            elif sql == _SAMPLE_SQL:
+                self._samples[:0] = rest
+            else:
+                self._logs[:0] = rest
+
+    async def flush(self) -> int:
+        batches = self._take()
+        if not any(rows for _, rows in batches):
+            return 0
+
+        t0 = time.perf_counter()
+        n = 0
+        for k, (sql, rows) in enumerate(batches):
+            for i in range(0, len(rows), self.txn_rows):
+                chunk = rows[i:i + self.txn_rows]
+                # بین تراکنش‌ها نوشتن‌های هندلرها در صف writer اجرا می‌شوند
+                job = asyncio.ensure_future(ADB.write(
+                    lambda c, sql=sql, chunk=chunk: c.executemany(_bind(c, sql), chunk).rowcount
+                ))
+                try:
+                    await asyncio.shield(job)
+                except asyncio.CancelledError:
+                    # The submitted chunk still commits; only the rest goes back.
+                    self._requeue(batches, k, i + self.txn_rows)
+                    raise
+                except Exception:
+                    self._requeue(batches, k, i)
+                    raise
+                n += len(chunk)
+
+        ms = (time.perf_counter() - t0) * 1000.0
+        self.flushes += 1
+        self.rows_written += n
+        self.last_flush_ms = ms
+        self.max_flush_ms = max(self.max_flush_ms, ms)
+        self.last_flush_ts = time.time()
+        return n
+
+    def flush_sync(self) -> int:
+        """Best-effort final flush (shutdown path, no event loop needed)."""
+        n = 0
+        for sql, rows in self._take():
+            if rows:
+                self._write_chunk_sync(sql, rows)
+                n += len(rows)
+        return n
+
+    async def run(self) -> None:
+        self._wakeup = asyncio.Event()
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                try:
+                    await self.flush()
+                except Exception as e:
+                    print(f"--- [Writer Error] {e} ---")
+        except asyncio.CancelledError:
+            try:
+                self.flush_sync()
+            except Exception:
+                pass
+            raise
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth(),
+            "last_flush_ms": self.last_flush_ms,
+            "max_flush_ms": self.max_flush_ms,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+        }
+
+
+WRITER = WriteBuffer()